@@ -1,8 +1,15 @@
 from __future__ import annotations
 
-from fastapi import APIRouter, Depends
+import datetime as dt
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import BaseModel
 
 from .deps import admin_auth
+from middleware.db_migrate import explain_hot_queries
+from middleware.ledger_audit import reconcile as reconcile_ledger
+from middleware import api_keys, outbox
 
 
 router = APIRouter(prefix="/v1/admin", tags=["admin"])
@@ -12,3 +19,100 @@ router = APIRouter(prefix="/v1/admin", tags=["admin"])
 def admin_ping(ctx: dict = Depends(admin_auth)):
     return {"ok": True, "request_id": ctx.get("request_id")}
 
+
+
+@router.get("/db/index_check")
+def admin_db_index_check(ctx: dict = Depends(admin_auth)):
+    """EXPLAIN the hot-path queries; ok is false if any of them would scan a table."""
+    results = explain_hot_queries()
+    return {"ok": all(r["uses_index"] for r in results), "queries": results, "request_id": ctx.get("request_id")}
+
+
+@router.get("/ledger/discrepancies")
+def admin_ledger_discrepancies(full: bool = Query(False), ctx: dict = Depends(admin_auth)):
+    """Wallets whose balance differs from their ledger. Read-only: checkpoints are not advanced.
+
+    full=true sums the whole ledger instead of starting from the checkpoints.
+    """
+    res = reconcile_ledger(full=full, write_checkpoints=False)
+    return {**res, "ok": not res["discrepancies"], "request_id": ctx.get("request_id")}
+
+
+@router.get("/outbox/stats")
+def admin_outbox_stats(window_hours: int = Query(24, ge=1, le=24 * 30), ctx: dict = Depends(admin_auth)):
+    """Per destination: pending depth, oldest pending age, dead rows and success rate over the window."""
+    return {"destinations": outbox.destination_stats(window_hours), "window_hours": window_hours, "request_id": ctx.get("request_id")}
+
+
+@router.get("/outbox/dead")
+def admin_outbox_dead(
+    endpoint: str | None = Query(None),
+    created_from: dt.datetime | None = Query(None),
+    created_to: dt.datetime | None = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+    cursor: str | None = Query(None, description="next_cursor of the previous page"),
+    ctx: dict = Depends(admin_auth),
+):
+    try:
+        rows, next_cursor = outbox.list_dead(endpoint=endpoint, created_from=created_from, created_to=created_to, limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "request_id": ctx.get("request_id"),
+        "next_cursor": next_cursor,
+        "rows": [
+            {
+                "id": r.id,
+                "endpoint": r.endpoint,
+                "attempts": r.attempts,
+                "last_error": r.last_error,
+                "created_at": r.created_at.isoformat() if r.created_at else None,
+            }
+            for r in rows
+        ],
+    }
+
+
+class OutboxReplayBody(BaseModel):
+    endpoint: Optional[str] = None
+    created_from: Optional[dt.datetime] = None
+    created_to: Optional[dt.datetime] = None
+    ids: Optional[list[int]] = None
+
+
+@router.post("/outbox/replay")
+def admin_outbox_replay(body: OutboxReplayBody, ctx: dict = Depends(admin_auth)):
+    """Requeue dead rows matching endpoint / created_at range / ids (at least one filter)."""
+    if not (body.endpoint or body.created_from or body.created_to or body.ids):
+        raise HTTPException(status_code=400, detail="endpoint, created_from/created_to or ids required")
+    n = outbox.replay_dead(endpoint=body.endpoint, created_from=body.created_from, created_to=body.created_to, ids=body.ids)
+    return {"ok": True, "replayed": n, "request_id": ctx.get("request_id")}
+
+
+class ApiKeyCreateBody(BaseModel):
+    user_id: int
+    litellm_api_key: str  # the user's LiteLLM virtual key; forwarded by the proxy, never returned
+    model_allowlist: Optional[list[str]] = None
+    max_budget_cents: Optional[int] = None
+    budget_duration: Optional[str] = None
+    rpm_limit: Optional[int] = None
+    tpm_limit: Optional[int] = None
+    cost_per_minute_cents: Optional[int] = None
+
+
+@router.post("/api_keys")
+def admin_create_api_key(body: ApiKeyCreateBody, ctx: dict = Depends(admin_auth)):
+    """Create a /v1/proxy API key. The key is returned only here; only its hash is stored."""
+    try:
+        raw, k = api_keys.create_key(**body.model_dump())
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"ok": True, "id": k.id, "api_key": raw, "key_last4": k.key_last4, "request_id": ctx.get("request_id")}
+
+
+@router.post("/api_keys/{key_id}/revoke")
+def admin_revoke_api_key(key_id: int, ctx: dict = Depends(admin_auth)):
+    """Deactivate a key; all workers reject it within about a second."""
+    if not api_keys.revoke(key_id):
+        raise HTTPException(status_code=404, detail="api key not found")
+    return {"ok": True, "id": key_id, "request_id": ctx.get("request_id")}
@@ -52,13 +52,16 @@ def api_list_customers(
     entity_id: int | None = Query(None),
     limit: int = Query(50, ge=1, le=200),
     offset: int = Query(0, ge=0),
+    cursor: str | None = Query(None, description="next_cursor of the previous page; takes precedence over offset"),
+    include_total: bool = Query(True, description="false skips the (cached) total count"),
     ctx: dict = Depends(dev_auth),
 ):
     try:
-        rows, total = list_customers(q=q, entity_type=entity_type, entity_id=entity_id, limit=limit, offset=offset)
+        rows, total, next_cursor = list_customers(q=q, entity_type=entity_type, entity_id=entity_id, limit=limit, offset=offset, cursor=cursor, with_total=include_total)
         return {
             "request_id": ctx.get("request_id"),
             "total": total,
+            "next_cursor": next_cursor,
             "customers": [
                 {
                     "id": c.id,
@@ -190,13 +193,16 @@ def api_list_invoices(
     status: str | None = Query(None),
     limit: int = Query(50, ge=1, le=200),
     offset: int = Query(0, ge=0),
+    cursor: str | None = Query(None, description="next_cursor of the previous page; takes precedence over offset"),
+    include_total: bool = Query(True, description="false skips the (cached) total count"),
     ctx: dict = Depends(dev_auth),
 ):
     try:
-        rows, total = list_invoices_with_customer(customer_id=customer_id, status=status, limit=limit, offset=offset)
+        rows, total, next_cursor = list_invoices_with_customer(customer_id=customer_id, status=status, limit=limit, offset=offset, cursor=cursor, with_total=include_total)
         return {
             "request_id": ctx.get("request_id"),
             "total": total,
+            "next_cursor": next_cursor,
             "invoices": [
                 {
                     "id": inv["id"],
@@ -263,13 +269,16 @@ def api_list_subscriptions(
     status: str | None = Query(None),
     limit: int = Query(50, ge=1, le=200),
     offset: int = Query(0, ge=0),
+    cursor: str | None = Query(None, description="next_cursor of the previous page; takes precedence over offset"),
+    include_total: bool = Query(True, description="false skips the (cached) total count"),
     ctx: dict = Depends(dev_auth),
 ):
     try:
-        rows, total = list_subscriptions_with_join(customer_id=customer_id, plan_id=plan_id, status=status, limit=limit, offset=offset)
+        rows, total, next_cursor = list_subscriptions_with_join(customer_id=customer_id, plan_id=plan_id, status=status, limit=limit, offset=offset, cursor=cursor, with_total=include_total)
         return {
             "request_id": ctx.get("request_id"),
             "total": total,
+            "next_cursor": next_cursor,
             "subscriptions": [
                 {
                     "id": sub["id"],
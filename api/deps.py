@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import uuid
 from fastapi import Header, HTTPException, Response
+from middleware import api_keys
 from middleware.config import settings
 from middleware.runtime_config import get as rc_get
 
@@ -30,6 +31,29 @@ def dev_auth(
     return ctx
 
 
+def proxy_auth(
+    response: Response,
+    authorization: str | None = Header(default=None, alias="authorization"),
+    x_api_key: str | None = Header(default=None, alias="x-api-key"),
+    x_dev_user_id: str | None = Header(default=None, alias="x-dev-user-id"),
+    x_request_id: str | None = Header(default=None, alias="x-request-id"),
+):
+    """Proxy auth behavior:
+    - Authorization: Bearer <API key>: the key is hashed and resolved (cached) to its
+      KeyContext, returned as ctx["api_key"]; unknown or revoked keys get 401.
+    - Otherwise dev_auth rules apply (DEV_API_KEY + x-dev-user-id).
+    """
+    token = authorization[7:].strip() if authorization and authorization[:7].lower() == "bearer " else None
+    if not token:
+        return dev_auth(response, x_api_key, x_dev_user_id, x_request_id)
+    request_id = (x_request_id or str(uuid.uuid4()))
+    response.headers["x-request-id"] = request_id
+    kctx = api_keys.authenticate(token)
+    if kctx is None:
+        raise HTTPException(status_code=401, detail="invalid api key", headers={"x-request-id": request_id})
+    return {"request_id": request_id, "api_key": kctx}
+
+
 def request_context(
     response: Response,
     x_request_id: str | None = Header(default=None, alias="x-request-id"),
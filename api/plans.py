@@ -16,6 +16,7 @@ from middleware.plans.service import (
     get_assignment,
     list_plans,
     set_plan_status,
+    set_assignment_status,
 )
 
 
@@ -153,6 +154,19 @@ def api_update_plan_status(plan_id: int, body: UpdatePlanStatusBody, ctx: dict =
         raise HTTPException(status_code=400, detail=str(e))
 
 
+class UpdateAssignmentStatusBody(BaseModel):
+    status: str = Field(pattern=r"^(active|paused|canceled)$")
+
+
+@router.patch("/assignment/{assignment_id}/status")
+def api_update_assignment_status(assignment_id: int, body: UpdateAssignmentStatusBody, ctx: dict = Depends(dev_auth)):
+    try:
+        pa = set_assignment_status(assignment_id, status=body.status)
+    except ValueError as e:
+        raise HTTPException(status_code=404 if "not found" in str(e) else 400, detail=str(e))
+    return {"request_id": ctx.get("request_id"), "assignment": {"id": pa.id, "entity_type": pa.entity_type, "entity_id": pa.entity_id, "plan_id": pa.plan_id, "status": pa.status}}
+
+
 @router.get("/assignment/{entity_type}/{entity_id}")
 def api_get_assignment(entity_type: str, entity_id: int, ctx: dict = Depends(dev_auth)):
     pa = get_assignment(entity_type, entity_id)
@@ -166,12 +180,18 @@ def api_list_plans(
     status: str | None = Query(None),
     limit: int = Query(50, ge=1, le=200),
     offset: int = Query(0, ge=0),
+    cursor: str | None = Query(None, description="next_cursor of the previous page; takes precedence over offset"),
+    include_total: bool = Query(True, description="false skips the (cached) total count"),
     ctx: dict = Depends(dev_auth),
 ):
-    rows, total = list_plans(q=q, type=type, status=status, limit=limit, offset=offset)
+    try:
+        rows, total, next_cursor = list_plans(q=q, type=type, status=status, limit=limit, offset=offset, cursor=cursor, with_total=include_total)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {
         "request_id": ctx.get("request_id"),
         "total": total,
+        "next_cursor": next_cursor,
         "plans": [
             {
                 "id": p.id,
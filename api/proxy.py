@@ -1,17 +1,21 @@
 from __future__ import annotations
 
+import asyncio
 import json
-import urllib.request
 from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Header
+import httpx
+from fastapi import APIRouter, Depends, HTTPException, Header, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-from .deps import dev_auth
+from .deps import proxy_auth
 from middleware.config import settings
 from middleware.runtime_config import get as rc_get
-from middleware.plans.service import estimate_cost_for_tokens, check_daily_limit, record_usage_row, get_daily_limit_status, record_overdraft_alert, has_today_overdraft, get_degrade_fallback
+from middleware.plans.service import BillingContext, load_billing_context, settle_usage, get_degrade_fallback
+from middleware import api_keys, prepaid, quotas
 from middleware.integrations.lago_stub import record_usage
+from middleware.integrations.litellm_proxy import get_client, chat_url, auth_headers, SSEUsageTracker
 
 
 router = APIRouter(prefix="/v1/proxy", tags=["proxy"])
@@ -20,32 +24,25 @@ router = APIRouter(prefix="/v1/proxy", tags=["proxy"])
 class ChatBody(BaseModel):
     model: str
     messages: list[dict]
+    stream: bool = False
     # optional usage hints
     input_tokens: Optional[int] = None
     output_tokens: Optional[int] = None
 
 
-@router.post("/chat/completions")
-def proxy_chat(body: ChatBody, ctx: dict = Depends(dev_auth), x_litellm_api_key: Optional[str] = Header(default=None, alias="x-litellm-api-key")):
-    # Validate config
-    base_url = rc_get("LITELLM_BASE_URL", str, settings.LITELLM_BASE_URL)
-    if not base_url:
-        raise HTTPException(status_code=503, detail="LiteLLM base URL not configured")
-    if not x_litellm_api_key:
-        raise HTTPException(status_code=400, detail="x-litellm-api-key header required")
-    # Determine user_id (dev mode allows x-dev-user-id)
-    try:
-        user_id = int(ctx.get("dev_user_id") or 0)
-    except Exception:
-        user_id = 0
-    if user_id <= 0:
-        raise HTTPException(status_code=400, detail="user_id required (provide x-dev-user-id in dev mode)")
+def _gate_request(user_id: int, body: ChatBody, litellm_api_key: str, key: Optional[api_keys.KeyContext] = None) -> tuple[str, BillingContext, Optional[prepaid.Hold], Optional[quotas.Charge]]:
+    """Overdraft gating, daily-limit pre-check, API-key budget, per-minute quotas and (prepaid mode) wallet hold.
 
+    Returns the model to forward, the billing context, which is reused at settlement,
+    the prepaid hold to settle (None when prepaid metering is off) and the quota
+    charge to correct (None when neither the API key nor the plan sets limits).
+    """
     # Overdraft next-request strong gating (if enabled)
     selected_model = body.model
     gating_enabled = rc_get("OVERDRAFT_GATING_ENABLED", bool, settings.OVERDRAFT_GATING_ENABLED)
     gating_mode = rc_get("OVERDRAFT_GATING_MODE", str, settings.OVERDRAFT_GATING_MODE)
-    if gating_enabled and has_today_overdraft(user_id):
+    bctx = load_billing_context(user_id, include_overdraft=bool(gating_enabled))
+    if gating_enabled and bctx.has_overdraft_today:
         if gating_mode == "block":
             raise HTTPException(status_code=403, detail="overdraft gating active (block)")
         elif gating_mode == "degrade":
@@ -54,108 +51,229 @@ def proxy_chat(body: ChatBody, ctx: dict = Depends(dev_auth), x_litellm_api_key:
     # Estimate cost for gating (tokens unknown -> skip or use hints)
     est_cents = 0
     if body.input_tokens is not None or body.output_tokens is not None:
-        est_cents, _tz = estimate_cost_for_tokens(
-            user_id,
-            model=selected_model,
+        est_cents = bctx.estimate_cost(
+            selected_model,
             input_tokens=body.input_tokens or 0,
             output_tokens=body.output_tokens or 0,
-            total_tokens=None,
         )
-        allowed, policy, reason, remaining = check_daily_limit(user_id, add_amount_cents=est_cents)
+        allowed, policy, reason, remaining = bctx.check_daily_limit(add_amount_cents=est_cents)
         if not allowed:
             raise HTTPException(status_code=403, detail=f"daily limit exceeded: {reason}")
         if policy == "degrade" and est_cents > remaining:
             # simple hard-coded degrade mapping for demo
             selected_model = get_degrade_fallback(selected_model)
+            est_cents = bctx.estimate_cost(selected_model, input_tokens=body.input_tokens or 0, output_tokens=body.output_tokens or 0)
 
-    # Forward request to LiteLLM
-    url = base_url.rstrip("/") + "/chat/completions"
-    data = json.dumps({"model": selected_model, "messages": body.messages}).encode("utf-8")
-    req = urllib.request.Request(url, data=data, headers={
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {x_litellm_api_key}",
-    })
-    try:
-        with urllib.request.urlopen(req, timeout=30) as resp:  # nosec - trusted URL from config
-            raw = resp.read()
-            status = resp.getcode()
-    except Exception as e:
-        raise HTTPException(status_code=502, detail=f"upstream error: {e}")
-    if status // 100 != 2:
-        raise HTTPException(status_code=502, detail=f"upstream status {status}")
+    # Per-minute request/token/cost limits of the API key and of the plan
+    if key is None:
+        # dev auth: the key linked to the forwarded LiteLLM key, if any
+        key = api_keys.context_for_litellm_key(litellm_api_key)
+    scopes = [(f"user:{user_id}", quotas.limits_from_meta(bctx.plan_meta))]
+    if key is not None:
+        if api_keys.over_budget(key):
+            raise HTTPException(status_code=402, detail="api key budget exceeded")
+        bctx.api_key_id = key.key_id
+        scopes.append((f"key:{key.key_id}", key.limits))
+    charge = None
+    use_prepaid = prepaid.enabled()
+    limited = any(lim for _, lim in scopes)
+    if limited or use_prepaid:
+        in_t, out_t = quotas.estimate_tokens(body.messages, input_tokens=body.input_tokens, output_tokens=body.output_tokens)
+    if limited:
+        cost_cents = bctx.estimate_cost(selected_model, input_tokens=in_t, output_tokens=out_t) if any(lim.cost_cents for _, lim in scopes) else 0
+        try:
+            charge = quotas.precharge(scopes, tokens=in_t + out_t, cents=cost_cents)
+        except quotas.QuotaExceeded as e:
+            raise HTTPException(status_code=429, detail=str(e), headers=e.headers)
 
-    # Parse response and usage
-    try:
-        j = json.loads(raw.decode("utf-8"))
-    except Exception as e:
-        raise HTTPException(status_code=502, detail=f"invalid upstream payload: {e}")
+    hold = None
+    if use_prepaid:
+        # without hints, hold the same token estimate the quotas charge, so
+        # concurrent requests cannot all pass on a nearly empty wallet
+        hold_cents = est_cents if est_cents else bctx.estimate_cost(selected_model, input_tokens=in_t, output_tokens=out_t)
+        try:
+            hold = prepaid.reserve(user_id, hold_cents, currency=prepaid.PRICE_CURRENCY)
+        except prepaid.InsufficientBalance as e:
+            quotas.release(charge)
+            raise HTTPException(status_code=402, detail=str(e))
+        except prepaid.CurrencyMismatch as e:
+            quotas.release(charge)
+            raise HTTPException(status_code=503, detail=f"prepaid metering misconfigured: {e}")
+    return selected_model, bctx, hold, charge
+
+
+async def _release(hold: Optional[prepaid.Hold], charge: Optional[quotas.Charge]) -> None:
+    """Nothing was consumed upstream: drop the wallet hold and give the quota charge back."""
+    prepaid.release(hold)
+    if charge is not None:
+        await asyncio.to_thread(quotas.release, charge)
 
-    usage = j.get("usage") or {}
+
+def _settle_usage(bctx: BillingContext, *, model: str, usage: dict, request_id: Optional[str], hold: Optional[prepaid.Hold] = None, charge: Optional[quotas.Charge] = None) -> bool:
+    """Price the upstream usage, record it locally and in Lago. Returns True on overdraft."""
     prompt_t = int(usage.get("prompt_tokens") or 0)
     completion_t = int(usage.get("completion_tokens") or 0)
     total_t = int(usage.get("total_tokens") or (prompt_t + completion_t))
 
-    # Compute final cost if we have rules
-    final_cents, _tz = estimate_cost_for_tokens(
-        user_id,
-        model=selected_model,
-        input_tokens=prompt_t,
-        output_tokens=completion_t,
-        total_tokens=total_t,
-    )
-    if final_cents > 0:
-        # apply grace cap: overflow part not charged
-        dlp, spent, remaining = get_daily_limit_status(user_id)
-        charged_cents = final_cents
-        if dlp and dlp.overflow_policy == "grace":
-            charged_cents = max(0, min(final_cents, remaining))
-        # block policy: if no hints and overflow would have occurred, cap and mark overdraft
-        overdraft = False
-        if dlp and dlp.overflow_policy == "block" and final_cents > remaining:
-            overdraft = True
-            charged_cents = max(0, min(final_cents, remaining))
-            # record overdraft alert for audit
-            try:
-                record_overdraft_alert(
-                    user_id=user_id,
-                    model=selected_model,
-                    request_id=ctx.get("request_id"),
-                    overflow_policy=dlp.overflow_policy,
-                    final_amount_cents=final_cents,
-                    charged_amount_cents=charged_cents,
-                    remaining_before_cents=remaining,
-                )
-            except Exception:
-                pass
-        # Record locally for day-limit aggregation
-        record_usage_row(user_id, model=selected_model, input_tokens=prompt_t, output_tokens=completion_t, total_tokens=total_t, computed_amount_cents=charged_cents, request_id=ctx.get("request_id"))
-        # Push to Lago
+    # Usage row and overdraft alert (block policy) are written in one transaction
+    try:
+        res = settle_usage(bctx, model=model, input_tokens=prompt_t, output_tokens=completion_t, total_tokens=total_t, request_id=request_id)
+    except Exception:
+        prepaid.release(hold)
+        quotas.settle(charge, tokens=total_t, cents=0)
+        raise
+    prepaid.settle(hold, res.charged_amount_cents)
+    quotas.settle(charge, tokens=total_t, cents=res.final_amount_cents)
+    if res.final_amount_cents <= 0:
+        return False
+    dlp = bctx.daily_limit
+    # Push to Lago
+    try:
+        record_usage(
+            usage_id=f"u-{request_id}",
+            user_id=bctx.user_id,
+            team_id=None,
+            model=model,
+            unit="token",
+            total_tokens=total_t,
+            input_tokens=prompt_t,
+            output_tokens=completion_t,
+            unit_base_price_cents=None,
+            price_multiplier=None,
+            computed_amount_cents=res.charged_amount_cents,
+            currency="USD",
+            timestamp=None,
+            request_id=request_id,
+            success=True,
+            meta={"overflow_policy": (dlp.overflow_policy if dlp else None), "overdraft": res.overdraft}
+        )
+    except Exception:
+        pass
+    return res.overdraft
+
+
+@router.post("/chat/completions")
+async def proxy_chat(body: ChatBody, response: Response, ctx: dict = Depends(proxy_auth), x_litellm_api_key: Optional[str] = Header(default=None, alias="x-litellm-api-key")):
+    # Validate config
+    base_url = rc_get("LITELLM_BASE_URL", str, settings.LITELLM_BASE_URL)
+    if not base_url:
+        raise HTTPException(status_code=503, detail="LiteLLM base URL not configured")
+    key: Optional[api_keys.KeyContext] = ctx.get("api_key")
+    if key is not None:
+        # API key auth: the key decides the user and the models it may call
+        if not key.allows_model(body.model):
+            raise HTTPException(status_code=403, detail=f"model not allowed for this api key: {body.model}")
+        user_id = key.user_id
+        # forward the LiteLLM key linked to this api key (resolved here, the client
+        # never holds it), never the master key, so LiteLLM applies the user's own
+        # budget and attributes the spend
+        if not key.litellm_api_key:
+            raise HTTPException(status_code=403, detail="api key is not linked to a LiteLLM key")
+        upstream_key = key.litellm_api_key
+    else:
+        # Determine user_id (dev mode allows x-dev-user-id)
         try:
-            record_usage(
-                usage_id=f"u-{ctx.get('request_id')}",
-                user_id=user_id,
-                team_id=None,
-                model=selected_model,
-                unit="token",
-                total_tokens=total_t,
-                input_tokens=prompt_t,
-                output_tokens=completion_t,
-                unit_base_price_cents=None,
-                price_multiplier=None,
-                computed_amount_cents=charged_cents,
-                currency="USD",
-                timestamp=None,
-                request_id=ctx.get("request_id"),
-                success=True,
-                meta={"overflow_policy": (dlp.overflow_policy if dlp else None), "overdraft": overdraft}
-            )
+            user_id = int(ctx.get("dev_user_id") or 0)
         except Exception:
-            pass
+            user_id = 0
+        if not x_litellm_api_key:
+            raise HTTPException(status_code=400, detail="x-litellm-api-key header required")
+        upstream_key = x_litellm_api_key
+    if user_id <= 0:
+        raise HTTPException(status_code=400, detail="user_id required (provide x-dev-user-id in dev mode)")
+
+    if prepaid.enabled():
+        # exhausted prepaid wallets are rejected from memory, before any DB work
+        try:
+            prepaid.check(user_id)
+        except prepaid.InsufficientBalance as e:
+            raise HTTPException(status_code=402, detail=str(e))
+
+    # Billing checks hit the DB; keep them off the event loop
+    selected_model, bctx, hold, charge = await asyncio.to_thread(_gate_request, user_id, body, upstream_key, key)
+    request_id = ctx.get("request_id")
+
+    # Forward request to LiteLLM over the pooled keep-alive client
+    payload: dict = {"model": selected_model, "messages": body.messages}
+    if body.stream:
+        payload["stream"] = True
+        # ask upstream to append a final usage chunk so we can still bill streamed calls
+        payload["stream_options"] = {"include_usage": True}
+    client = get_client()
+    req = client.build_request("POST", chat_url(base_url), content=json.dumps(payload).encode("utf-8"), headers=auth_headers(upstream_key))
+    try:
+        resp = await client.send(req, stream=body.stream)
+    except httpx.HTTPError as e:
+        await _release(hold, charge)
+        raise HTTPException(status_code=502, detail=f"upstream error: {e}")
+    if resp.status_code // 100 != 2:
+        await resp.aclose()
+        await _release(hold, charge)
+        raise HTTPException(status_code=502, detail=f"upstream status {resp.status_code}")
+
+    if body.stream:
+        return _stream_response(resp, bctx=bctx, model=selected_model, requested_model=body.model, request_id=request_id, hold=hold, charge=charge)
+
+    # Parse response and usage
+    try:
+        j = resp.json()
+    except Exception as e:
+        await _release(hold, charge)
+        raise HTTPException(status_code=502, detail=f"invalid upstream payload: {e}")
+
+    overdraft = await asyncio.to_thread(_settle_usage, bctx, model=selected_model, usage=j.get("usage") or {}, request_id=request_id, hold=hold, charge=charge)
+    response.headers.update(quotas.headers(charge))
 
     # Return upstream payload with request_id
-    j["request_id"] = ctx.get("request_id")
+    j["request_id"] = request_id
     if selected_model != body.model:
         j["degraded_model"] = selected_model
-    if final_cents > 0 and dlp and dlp.overflow_policy == "block" and final_cents > remaining:
+    if overdraft:
         j["overdraft"] = True
     return j
+
+
+# Settlement tasks of streams whose client went away; held so they are not collected mid-run
+_settle_tasks: set[asyncio.Task] = set()
+
+
+async def _finish_stream(resp: httpx.Response, tracker: SSEUsageTracker, *, bctx: BillingContext, model: str, request_id: Optional[str], hold: Optional[prepaid.Hold], charge: Optional[quotas.Charge]) -> None:
+    try:
+        await resp.aclose()
+    except Exception:
+        pass
+    # settle even if the client went away mid-stream: tokens were still consumed
+    if tracker.usage:
+        try:
+            await asyncio.to_thread(_settle_usage, bctx, model=model, usage=tracker.usage, request_id=request_id, hold=hold, charge=charge)
+        except Exception:
+            pass
+    else:
+        # no usage chunk: free the wallet hold and the token/cost estimates, but keep
+        # the request counted, or stripping usage would get around the RPM limit
+        prepaid.release(hold)
+        if charge is not None:
+            await asyncio.to_thread(quotas.settle, charge, tokens=0, cents=0)
+
+
+def _stream_response(resp: httpx.Response, *, bctx: BillingContext, model: str, requested_model: str, request_id: Optional[str], hold: Optional[prepaid.Hold] = None, charge: Optional[quotas.Charge] = None) -> StreamingResponse:
+    tracker = SSEUsageTracker()
+
+    async def _relay():
+        try:
+            async for chunk in resp.aiter_bytes():
+                tracker.feed(chunk)
+                yield chunk
+        finally:
+            tracker.close()
+            # on a client disconnect this runs inside a cancelled scope, where any await
+            # is interrupted: close upstream and settle from a task of its own
+            task = asyncio.get_running_loop().create_task(_finish_stream(resp, tracker, bctx=bctx, model=model, request_id=request_id, hold=hold, charge=charge))
+            _settle_tasks.add(task)
+            task.add_done_callback(_settle_tasks.discard)
+
+    # Injected response headers are not applied to returned Response objects; set them here
+    headers = {"x-request-id": str(request_id or ""), "Cache-Control": "no-cache", **quotas.headers(charge)}
+    if model != requested_model:
+        headers["x-degraded-model"] = model
+    return StreamingResponse(_relay(), media_type=resp.headers.get("content-type") or "text/event-stream", headers=headers)
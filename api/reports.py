@@ -1,18 +1,22 @@
 from __future__ import annotations
 
+import csv
 import datetime as dt
-from typing import Optional
+import io
+import json
+from typing import Iterable, Iterator, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Query
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, select
 
 from .deps import request_context, admin_auth
 from middleware.db import SessionLocal
-from middleware.models import Usage, OverdraftAlert, Wallet, ApiKey
+from middleware.models import OverdraftAlert, Wallet, ApiKey, LedgerEntry, Usage
 from middleware.lago.service import LagoPayment
 from middleware.plans.service import utc8_day_start, get_daily_limit_status
+from middleware.usage_rollups import usage_buckets
 from middleware.config import settings
 from middleware.runtime_config import get as rc_get
 
@@ -20,10 +24,36 @@ from middleware.runtime_config import get as rc_get
 router = APIRouter(prefix="/v1/reports", tags=["reports"])
 
 
+# rows fetched per round trip by the streaming exports
+_EXPORT_CHUNK = 1000
+
+
 def _session() -> Session:
     return SessionLocal()
 
 
+def _csv_text(headers: list[str], rows: Iterable[list]) -> str:
+    buf = io.StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    w.writerow(headers)
+    w.writerows(rows)
+    return buf.getvalue()
+
+
+def _parse_range(date_from: str, date_to: str) -> tuple[dt.datetime, dt.datetime]:
+    """[start, end) in UTC for inclusive UTC+8 dates."""
+    try:
+        y1, m1, d1 = map(int, date_from.split("-"))
+        y2, m2, d2 = map(int, date_to.split("-"))
+        base_from = dt.datetime(y1, m1, d1)
+        base_to = dt.datetime(y2, m2, d2)
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid date format")
+    if base_to < base_from:
+        raise HTTPException(status_code=400, detail="date_to must be >= date_from")
+    return utc8_day_start(base_from, hhmm="00:00"), utc8_day_start(base_to, hhmm="00:00") + dt.timedelta(days=1)
+
+
 @router.get("/daily")
 def daily_report(user_id: int, date: str = Query(..., description="YYYY-MM-DD"), ctx: dict = Depends(request_context)):
     try:
@@ -34,11 +64,9 @@ def daily_report(user_id: int, date: str = Query(..., description="YYYY-MM-DD"),
     start = utc8_day_start(base, hhmm="00:00")
     end = start + dt.timedelta(days=1)
     with _session() as s:
-        q = s.query(
-            func.coalesce(func.sum(Usage.computed_amount_cents), 0),
-            func.coalesce(func.sum(Usage.total_tokens), 0),
-        ).filter(Usage.user_id == user_id, Usage.created_at >= start, Usage.created_at < end)
-        amount_cents, total_tokens = q.one()
+        buckets = usage_buckets(s, start=start, end=end, user_id=user_id)
+    amount_cents = sum(b[2] for b in buckets)
+    total_tokens = sum(b[3] for b in buckets)
     return {"request_id": ctx.get("request_id"), "user_id": user_id, "date": date, "amount_cents": int(amount_cents), "total_tokens": int(total_tokens)}
 
 
@@ -84,7 +112,7 @@ def budget_report(
         window_start = utc8_day_start(now, hhmm=str(dlp.reset_time))
         window_end = window_start + dt.timedelta(days=1)
         daily_limit = {
-            "plan_id": dlp.id,
+            "plan_id": dlp.plan_id,
             "daily_limit_cents": int(dlp.daily_limit_cents),
             "overflow_policy": dlp.overflow_policy,
             "reset_time": dlp.reset_time,
@@ -152,8 +180,7 @@ def budget_report(
             str(api_keys_count),
             str(api_keys_budget_total),
         ]
-        csv_text = ",".join(headers) + "\n" + ",".join(row) + "\n"
-        return PlainTextResponse(content=csv_text, media_type="text/csv")
+        return PlainTextResponse(content=_csv_text(headers, [row]), media_type="text/csv")
 
     return data
 
@@ -165,225 +192,34 @@ def period_team_report(
     date_to: str = Query(..., description="YYYY-MM-DD (inclusive, UTC+8 window)"),
     model: Optional[str] = Query(None, description="filter by model"),
     success: Optional[bool] = Query(None, description="filter by success flag"),
-    group_by: str = Query("total", pattern=r"^(total|model|day|model_day)$"),
+    group_by: str = Query("total", pattern=r"^(total|model|day|model_day|hour|model_hour)$"),
     format: str = Query("json", pattern=r"^(json|csv)$"),
     ctx: dict = Depends(admin_auth),
 ):
-    # parse dates
-    try:
-        y1, m1, d1 = map(int, date_from.split("-"))
-        y2, m2, d2 = map(int, date_to.split("-"))
-        base_from = dt.datetime(y1, m1, d1)
-        base_to = dt.datetime(y2, m2, d2)
-    except Exception:
-        raise HTTPException(status_code=400, detail="invalid date format")
-    if base_to < base_from:
-        raise HTTPException(status_code=400, detail="date_to must be >= date_from")
-    start = utc8_day_start(base_from, hhmm="00:00")
-    end = utc8_day_start(base_to, hhmm="00:00") + dt.timedelta(days=1)
-
-    with _session() as s:
-        if group_by == "total":
-            uq = s.query(
-                func.coalesce(func.sum(Usage.computed_amount_cents), 0),
-                func.coalesce(func.sum(Usage.total_tokens), 0),
-            ).filter(Usage.team_id == team_id, Usage.created_at >= start, Usage.created_at < end)
-            if model:
-                uq = uq.filter(Usage.model == model)
-            if success is not None:
-                uq = uq.filter(Usage.success == bool(success))
-            usage_amount_cents, usage_tokens = uq.one()
-        else:
-            groups: list[dict] = []
-            def _sum_usage(filters) -> tuple[int, int]:
-                q = s.query(
-                    func.coalesce(func.sum(Usage.computed_amount_cents), 0),
-                    func.coalesce(func.sum(Usage.total_tokens), 0),
-                ).filter(*filters)
-                a, t = q.one()
-                return int(a or 0), int(t or 0)
-
-            models: list[str] = []
-            if group_by in ("model", "model_day"):
-                if model:
-                    models = [model]
-                else:
-                    mrows = (
-                        s.query(Usage.model)
-                        .filter(Usage.team_id == team_id, Usage.created_at >= start, Usage.created_at < end)
-                        .distinct()
-                        .all()
-                    )
-                    models = [r[0] for r in mrows]
-
-            if group_by == "model":
-                for m in models:
-                    filters = [Usage.team_id == team_id, Usage.created_at >= start, Usage.created_at < end, Usage.model == m]
-                    if success is not None:
-                        filters.append(Usage.success == bool(success))
-                    a, t = _sum_usage(filters)
-                    if a or t:
-                        groups.append({"model": m, "usage_amount_cents": a, "usage_tokens": t})
-            elif group_by == "day":
-                cur = start
-                while cur < end:
-                    day_end = cur + dt.timedelta(days=1)
-                    filters = [Usage.team_id == team_id, Usage.created_at >= cur, Usage.created_at < day_end]
-                    if model:
-                        filters.append(Usage.model == model)
-                    if success is not None:
-                        filters.append(Usage.success == bool(success))
-                    a, t = _sum_usage(filters)
-                    if a or t:
-                        groups.append({"date": (cur + dt.timedelta(hours=8)).strftime("%Y-%m-%d"), "usage_amount_cents": a, "usage_tokens": t})
-                    cur = day_end
-            elif group_by == "model_day":
-                cur = start
-                while cur < end:
-                    day_end = cur + dt.timedelta(days=1)
-                    for m in models:
-                        filters = [
-                            Usage.team_id == team_id,
-                            Usage.created_at >= cur,
-                            Usage.created_at < day_end,
-                            Usage.model == m,
-                        ]
-                        if success is not None:
-                            filters.append(Usage.success == bool(success))
-                        a, t = _sum_usage(filters)
-                        if a or t:
-                            groups.append({
-                                "date": (cur + dt.timedelta(hours=8)).strftime("%Y-%m-%d"),
-                                "model": m,
-                                "usage_amount_cents": a,
-                                "usage_tokens": t,
-                            })
-                    cur = day_end
-
-            usage_amount_cents = sum(g.get("usage_amount_cents", 0) for g in groups)
-            usage_tokens = sum(g.get("usage_tokens", 0) for g in groups)
-
-        topup = s.query(func.coalesce(func.sum(LagoPayment.amount_cents), 0)).filter(
-            LagoPayment.team_id == team_id,
-            LagoPayment.created_at >= start,
-            LagoPayment.created_at < end,
-            LagoPayment.event_type == "wallet_topup",
-            LagoPayment.status == "succeeded",
-        ).scalar() or 0
-
-        refunds = s.query(func.coalesce(func.sum(LagoPayment.amount_cents), 0)).filter(
-            LagoPayment.team_id == team_id,
-            LagoPayment.created_at >= start,
-            LagoPayment.created_at < end,
-            LagoPayment.event_type == "refund",
-        ).scalar() or 0
-
-    net_topup_cents = int(topup) - int(refunds)
-    usage_amount_cents = int(usage_amount_cents)
-    usage_tokens = int(usage_tokens)
-    balance_delta_cents = net_topup_cents - usage_amount_cents
-
-    data = {
-        "request_id": ctx.get("request_id"),
-        "team_id": team_id,
-        "from": date_from,
-        "to": date_to,
-        "usage_amount_cents": usage_amount_cents,
-        "usage_tokens": usage_tokens,
-        "topup_cents": int(topup),
-        "refunds_cents": int(refunds),
-        "net_topup_cents": net_topup_cents,
-        "balance_delta_cents": balance_delta_cents,
-    }
-
-    if format == "csv":
-        if group_by == "total":
-            headers = [
-                "request_id",
-                "team_id",
-                "from",
-                "to",
-                "usage_amount_cents",
-                "usage_tokens",
-                "topup_cents",
-                "refunds_cents",
-                "net_topup_cents",
-                "balance_delta_cents",
-            ]
-            row = [str(data[k]) for k in headers]
-            csv_text = ",".join(headers) + "\n" + ",".join(row) + "\n"
-            return PlainTextResponse(content=csv_text, media_type="text/csv")
-        else:
-            if group_by == "model":
-                headers = ["request_id", "team_id", "from", "to", "model", "usage_amount_cents", "usage_tokens"]
-                lines = [headers]
-                for g in groups:
-                    lines.append([
-                        str(ctx.get("request_id")),
-                        str(team_id),
-                        date_from,
-                        date_to,
-                        g["model"],
-                        str(g["usage_amount_cents"]),
-                        str(g["usage_tokens"]),
-                    ])
-            elif group_by == "day":
-                headers = ["request_id", "team_id", "from", "to", "date", "usage_amount_cents", "usage_tokens"]
-                lines = [headers]
-                for g in groups:
-                    lines.append([
-                        str(ctx.get("request_id")),
-                        str(team_id),
-                        date_from,
-                        date_to,
-                        g["date"],
-                        str(g["usage_amount_cents"]),
-                        str(g["usage_tokens"]),
-                    ])
-            else:  # model_day
-                headers = ["request_id", "team_id", "from", "to", "date", "model", "usage_amount_cents", "usage_tokens"]
-                lines = [headers]
-                for g in groups:
-                    lines.append([
-                        str(ctx.get("request_id")),
-                        str(team_id),
-                        date_from,
-                        date_to,
-                        g["date"],
-                        g["model"],
-                        str(g["usage_amount_cents"]),
-                        str(g["usage_tokens"]),
-                    ])
-            csv_text = "\n".join([",".join(row) for row in lines]) + "\n"
-            return PlainTextResponse(content=csv_text, media_type="text/csv")
-
-    if group_by == "total":
-        return data
-    else:
-        data["groups"] = groups
-        data["group_by"] = group_by
-        return data
+    return _period_report("team_id", team_id, date_from=date_from, date_to=date_to, model=model, success=success, group_by=group_by, format=format, ctx=ctx)
 
 
 @router.get("/summary")
 def summary_report(user_id: int, days: int = 7, ctx: dict = Depends(request_context)):
     days = max(1, min(days, 90))
     today_utc = dt.datetime.utcnow()
-    results = []
+    end = utc8_day_start(today_utc, hhmm="00:00") + dt.timedelta(days=1)
+    start = end - dt.timedelta(days=days)
+    per_day: dict[dt.datetime, list[int]] = {}
     with _session() as s:
-        for i in range(days):
-            start = utc8_day_start(today_utc - dt.timedelta(days=i), hhmm="00:00")
-            end = start + dt.timedelta(days=1)
-            amount_cents, total_tokens = s.query(
-                func.coalesce(func.sum(Usage.computed_amount_cents), 0),
-                func.coalesce(func.sum(Usage.total_tokens), 0),
-            ).filter(Usage.user_id == user_id, Usage.created_at >= start, Usage.created_at < end).one()
-            results.append({
-                "date": (start + dt.timedelta(hours=8)).strftime("%Y-%m-%d"),
-                "amount_cents": int(amount_cents),
-                "total_tokens": int(total_tokens),
-            })
-    results.sort(key=lambda x: x["date"])  # ascending
+        for day, _m, a, t in usage_buckets(s, start=start, end=end, user_id=user_id):
+            acc = per_day.setdefault(day, [0, 0])
+            acc[0] += a
+            acc[1] += t
+    results = []
+    for i in range(days):
+        day = start + dt.timedelta(days=i)
+        a, t = per_day.get(day, (0, 0))
+        results.append({
+            "date": (day + dt.timedelta(hours=8)).strftime("%Y-%m-%d"),
+            "amount_cents": int(a),
+            "total_tokens": int(t),
+        })
     return {"request_id": ctx.get("request_id"), "user_id": user_id, "days": days, "daily": results}
 
 
@@ -420,109 +256,25 @@ def period_report(
     date_to: str = Query(..., description="YYYY-MM-DD (inclusive, UTC+8 window)"),
     model: Optional[str] = Query(None, description="filter by model"),
     success: Optional[bool] = Query(None, description="filter by success flag"),
-    group_by: str = Query("total", pattern=r"^(total|model|day|model_day)$"),
+    group_by: str = Query("total", pattern=r"^(total|model|day|model_day|hour|model_hour)$"),
     format: str = Query("json", pattern=r"^(json|csv)$"),
     ctx: dict = Depends(request_context),
 ):
-    # parse dates
-    try:
-        y1, m1, d1 = map(int, date_from.split("-"))
-        y2, m2, d2 = map(int, date_to.split("-"))
-        base_from = dt.datetime(y1, m1, d1)
-        base_to = dt.datetime(y2, m2, d2)
-    except Exception:
-        raise HTTPException(status_code=400, detail="invalid date format")
-    if base_to < base_from:
-        raise HTTPException(status_code=400, detail="date_to must be >= date_from")
-    start = utc8_day_start(base_from, hhmm="00:00")
-    end = utc8_day_start(base_to, hhmm="00:00") + dt.timedelta(days=1)
+    return _period_report("user_id", user_id, date_from=date_from, date_to=date_to, model=model, success=success, group_by=group_by, format=format, ctx=ctx)
 
+
+def _period_report(entity_key: str, entity_id: int, *, date_from: str, date_to: str, model: Optional[str], success: Optional[bool], group_by: str, format: str, ctx: dict):
+    """Shared body of /period (user) and /period_team (team)."""
+    start, end = _parse_range(date_from, date_to)
+    entity = {entity_key: entity_id}
+    pay_col = LagoPayment.user_id if entity_key == "user_id" else LagoPayment.team_id
+
+    granularity = "hour" if group_by in ("hour", "model_hour") else "day"
     with _session() as s:
-        if group_by == "total":
-            uq = s.query(
-                func.coalesce(func.sum(Usage.computed_amount_cents), 0),
-                func.coalesce(func.sum(Usage.total_tokens), 0),
-            ).filter(Usage.user_id == user_id, Usage.created_at >= start, Usage.created_at < end)
-            if model:
-                uq = uq.filter(Usage.model == model)
-            if success is not None:
-                uq = uq.filter(Usage.success == bool(success))
-            usage_amount_cents, usage_tokens = uq.one()
-        else:
-            # grouped detail (usage-only)
-            groups: list[dict] = []
-            def _sum_usage(filters) -> tuple[int, int]:
-                q = s.query(
-                    func.coalesce(func.sum(Usage.computed_amount_cents), 0),
-                    func.coalesce(func.sum(Usage.total_tokens), 0),
-                ).filter(*filters)
-                a, t = q.one()
-                return int(a or 0), int(t or 0)
-
-            # model candidates
-            models: list[str] = []
-            if group_by in ("model", "model_day"):
-                if model:
-                    models = [model]
-                else:
-                    mrows = (
-                        s.query(Usage.model)
-                        .filter(Usage.user_id == user_id, Usage.created_at >= start, Usage.created_at < end)
-                        .distinct()
-                        .all()
-                    )
-                    models = [r[0] for r in mrows]
-
-            if group_by == "model":
-                for m in models:
-                    filters = [Usage.user_id == user_id, Usage.created_at >= start, Usage.created_at < end, Usage.model == m]
-                    if success is not None:
-                        filters.append(Usage.success == bool(success))
-                    a, t = _sum_usage(filters)
-                    if a or t:
-                        groups.append({"model": m, "usage_amount_cents": a, "usage_tokens": t})
-            elif group_by == "day":
-                cur = start
-                while cur < end:
-                    day_end = cur + dt.timedelta(days=1)
-                    filters = [Usage.user_id == user_id, Usage.created_at >= cur, Usage.created_at < day_end]
-                    if model:
-                        filters.append(Usage.model == model)
-                    if success is not None:
-                        filters.append(Usage.success == bool(success))
-                    a, t = _sum_usage(filters)
-                    if a or t:
-                        groups.append({"date": (cur + dt.timedelta(hours=8)).strftime("%Y-%m-%d"), "usage_amount_cents": a, "usage_tokens": t})
-                    cur = day_end
-            elif group_by == "model_day":
-                cur = start
-                while cur < end:
-                    day_end = cur + dt.timedelta(days=1)
-                    for m in models:
-                        filters = [
-                            Usage.user_id == user_id,
-                            Usage.created_at >= cur,
-                            Usage.created_at < day_end,
-                            Usage.model == m,
-                        ]
-                        if success is not None:
-                            filters.append(Usage.success == bool(success))
-                        a, t = _sum_usage(filters)
-                        if a or t:
-                            groups.append({
-                                "date": (cur + dt.timedelta(hours=8)).strftime("%Y-%m-%d"),
-                                "model": m,
-                                "usage_amount_cents": a,
-                                "usage_tokens": t,
-                            })
-                    cur = day_end
-
-            # aggregate totals from groups
-            usage_amount_cents = sum(g.get("usage_amount_cents", 0) for g in groups)
-            usage_tokens = sum(g.get("usage_tokens", 0) for g in groups)
+        buckets = usage_buckets(s, start=start, end=end, model=model, success=success, granularity=granularity, **entity)
 
         topup = s.query(func.coalesce(func.sum(LagoPayment.amount_cents), 0)).filter(
-            LagoPayment.user_id == user_id,
+            pay_col == entity_id,
             LagoPayment.created_at >= start,
             LagoPayment.created_at < end,
             LagoPayment.event_type == "wallet_topup",
@@ -530,20 +282,43 @@ def period_report(
         ).scalar() or 0
 
         refunds = s.query(func.coalesce(func.sum(LagoPayment.amount_cents), 0)).filter(
-            LagoPayment.user_id == user_id,
+            pay_col == entity_id,
             LagoPayment.created_at >= start,
             LagoPayment.created_at < end,
             LagoPayment.event_type == "refund",
         ).scalar() or 0
 
+    # grouped detail (usage-only); groups with no amount and no tokens are omitted
+    groups: list[dict] = []
+    if group_by != "total":
+        agg: dict[tuple, list[int]] = {}
+        for bucket, m, a, t in buckets:
+            key = (bucket if group_by != "model" else None, m if group_by in ("model", "model_day", "model_hour") else None)
+            acc = agg.setdefault(key, [0, 0])
+            acc[0] += a
+            acc[1] += t
+        for (bucket, m), (a, t) in sorted(agg.items(), key=lambda kv: (kv[0][0] or start, kv[0][1] or "")):
+            if not (a or t):
+                continue
+            g: dict = {}
+            if bucket is not None and granularity == "hour":
+                g["hour"] = (bucket + dt.timedelta(hours=8)).strftime("%Y-%m-%d %H:00")
+            elif bucket is not None:
+                g["date"] = (bucket + dt.timedelta(hours=8)).strftime("%Y-%m-%d")
+            if m is not None:
+                g["model"] = m
+            g["usage_amount_cents"] = a
+            g["usage_tokens"] = t
+            groups.append(g)
+
     net_topup_cents = int(topup) - int(refunds)
-    usage_amount_cents = int(usage_amount_cents)
-    usage_tokens = int(usage_tokens)
+    usage_amount_cents = int(sum(b[2] for b in buckets))
+    usage_tokens = int(sum(b[3] for b in buckets))
     balance_delta_cents = net_topup_cents - usage_amount_cents
 
     data = {
         "request_id": ctx.get("request_id"),
-        "user_id": user_id,
+        entity_key: entity_id,
         "from": date_from,
         "to": date_to,
         "usage_amount_cents": usage_amount_cents,
@@ -558,7 +333,7 @@ def period_report(
         if group_by == "total":
             headers = [
                 "request_id",
-                "user_id",
+                entity_key,
                 "from",
                 "to",
                 "usage_amount_cents",
@@ -568,53 +343,16 @@ def period_report(
                 "net_topup_cents",
                 "balance_delta_cents",
             ]
-            row = [str(data[k]) for k in headers]
-            csv_text = ",".join(headers) + "\n" + ",".join(row) + "\n"
-            return PlainTextResponse(content=csv_text, media_type="text/csv")
+            return PlainTextResponse(content=_csv_text(headers, [[data[k] for k in headers]]), media_type="text/csv")
         else:
             # grouped detail (usage-only)
-            if group_by == "model":
-                headers = ["request_id", "user_id", "from", "to", "model", "usage_amount_cents", "usage_tokens"]
-                lines = [headers]
-                for g in groups:
-                    lines.append([
-                        str(ctx.get("request_id")),
-                        str(user_id),
-                        date_from,
-                        date_to,
-                        g["model"],
-                        str(g["usage_amount_cents"]),
-                        str(g["usage_tokens"]),
-                    ])
-            elif group_by == "day":
-                headers = ["request_id", "user_id", "from", "to", "date", "usage_amount_cents", "usage_tokens"]
-                lines = [headers]
-                for g in groups:
-                    lines.append([
-                        str(ctx.get("request_id")),
-                        str(user_id),
-                        date_from,
-                        date_to,
-                        g["date"],
-                        str(g["usage_amount_cents"]),
-                        str(g["usage_tokens"]),
-                    ])
-            else:  # model_day
-                headers = ["request_id", "user_id", "from", "to", "date", "model", "usage_amount_cents", "usage_tokens"]
-                lines = [headers]
-                for g in groups:
-                    lines.append([
-                        str(ctx.get("request_id")),
-                        str(user_id),
-                        date_from,
-                        date_to,
-                        g["date"],
-                        g["model"],
-                        str(g["usage_amount_cents"]),
-                        str(g["usage_tokens"]),
-                    ])
-            csv_text = "\n".join([",".join(row) for row in lines]) + "\n"
-            return PlainTextResponse(content=csv_text, media_type="text/csv")
+            group_cols = {"model": ["model"], "day": ["date"], "model_day": ["date", "model"], "hour": ["hour"], "model_hour": ["hour", "model"]}[group_by]
+            headers = ["request_id", entity_key, "from", "to", *group_cols, "usage_amount_cents", "usage_tokens"]
+            rows = [
+                [ctx.get("request_id"), entity_id, date_from, date_to, *[g[c] for c in group_cols], g["usage_amount_cents"], g["usage_tokens"]]
+                for g in groups
+            ]
+            return PlainTextResponse(content=_csv_text(headers, rows), media_type="text/csv")
 
     if group_by == "total":
         return data
@@ -622,3 +360,140 @@ def period_report(
         data["groups"] = groups
         data["group_by"] = group_by
         return data
+
+
+# ---- Row-level exports (admin) ----
+#
+# Streamed straight from the database: rows are fetched _EXPORT_CHUNK at a time
+# (server-side cursor where the driver supports it) and written out per chunk, so
+# memory stays flat regardless of the date range.
+
+def _export_value(v, fmt: str):
+    if isinstance(v, dt.datetime):
+        return v.isoformat()
+    if fmt == "csv":
+        if v is None:
+            return ""
+        if isinstance(v, bool):
+            return 1 if v else 0
+        if isinstance(v, (dict, list)):
+            return json.dumps(v, ensure_ascii=False)
+    return v
+
+
+def _export(name: str, columns: list, stmt, fmt: str) -> StreamingResponse:
+    headers = [c.key for c in columns]
+
+    def _chunks() -> Iterator[str]:
+        buf = io.StringIO()
+        w = csv.writer(buf, lineterminator="\n")
+        if fmt == "csv":
+            w.writerow(headers)
+        with _session() as s:
+            result = s.execute(stmt.execution_options(yield_per=_EXPORT_CHUNK))
+            for part in result.partitions():
+                for row in part:
+                    values = [_export_value(v, fmt) for v in row]
+                    if fmt == "csv":
+                        w.writerow(values)
+                    else:
+                        buf.write(json.dumps(dict(zip(headers, values)), ensure_ascii=False) + "\n")
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        if buf.getvalue():
+            yield buf.getvalue()
+
+    media_type = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        _chunks(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'},
+    )
+
+
+@router.get("/export/usage")
+def export_usage(
+    date_from: str = Query(..., description="YYYY-MM-DD (inclusive, UTC+8 window)"),
+    date_to: str = Query(..., description="YYYY-MM-DD (inclusive, UTC+8 window)"),
+    user_id: Optional[int] = None,
+    team_id: Optional[int] = None,
+    model: Optional[str] = Query(None, description="filter by model"),
+    success: Optional[bool] = Query(None, description="filter by success flag"),
+    format: str = Query("csv", pattern=r"^(csv|ndjson)$"),
+    ctx: dict = Depends(admin_auth),
+):
+    start, end = _parse_range(date_from, date_to)
+    columns = [
+        Usage.id, Usage.created_at, Usage.user_id, Usage.team_id, Usage.model, Usage.unit,
+        Usage.input_tokens, Usage.output_tokens, Usage.total_tokens, Usage.computed_amount_cents,
+        Usage.currency, Usage.success, Usage.request_id,
+    ]
+    stmt = select(*columns).where(Usage.created_at >= start, Usage.created_at < end)
+    if user_id is not None:
+        stmt = stmt.where(Usage.user_id == user_id)
+    if team_id is not None:
+        stmt = stmt.where(Usage.team_id == team_id)
+    if model:
+        stmt = stmt.where(Usage.model == model)
+    if success is not None:
+        stmt = stmt.where(Usage.success == bool(success))
+    return _export(f"usage_{date_from}_{date_to}", columns, stmt.order_by(Usage.id), format)
+
+
+@router.get("/export/ledger")
+def export_ledger(
+    date_from: str = Query(..., description="YYYY-MM-DD (inclusive, UTC+8 window)"),
+    date_to: str = Query(..., description="YYYY-MM-DD (inclusive, UTC+8 window)"),
+    user_id: Optional[int] = None,
+    currency: Optional[str] = None,
+    reason: Optional[str] = Query(None, description="recharge|spend|refund|..."),
+    format: str = Query("csv", pattern=r"^(csv|ndjson)$"),
+    ctx: dict = Depends(admin_auth),
+):
+    start, end = _parse_range(date_from, date_to)
+    columns = [
+        LedgerEntry.id, LedgerEntry.created_at, Wallet.user_id, LedgerEntry.wallet_id,
+        LedgerEntry.amount_cents, LedgerEntry.currency, LedgerEntry.reason, LedgerEntry.meta,
+    ]
+    stmt = (
+        select(*columns)
+        .join(Wallet, Wallet.id == LedgerEntry.wallet_id)
+        .where(LedgerEntry.created_at >= start, LedgerEntry.created_at < end)
+    )
+    if user_id is not None:
+        stmt = stmt.where(Wallet.user_id == user_id)
+    if currency:
+        stmt = stmt.where(LedgerEntry.currency == currency.upper())
+    if reason:
+        stmt = stmt.where(LedgerEntry.reason == reason)
+    return _export(f"ledger_{date_from}_{date_to}", columns, stmt.order_by(LedgerEntry.id), format)
+
+
+@router.get("/export/lago_payments")
+def export_lago_payments(
+    date_from: str = Query(..., description="YYYY-MM-DD (inclusive, UTC+8 window)"),
+    date_to: str = Query(..., description="YYYY-MM-DD (inclusive, UTC+8 window)"),
+    user_id: Optional[int] = None,
+    team_id: Optional[int] = None,
+    event_type: Optional[str] = Query(None, description="wallet_topup|refund|..."),
+    status: Optional[str] = None,
+    format: str = Query("csv", pattern=r"^(csv|ndjson)$"),
+    ctx: dict = Depends(admin_auth),
+):
+    start, end = _parse_range(date_from, date_to)
+    P = LagoPayment
+    columns = [
+        P.id, P.created_at, P.event_type, P.provider, P.provider_txn_id, P.order_id, P.amount_cents,
+        P.currency, P.status, P.user_id, P.team_id, P.request_id, P.meta,
+    ]
+    stmt = select(*columns).where(P.created_at >= start, P.created_at < end)
+    if user_id is not None:
+        stmt = stmt.where(P.user_id == user_id)
+    if team_id is not None:
+        stmt = stmt.where(P.team_id == team_id)
+    if event_type:
+        stmt = stmt.where(P.event_type == event_type)
+    if status:
+        stmt = stmt.where(P.status == status)
+    return _export(f"lago_payments_{date_from}_{date_to}", columns, stmt.order_by(P.id), format)
@@ -16,8 +16,7 @@ import asyncio
 
 from middleware.db import init_db
 from middleware.db_migrate import run_migrations
-from middleware.payments.service import create_checkout, process_webhook, refund_payment, get_payment_status
-from middleware.billing.service import process_stripe_invoice_webhook, process_stripe_subscription_webhook
+from middleware.payments.service import create_checkout, refund_payment, get_payment_status
 from middleware.config import settings
 from middleware.runtime_config import get as rc_get
 from .deps import dev_auth, request_context, admin_auth
@@ -33,8 +32,14 @@ from .auth import router as auth_router
 from .admin import router as admin_router
 from .users import router as users_router
 from .settings import router as settings_router
-from middleware.integrations.litellm_sync import sync_wallets_to_litellm
-from middleware.billing.service import process_outbox_once
+from middleware.integrations.litellm_sync import run_budget_events, sync_wallets_to_litellm
+from middleware import outbox
+from middleware.integrations.litellm_proxy import aclose_client as close_litellm_client
+from middleware.plans.spend import reconcile as reconcile_spend_counters
+from middleware import prepaid, runtime_config, usage_recorder, webhooks
+from middleware.ratelimit import get_limiter
+from middleware.usage_rollups import catch_up as rollup_usage
+from middleware.ledger_audit import reconcile as reconcile_ledger
 
 
 app = FastAPI(title="RabbitAIPanel Middleware API", version="0.1.0")
@@ -53,6 +58,9 @@ def on_startup() -> None:
         logger.error("db.migration_failed err=%s", e)
     # Setup logging baseline
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    # Config snapshot: reloaded in the background when settings change on any worker
+    runtime_config.reload()
+    runtime_config.start()
     # Periodic LiteLLM budget sync
     if rc_get("LITELLM_SYNC_ENABLED", bool, settings.LITELLM_SYNC_ENABLED):
         interval = max(60, int(rc_get("LITELLM_SYNC_INTERVAL_SEC", int, settings.LITELLM_SYNC_INTERVAL_SEC)))
@@ -61,29 +69,125 @@ def on_startup() -> None:
         async def _runner():
             await asyncio.sleep(2)
             try:
-                await asyncio.to_thread(sync_wallets_to_litellm, currency)
-            except Exception:
-                pass
+                await sync_wallets_to_litellm(currency)
+            except Exception as e:
+                logger.error("litellm.sync.failed err=%s", e)
             while True:
                 await asyncio.sleep(interval)
                 try:
-                    await asyncio.to_thread(sync_wallets_to_litellm, currency)
-                except Exception:
-                    pass
+                    await sync_wallets_to_litellm(currency)
+                except Exception as e:
+                    logger.error("litellm.sync.failed err=%s", e)
 
         asyncio.create_task(_runner())
+    # Event-driven budget push: wallet changes reach LiteLLM within the coalescing window
+    if rc_get("LITELLM_BUDGET_LINKAGE", bool, settings.LITELLM_BUDGET_LINKAGE):
+        asyncio.create_task(run_budget_events(rc_get("LITELLM_SYNC_CURRENCY", str, settings.LITELLM_SYNC_CURRENCY)))
     
-    # Outbox retry worker (security/resilience)
+    # Outbox dispatcher (security/resilience): rows are leased, so every worker can run it
     async def _outbox_worker():
         await asyncio.sleep(1)
         while True:
+            sent = 0
+            try:
+                sent = await asyncio.to_thread(outbox.dispatch_once)
+            except Exception as e:
+                logger.error("outbox.dispatch_failed err=%s", e)
+            # keep draining while there is a backlog
+            await asyncio.sleep(0 if sent else 10)
+
+    asyncio.create_task(_outbox_worker())
+
+    # Outbox retention: archive old sent rows in chunks
+    async def _outbox_retention():
+        while True:
+            await asyncio.sleep(3600)
+            try:
+                await asyncio.to_thread(outbox.archive_sent)
+            except Exception as e:
+                logger.error("outbox.archive_failed err=%s", e)
+
+    asyncio.create_task(_outbox_retention())
+
+    # Daily spend counters: fold in usage written by other workers
+    async def _spend_reconciler():
+        while True:
+            interval = int(rc_get("SPEND_COUNTER_RECONCILE_SEC", int, settings.SPEND_COUNTER_RECONCILE_SEC))
+            await asyncio.sleep(max(5, interval) if interval > 0 else 60)
+            if interval <= 0:
+                continue
             try:
-                await asyncio.to_thread(process_outbox_once, 20)
+                await asyncio.to_thread(reconcile_spend_counters)
             except Exception:
                 pass
-            await asyncio.sleep(10)
 
-    asyncio.create_task(_outbox_worker())
+    asyncio.create_task(_spend_reconciler())
+
+    # Write-behind usage rows: batch inserts off the chat response path
+    usage_recorder.start()
+    # Prepaid metering: batched wallet/ledger writes for in-memory balances
+    prepaid.start()
+    # Webhook worker: applies events stored and acknowledged by /v1/webhooks/stripe
+    webhooks.start()
+
+    # Usage rollups for reports: fold new usage rows into hourly/daily buckets
+    async def _rollup_worker():
+        await asyncio.sleep(3)
+        while True:
+            if rc_get("USAGE_ROLLUPS_ENABLED", bool, settings.USAGE_ROLLUPS_ENABLED):
+                try:
+                    await asyncio.to_thread(rollup_usage)
+                except Exception as e:
+                    logger.error("usage_rollups.failed err=%s", e)
+            await asyncio.sleep(max(5, int(rc_get("USAGE_ROLLUP_INTERVAL_SEC", int, settings.USAGE_ROLLUP_INTERVAL_SEC))))
+
+    asyncio.create_task(_rollup_worker())
+
+    # Wallet balances vs ledger: replay entries after the last checkpoint
+    async def _ledger_reconciler():
+        while True:
+            interval = int(rc_get("LEDGER_RECONCILE_INTERVAL_SEC", int, settings.LEDGER_RECONCILE_INTERVAL_SEC))
+            await asyncio.sleep(max(60, interval) if interval > 0 else 60)
+            if interval <= 0:
+                continue
+            try:
+                await asyncio.to_thread(reconcile_ledger)
+            except Exception as e:
+                logger.error("ledger.reconcile_failed err=%s", e)
+
+    asyncio.create_task(_ledger_reconciler())
+
+
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+    # Release pooled upstream connections held by the chat proxy
+    try:
+        await close_litellm_client()
+    except Exception:
+        pass
+    try:
+        await asyncio.to_thread(outbox.close)
+    except Exception:
+        pass
+    # Flush buffered usage rows before the process exits
+    try:
+        await asyncio.to_thread(usage_recorder.stop)
+    except Exception as e:
+        logger.error("usage_recorder.stop_failed err=%s", e)
+    try:
+        await asyncio.to_thread(runtime_config.stop)
+    except Exception as e:
+        logger.error("runtime_config.stop_failed err=%s", e)
+    try:
+        await asyncio.to_thread(webhooks.stop)
+    except Exception as e:
+        logger.error("webhooks.stop_failed err=%s", e)
+    # Write settled prepaid spend to the wallets
+    try:
+        await asyncio.to_thread(prepaid.stop)
+    except Exception as e:
+        logger.error("prepaid.stop_failed err=%s", e)
+
 
 # CORS (dev)
 origins = [o.strip() for o in (os.getenv("DEV_CORS_ORIGINS", "*").split(","))]
@@ -97,9 +201,6 @@ app.add_middleware(
 
 
 # Basic request logging and rate limiting (demo)
-_rate_buckets: dict[str, list[float]] = {}
-
-
 @app.middleware("http")
 async def _logging_and_ratelimit(request: Request, call_next):
     t0 = time.time()
@@ -116,27 +217,29 @@ async def _logging_and_ratelimit(request: Request, call_next):
             ident = request.headers.get("x-api-key") or (request.client.host if request.client else "unknown") or "unknown"
             window = max(1, int(rc_get("RATE_LIMIT_WINDOW_SEC", int, settings.RATE_LIMIT_WINDOW_SEC)))
             limit = max(1, int(rc_get("RATE_LIMIT_MAX_REQUESTS", int, settings.RATE_LIMIT_MAX_REQUESTS)))
-            now = time.time()
-            bucket = _rate_buckets.get(ident) or []
-            # drop outdated timestamps
-            bucket = [ts for ts in bucket if ts > now - window]
-            if len(bucket) >= limit:
-                # simple Retry-After based on earliest timestamp in window
-                retry_after = int(max(1, window - (now - bucket[0])))
+            try:
+                limiter = get_limiter()
+                if limiter.blocking:
+                    d = await asyncio.to_thread(limiter.hit, ident, limit, window, time.time())
+                else:
+                    d = limiter.hit(ident, limit, window, time.time())
+            except Exception as e:
+                # a shared backend being down must not take the API with it
+                logger.error("ratelimit.backend_failed err=%s", e)
+                d = None
+            if d is not None and not d.allowed:
                 return Response(
                     status_code=429,
                     content="rate limit exceeded",
                     headers={
                         "x-request-id": rid,
-                        "Retry-After": str(retry_after),
-                        "X-RateLimit-Limit": str(limit),
+                        "Retry-After": str(d.retry_after),
+                        "X-RateLimit-Limit": str(d.limit),
                         "X-RateLimit-Remaining": "0",
-                        "X-RateLimit-Reset": str(int(now + retry_after)),
+                        "X-RateLimit-Reset": str(int(time.time() + d.retry_after)),
                     },
                     media_type="text/plain",
                 )
-            bucket.append(now)
-            _rate_buckets[ident] = bucket
 
     try:
         response = await call_next(request)
@@ -217,69 +320,21 @@ async def stripe_webhook(request: Request, response: Response):
     # request id propagation for webhooks
     request_id = headers.get("x-request-id") or str(uuid.uuid4())
     response.headers["x-request-id"] = request_id
-    # Route invoice.* events to billing handler; others go to payment handler
-    is_invoice_event = False
-    is_subscription_event = False
+    # verify + store, then acknowledge; the webhook worker applies the event
     try:
-        parsed = json.loads(body.decode("utf-8")) if body else {}
-        evt_type = (parsed or {}).get("type")
-        is_invoice_event = isinstance(evt_type, str) and evt_type.startswith("invoice.")
-        is_subscription_event = isinstance(evt_type, str) and evt_type.startswith("customer.subscription.")
-    except Exception:
-        is_invoice_event = False
-        is_subscription_event = False
-
-    if is_subscription_event:
-        try:
-            result = process_stripe_subscription_webhook(headers=headers, body=body, request_id=request_id)
-            logger.info(
-                "webhook.handled request_id=%s provider=stripe event_type=%s stripe_subscription_id=%s",
-                request_id,
-                result.get("event_type"),
-                result.get("stripe_subscription_id"),
-            )
-            return {
-                "ok": True,
-                "request_id": request_id,
-                "event_type": result.get("event_type"),
-                "stripe_subscription_id": result.get("stripe_subscription_id"),
-                "status": result.get("status"),
-            }
-        except Exception as e:
-            logger.warning("webhook.error request_id=%s provider=stripe err=%s", request_id, e)
-            raise HTTPException(status_code=400, detail=str(e))
-    elif is_invoice_event:
-        try:
-            result = process_stripe_invoice_webhook(headers=headers, body=body, request_id=request_id)
-            logger.info(
-                "webhook.handled request_id=%s provider=stripe event_type=%s stripe_invoice_id=%s",
-                request_id,
-                result.get("event_type"),
-                result.get("stripe_invoice_id"),
-            )
-            return {
-                "ok": True,
-                "request_id": request_id,
-                "event_type": result.get("event_type"),
-                "stripe_invoice_id": result.get("stripe_invoice_id"),
-                "status": result.get("status"),
-            }
-        except Exception as e:
-            logger.warning("webhook.error request_id=%s provider=stripe err=%s", request_id, e)
-            raise HTTPException(status_code=400, detail=str(e))
-    else:
-        try:
-            event = process_webhook(provider_name="stripe", headers=headers, body=body, request_id=request_id)
-        except Exception as e:
-            logger.warning("webhook.error request_id=%s provider=stripe err=%s", request_id, e)
-            raise HTTPException(status_code=400, detail=str(e))
-        logger.info(
-            "webhook.handled request_id=%s provider=stripe event_type=%s order_id=%s",
-            request_id,
-            event.event_type,
-            event.order_id,
-        )
-        return {"ok": True, "request_id": request_id, "event_type": event.event_type, "order_id": event.order_id}
+        res = await asyncio.to_thread(webhooks.accept_stripe, headers, body, request_id)
+    except Exception as e:
+        logger.warning("webhook.error request_id=%s provider=stripe err=%s", request_id, e)
+        raise HTTPException(status_code=400, detail=str(e))
+    logger.info(
+        "webhook.accepted request_id=%s provider=stripe event_type=%s event_id=%s duplicate=%s queued=%s",
+        request_id,
+        res["event_type"],
+        res["event_id"],
+        res["duplicate"],
+        res["queued"],
+    )
+    return {"ok": True, "request_id": request_id, **res}
 
 
 class RefundBody(BaseModel):
@@ -7,7 +7,8 @@ from typing import Any
 from .deps import admin_auth
 from middleware.db import SessionLocal
 from middleware.config import settings
-from middleware.runtime_config import is_sensitive, clear_cache, get as rc_get
+from middleware import cache_versions
+from middleware.runtime_config import SETTINGS_CACHE, is_sensitive, clear_cache, get as rc_get
 from middleware.settings_meta import KEYS as SETTINGS_KEYS
 import re
 from sqlalchemy import text
@@ -133,12 +134,14 @@ def update_settings(body: UpdateSettingsBody, ctx: dict = Depends(admin_auth)):
                 else:
                     v_str = str(v)
                 s.execute(text("INSERT OR REPLACE INTO settings(key, value) VALUES(:k, :v)"), {"k": k, "v": v_str})
+            # other workers reload their config snapshot when this stamp moves
+            cache_versions.bump(SETTINGS_CACHE, session=s)
             s.commit()
         except Exception as e:
             s.rollback()
             raise HTTPException(status_code=400, detail=str(e))
 
-    # Clear runtime config cache so changes take effect immediately
+    # Reload this worker's config snapshot right away
     try:
         clear_cache()
     except Exception:
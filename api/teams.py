@@ -15,12 +15,18 @@ def api_list_teams(
     organization_id: int | None = Query(None),
     limit: int = Query(50, ge=1, le=200),
     offset: int = Query(0, ge=0),
+    cursor: str | None = Query(None, description="next_cursor of the previous page; takes precedence over offset"),
+    include_total: bool = Query(True, description="false skips the (cached) total count"),
     ctx: dict = Depends(dev_auth),
 ):
-    rows, total = list_teams(q=q, organization_id=organization_id, limit=limit, offset=offset)
+    try:
+        rows, total, next_cursor = list_teams(q=q, organization_id=organization_id, limit=limit, offset=offset, cursor=cursor, with_total=include_total)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {
         "request_id": ctx.get("request_id"),
         "total": total,
+        "next_cursor": next_cursor,
         "teams": [
             {
                 "id": t.id,
@@ -8,6 +8,7 @@ from sqlalchemy.orm import Session
 
 from middleware.db import SessionLocal
 from middleware.models import Wallet, LedgerEntry
+from middleware.pagination import keyset_page
 from .deps import dev_auth
 
 
@@ -38,19 +39,23 @@ def get_wallets(user_id: int, ctx: dict = Depends(dev_auth), db: Session = Depen
 
 
 @router.get("/{user_id}/ledger")
-def get_ledger(user_id: int, limit: int = Query(20, gt=0, le=200), ctx: dict = Depends(dev_auth), db: Session = Depends(get_db)):
-    rows = (
-        db.query(LedgerEntry)
-        .join(Wallet, Wallet.id == LedgerEntry.wallet_id)
-        .filter(Wallet.user_id == user_id)
-        .order_by(LedgerEntry.id.desc())
-        .limit(limit)
-        .all()
-    )
+def get_ledger(
+    user_id: int,
+    limit: int = Query(20, gt=0, le=200),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    ctx: dict = Depends(dev_auth),
+    db: Session = Depends(get_db),
+):
+    query = db.query(LedgerEntry).join(Wallet, Wallet.id == LedgerEntry.wallet_id).filter(Wallet.user_id == user_id)
+    try:
+        rows, next_cursor = keyset_page(query, LedgerEntry.id, limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     logger.info("wallet.ledger request_id=%s user_id=%s limit=%s returned=%s", ctx.get("request_id"), user_id, limit, len(rows))
     return {
         "request_id": ctx.get("request_id"),
         "user_id": user_id,
+        "next_cursor": next_cursor,
         "entries": [
             {
                 "amount_cents": r.amount_cents,
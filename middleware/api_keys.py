@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import datetime as dt
+import hashlib
+import logging
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+from sqlalchemy import func
+
+from . import cache_versions
+from .config import settings
+from .db import SessionLocal
+from .models import ApiKey, Usage, User
+from .quotas import Limits, limits_for_key
+from .runtime_config import get as rc_get
+
+logger = logging.getLogger(__name__)
+
+
+# API keys for /v1/proxy.
+#
+# Only sha256(key) is stored (api_keys.key_hash); the key itself is shown once, at
+# creation. A presented key is hashed and resolved to a KeyContext (user, team,
+# model allowlist, budget, per-minute limits, linked LiteLLM key), which is kept in an LRU of
+# API_KEY_CACHE_SIZE entries for API_KEY_CACHE_TTL_SEC, so a warm key costs no
+# query. Unknown keys are cached too (as None, for a shorter time) so a stream of
+# bad keys cannot hammer the table. Revoking or editing a key bumps the
+# "api_keys" stamp in cache_versions: this worker drops its cache at once, the
+# others within a poll interval. Nothing derived from the user's plan is cached
+# here (plan edits bump a different stamp); the proxy reads it per request.
+#
+# Every key is linked to the caller's own LiteLLM virtual key, which is stored
+# server-side (never returned) together with its hash. The proxy forwards that key
+# for API-key callers, so clients hold only the platform key while LiteLLM still
+# applies the user's own budget and spend attribution; the master key is never
+# substituted.
+#
+# max_budget_cents caps the USD usage charged to a key per budget_duration window
+# (30s/15m/24h/30d/1w/1mo, anchored at the key's creation; no duration: for its
+# lifetime). Spend is kept in a running counter per key: usage recorded by this
+# process bumps it at once, and it is re-read from the usage table (plus rows
+# still buffered) every _SPEND_RECHECK_SEC to pick up other workers.
+
+API_KEYS_CACHE = "api_keys"
+
+_NEGATIVE_TTL_SEC = 30
+_KEY_PREFIX = "sk-rb-"
+_SPEND_RECHECK_SEC = 5.0
+_DURATION_RE = re.compile(r"^\s*(\d+)\s*(s|m|h|d|w|mo)\s*$")
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400, "mo": 30 * 86400}
+
+
+@dataclass(frozen=True)
+class KeyContext:
+    key_id: int
+    user_id: int
+    team_id: Optional[int]
+    model_allowlist: frozenset[str]  # empty: every model
+    max_budget_cents: Optional[int]
+    budget_duration: Optional[str]
+    limits: Limits
+    created_at: dt.datetime
+    litellm_api_key: Optional[str] = field(default=None, repr=False)  # None: not linked, cannot call the proxy
+
+    def allows_model(self, model: str) -> bool:
+        return not self.model_allowlist or model in self.model_allowlist
+
+    def budget_window_start(self, now: Optional[dt.datetime] = None) -> dt.datetime:
+        """Start of the current budget window (the key's creation without a duration)."""
+        period = parse_duration(self.budget_duration)
+        if period is None:
+            return self.created_at
+        now = now or dt.datetime.utcnow()
+        elapsed = max(0.0, (now - self.created_at).total_seconds())
+        return self.created_at + dt.timedelta(seconds=(elapsed // period) * period)
+
+
+@dataclass
+class _Spend:
+    start: dt.datetime
+    cents: int
+    checked: float  # monotonic time of the last DB read
+
+
+_lock = threading.Lock()
+_cache: OrderedDict[tuple[str, str], tuple[float, Optional[KeyContext]]] = OrderedDict()
+_cache_stamp: Optional[cache_versions.Stamp] = None
+_spend_lock = threading.Lock()
+_spend: dict[int, _Spend] = {}
+
+
+def hash_key(raw: str) -> str:
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def parse_duration(value: Optional[str]) -> Optional[int]:
+    """Seconds in a budget_duration such as 30d or 24h; None when unset or unparseable."""
+    m = _DURATION_RE.match(value or "")
+    if not m or int(m.group(1)) <= 0:
+        return None
+    return int(m.group(1)) * _DURATION_UNITS[m.group(2)]
+
+
+def _context(s, k: ApiKey) -> KeyContext:
+    team_id = s.query(User.team_id).filter(User.id == k.user_id).scalar()
+    allow = frozenset(m.strip() for m in (k.model_allowlist or "").split(",") if m.strip())
+    return KeyContext(
+        key_id=int(k.id),
+        user_id=int(k.user_id),
+        team_id=int(team_id) if team_id is not None else None,
+        model_allowlist=allow,
+        max_budget_cents=k.max_budget_cents,
+        budget_duration=k.budget_duration,
+        limits=limits_for_key(k),
+        created_at=k.created_at,
+        litellm_api_key=k.litellm_api_key,
+    )
+
+
+def _lookup(column: str, digest: str) -> Optional[KeyContext]:
+    """Context of the active key whose `column` equals digest, via the LRU."""
+    global _cache_stamp
+    key = (column, digest)
+    now = time.monotonic()
+    stamp = cache_versions.stamp(API_KEYS_CACHE)
+    with _lock:
+        if _cache_stamp != stamp:
+            _cache.clear()
+            _cache_stamp = stamp
+        hit = _cache.get(key)
+        if hit is not None and hit[0] > now:
+            _cache.move_to_end(key)
+            return hit[1]
+    with SessionLocal() as s:
+        k = s.query(ApiKey).filter(getattr(ApiKey, column) == digest, ApiKey.active == True).first()  # noqa: E712
+        kctx = _context(s, k) if k is not None else None
+    ttl = int(rc_get("API_KEY_CACHE_TTL_SEC", int, settings.API_KEY_CACHE_TTL_SEC)) if kctx is not None else _NEGATIVE_TTL_SEC
+    size = max(1, int(rc_get("API_KEY_CACHE_SIZE", int, settings.API_KEY_CACHE_SIZE)))
+    with _lock:
+        # loaded under an older stamp: the key may have been revoked meanwhile
+        if _cache_stamp == stamp:
+            _cache[key] = (now + max(1, ttl), kctx)
+            _cache.move_to_end(key)
+            while len(_cache) > size:
+                _cache.popitem(last=False)
+    return kctx
+
+
+def authenticate(raw_key: str) -> Optional[KeyContext]:
+    """KeyContext for a presented API key, or None if it is unknown or revoked."""
+    return _lookup("key_hash", hash_key(raw_key))
+
+
+def context_for_litellm_key(litellm_api_key: str) -> Optional[KeyContext]:
+    """KeyContext of the ApiKey linked to a LiteLLM virtual key (by litellm_key_hash)."""
+    return _lookup("litellm_key_hash", hash_key(litellm_api_key))
+
+
+def create_key(
+    user_id: int,
+    *,
+    litellm_api_key: str,
+    model_allowlist: Optional[list[str]] = None,
+    max_budget_cents: Optional[int] = None,
+    budget_duration: Optional[str] = None,
+    rpm_limit: Optional[int] = None,
+    tpm_limit: Optional[int] = None,
+    cost_per_minute_cents: Optional[int] = None,
+) -> tuple[str, ApiKey]:
+    """Create a key for user_id, linked to the user's LiteLLM virtual key.
+
+    Returns (raw key, row); the raw API key is not stored.
+    """
+    if not (litellm_api_key or "").strip():
+        raise ValueError("litellm_api_key is required")
+    raw = _KEY_PREFIX + secrets.token_urlsafe(32)
+    with SessionLocal() as s:
+        s.query(User.id).filter_by(id=user_id).one()
+        k = ApiKey(
+            user_id=user_id,
+            key_hash=hash_key(raw),
+            key_last4=raw[-4:],
+            litellm_key_hash=hash_key(litellm_api_key.strip()),
+            litellm_api_key=litellm_api_key.strip(),
+            model_allowlist=",".join(m.strip() for m in model_allowlist if m.strip()) if model_allowlist else None,
+            max_budget_cents=max_budget_cents,
+            budget_duration=budget_duration,
+            rpm_limit=rpm_limit,
+            tpm_limit=tpm_limit,
+            cost_per_minute_cents=cost_per_minute_cents,
+            active=True,
+        )
+        s.add(k)
+        # a cached negative lookup of this hash must not outlive the insert
+        cache_versions.bump(API_KEYS_CACHE, session=s)
+        s.commit()
+        s.refresh(k)
+        s.expunge(k)
+    logger.info("api_key.created key_id=%s user_id=%s last4=%s", k.id, user_id, k.key_last4)
+    return raw, k
+
+
+def revoke(key_id: int) -> bool:
+    """Deactivate a key; every worker stops accepting it within a poll interval. False if not found."""
+    with SessionLocal() as s:
+        k = s.get(ApiKey, key_id)
+        if k is None:
+            return False
+        k.active = False
+        cache_versions.bump(API_KEYS_CACHE, session=s)
+        s.commit()
+    logger.info("api_key.revoked key_id=%s", key_id)
+    return True
+
+
+def clear_cache() -> None:
+    with _lock:
+        _cache.clear()
+    with _spend_lock:
+        _spend.clear()
+
+
+def spent_cents(kctx: KeyContext) -> int:
+    """USD usage charged to the key in its current budget window."""
+    start = kctx.budget_window_start()
+    now = time.monotonic()
+    with _spend_lock:
+        sp = _spend.get(kctx.key_id)
+        if sp is not None and sp.start == start and now - sp.checked < _SPEND_RECHECK_SEC:
+            return sp.cents
+    from . import usage_recorder
+
+    # batch writes are held off so the table and the buffer are read at one point;
+    # bumps of rows queued after the buffer was read land on the new counter
+    with usage_recorder.hold_flush():
+        with SessionLocal() as s:
+            total = int(
+                s.query(func.coalesce(func.sum(Usage.computed_amount_cents), 0))
+                .filter(Usage.api_key_id == kctx.key_id, Usage.created_at >= start, Usage.currency == "USD")
+                .scalar()
+                or 0
+            )
+        with usage_recorder.buffer_lock():
+            total += usage_recorder.pending_key_cents(kctx.key_id, start)
+            with _spend_lock:
+                _spend[kctx.key_id] = _Spend(start=start, cents=total, checked=now)
+    return total
+
+
+def over_budget(kctx: KeyContext) -> bool:
+    return kctx.max_budget_cents is not None and spent_cents(kctx) >= kctx.max_budget_cents
+
+
+def bump_spend(key_id: Optional[int], amount_cents: int, *, currency: str = "USD", at: Optional[dt.datetime] = None) -> None:
+    """Account a Usage row charged to key_id (called by usage_recorder as it queues or writes it)."""
+    if not key_id or not amount_cents or (currency or "").upper() != "USD":
+        return
+    at = at or dt.datetime.utcnow()
+    with _spend_lock:
+        sp = _spend.get(key_id)
+        if sp is not None and at >= sp.start:
+            sp.cents += int(amount_cents)
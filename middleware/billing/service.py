@@ -11,6 +11,7 @@ from sqlalchemy import func
 from ..db import SessionLocal
 from ..models import Customer, Subscription, Invoice, InvoiceItem, Usage, EventOutbox, ProviderEvent, StripePriceMapping, Plan
 from ..plans.service import utc8_day_start
+from ..pagination import cached_total, keyset_page
 from ..config import settings
 from ..runtime_config import get as rc_get
 
@@ -43,20 +44,15 @@ def create_customer(*, entity_type: str, entity_id: int, name: Optional[str] = N
         return c
 
 
-def list_customers(*, q: Optional[str] = None, entity_type: Optional[str] = None, entity_id: Optional[int] = None, limit: int = 50, offset: int = 0) -> tuple[list[Customer], int]:
-    with _session() as s:
-        q = s.query(Customer)
-        if entity_type in ("user", "team"):
-            q = q.filter(Customer.entity_type == entity_type)
-        if entity_id is not None:
-            q = q.filter(Customer.entity_id == entity_id)
-        if isinstance(globals().get('q'), str) and globals().get('q'):
-            pass
-        total = q.count()
-        rows = q.order_by(Customer.id.desc()).offset(offset).limit(limit).all()
-        return list(rows), int(total)
-
-def list_customers(q: Optional[str] = None, entity_type: Optional[str] = None, entity_id: Optional[int] = None, limit: int = 50, offset: int = 0) -> tuple[list[Customer], int]:
+def list_customers(
+    q: Optional[str] = None,
+    entity_type: Optional[str] = None,
+    entity_id: Optional[int] = None,
+    limit: int = 50,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    with_total: bool = True,
+) -> tuple[list[Customer], Optional[int], Optional[str]]:
     with _session() as s:
         query = s.query(Customer)
         if entity_type in ("user", "team"):
@@ -66,9 +62,9 @@ def list_customers(q: Optional[str] = None, entity_type: Optional[str] = None, e
         if q:
             pattern = f"%{q}%"
             query = query.filter((Customer.name.ilike(pattern)) | (Customer.email.ilike(pattern)))
-        total = query.count()
-        rows = query.order_by(Customer.id.desc()).offset(offset).limit(limit).all()
-        return list(rows), int(total)
+        total = cached_total(query, key=("customers", q, entity_type, entity_id)) if with_total else None
+        rows, next_cursor = keyset_page(query, Customer.id, limit=limit, offset=offset, cursor=cursor)
+        return rows, total, next_cursor
 
 def update_customer(customer_id: int, *, name: Optional[str] = None, email: Optional[str] = None, stripe_customer_id: Optional[str] = None) -> Customer:
     with session_scope() as s:
@@ -221,11 +217,12 @@ def push_invoice_to_stripe(invoice_id: int) -> str:
         return si.id
 
 
-def process_stripe_invoice_webhook(headers: dict, body: bytes, request_id: str | None = None) -> dict:
+def process_stripe_invoice_webhook(headers: dict, body: bytes, request_id: str | None = None, *, event: dict | None = None) -> dict:
     """Process Stripe Billing invoice.* webhooks and update local Invoice status.
 
     - Verifies signature when STRIPE_WEBHOOK_SECRET is configured
     - Idempotency via ProviderEvent(provider='stripe', event_id)
+    - event: already verified and recorded by the webhook intake; skips both of the above
     - Maps Stripe invoice events/status to local Invoice.status: draft|finalized|paid|failed
     Returns a compact dict describing the handled event.
     """
@@ -236,7 +233,12 @@ def process_stripe_invoice_webhook(headers: dict, body: bytes, request_id: str |
 
     # Verify and parse event
     webhook_secret = rc_get("STRIPE_WEBHOOK_SECRET", str, settings.STRIPE_WEBHOOK_SECRET)
-    if webhook_secret:
+    if event is not None:
+        data = event
+        obj = data.get("data", {}).get("object", {})
+        event_type = data.get("type")
+        event_id = data.get("id")
+    elif webhook_secret:
         sig = headers.get("stripe-signature") or headers.get("Stripe-Signature")
         if not sig:
             raise RuntimeError("Missing Stripe-Signature header")
@@ -282,7 +284,7 @@ def process_stripe_invoice_webhook(headers: dict, body: bytes, request_id: str |
 
     with SessionLocal() as s:
         # Idempotency guard
-        if event_id:
+        if event_id and event is None:
             pe = ProviderEvent(provider="stripe", event_id=event_id, raw=data if isinstance(data, dict) else None)
             s.add(pe)
             try:
@@ -415,15 +417,23 @@ def list_invoices(*, customer_id: Optional[int] = None, status: Optional[str] =
         return list(rows), int(total)
 
 
-def list_invoices_with_customer(*, customer_id: Optional[int] = None, status: Optional[str] = None, limit: int = 50, offset: int = 0) -> tuple[list[dict], int]:
+def list_invoices_with_customer(
+    *,
+    customer_id: Optional[int] = None,
+    status: Optional[str] = None,
+    limit: int = 50,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    with_total: bool = True,
+) -> tuple[list[dict], Optional[int], Optional[str]]:
     with SessionLocal() as s:
         q = s.query(Invoice, Customer).join(Customer, Invoice.customer_id == Customer.id)
         if customer_id is not None:
             q = q.filter(Invoice.customer_id == customer_id)
         if status in ("draft", "finalized", "paid", "failed"):
             q = q.filter(Invoice.status == status)
-        total = q.count()
-        rows = q.order_by(Invoice.id.desc()).offset(offset).limit(limit).all()
+        total = cached_total(q, key=("invoices", customer_id, status)) if with_total else None
+        rows, next_cursor = keyset_page(q, Invoice.id, limit=limit, offset=offset, cursor=cursor, key=lambda r: r[0].id)
         items: list[dict] = []
         for inv, cust in rows:
             items.append({
@@ -439,7 +449,7 @@ def list_invoices_with_customer(*, customer_id: Optional[int] = None, status: Op
                 "customer_name": cust.name,
                 "customer_email": cust.email,
             })
-        return items, int(total)
+        return items, total, next_cursor
 
 
 def get_subscription(subscription_id: int) -> Subscription:
@@ -473,7 +483,16 @@ def list_subscriptions(
         rows = q.order_by(Subscription.id.desc()).offset(offset).limit(limit).all()
         return list(rows), int(total)
 
-def list_subscriptions_with_join(*, customer_id: Optional[int] = None, plan_id: Optional[int] = None, status: Optional[str] = None, limit: int = 50, offset: int = 0) -> tuple[list[dict], int]:
+def list_subscriptions_with_join(
+    *,
+    customer_id: Optional[int] = None,
+    plan_id: Optional[int] = None,
+    status: Optional[str] = None,
+    limit: int = 50,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    with_total: bool = True,
+) -> tuple[list[dict], Optional[int], Optional[str]]:
     with SessionLocal() as s:
         q = s.query(Subscription, Customer, Plan).join(Customer, Subscription.customer_id == Customer.id).join(Plan, Subscription.plan_id == Plan.id)
         if customer_id is not None:
@@ -482,8 +501,8 @@ def list_subscriptions_with_join(*, customer_id: Optional[int] = None, plan_id:
             q = q.filter(Subscription.plan_id == plan_id)
         if status in ("active", "canceled", "paused"):
             q = q.filter(Subscription.status == status)
-        total = q.count()
-        rows = q.order_by(Subscription.id.desc()).offset(offset).limit(limit).all()
+        total = cached_total(q, key=("subscriptions", customer_id, plan_id, status)) if with_total else None
+        rows, next_cursor = keyset_page(q, Subscription.id, limit=limit, offset=offset, cursor=cursor, key=lambda r: r[0].id)
         items: list[dict] = []
         for sub, cust, plan in rows:
             items.append({
@@ -497,7 +516,7 @@ def list_subscriptions_with_join(*, customer_id: Optional[int] = None, plan_id:
                 "customer_email": cust.email,
                 "plan_name": plan.name,
             })
-        return items, int(total)
+        return items, total, next_cursor
 
 
 def update_subscription_status(subscription_id: int, *, status: str) -> Subscription:
@@ -512,11 +531,12 @@ def update_subscription_status(subscription_id: int, *, status: str) -> Subscrip
         return sub
 
 
-def process_stripe_subscription_webhook(headers: dict, body: bytes, request_id: str | None = None) -> dict:
+def process_stripe_subscription_webhook(headers: dict, body: bytes, request_id: str | None = None, *, event: dict | None = None) -> dict:
     """处理 Stripe `customer.subscription.*` 事件并同步本地 Subscription.status。
 
     - 验签（若配置了 `STRIPE_WEBHOOK_SECRET`）
     - 通过 ProviderEvent 进行幂等保护
+    - event：已由 webhook intake 验签并写入 provider_events 时传入，跳过以上两步
     - 将 Stripe subscription 的状态映射到本地：active|canceled|paused
     """
     try:
@@ -526,7 +546,12 @@ def process_stripe_subscription_webhook(headers: dict, body: bytes, request_id:
 
     # 解析/验签
     webhook_secret2 = rc_get("STRIPE_WEBHOOK_SECRET", str, settings.STRIPE_WEBHOOK_SECRET)
-    if webhook_secret2:
+    if event is not None:
+        data = event
+        obj = data.get("data", {}).get("object", {})
+        event_type = data.get("type")
+        event_id = data.get("id")
+    elif webhook_secret2:
         sig = headers.get("stripe-signature") or headers.get("Stripe-Signature")
         if not sig:
             raise RuntimeError("Missing Stripe-Signature header")
@@ -574,7 +599,7 @@ def process_stripe_subscription_webhook(headers: dict, body: bytes, request_id:
 
     with SessionLocal() as s:
         # 幂等
-        if event_id:
+        if event_id and event is None:
             pe = ProviderEvent(provider="stripe", event_id=event_id, raw=data if isinstance(data, dict) else None)
             s.add(pe)
             try:
@@ -630,49 +655,8 @@ def process_stripe_subscription_webhook(headers: dict, body: bytes, request_id:
 
 
 def enqueue_http_post(*, endpoint: str, payload: dict) -> EventOutbox:
-    with _session() as s:
+    with session_scope() as s:
         e = EventOutbox(event_type="http_post", endpoint=endpoint, payload=payload, status="pending", attempts=0, next_attempt_at=dt.datetime.utcnow())
         s.add(e)
         s.flush()
         return e
-
-
-def process_outbox_once(max_batch: int = 10) -> int:
-    import urllib.request
-
-    now = dt.datetime.utcnow()
-    sent = 0
-    with _session() as s:
-        q = (
-            s.query(EventOutbox)
-            .filter(EventOutbox.status == "pending", (EventOutbox.next_attempt_at == None) | (EventOutbox.next_attempt_at <= now))  # noqa: E711
-            .order_by(EventOutbox.id.asc())
-            .limit(max_batch)
-        )
-        rows = q.all()
-        for row in rows:
-            try:
-                if row.event_type == "http_post" and row.endpoint and row.payload is not None:
-                    data = json.dumps(row.payload).encode("utf-8")
-                    req = urllib.request.Request(row.endpoint, data=data, headers={"Content-Type": "application/json"})
-                    with urllib.request.urlopen(req, timeout=5) as resp:  # nosec
-                        _ = resp.read()
-                    row.status = "sent"
-                    row.last_error = None
-                    sent += 1
-                else:
-                    row.status = "failed"
-                    row.last_error = "unsupported event_type/payload"
-            except Exception as e:
-                row.attempts += 1
-                # mark as dead after configured attempts
-                if row.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
-                    row.status = "failed"
-                    row.next_attempt_at = None
-                    row.last_error = f"dead after {row.attempts} attempts: {e}"
-                else:
-                    backoff = min(3600, 2 ** min(10, row.attempts))
-                    row.next_attempt_at = dt.datetime.utcnow() + dt.timedelta(seconds=backoff)
-                    row.last_error = str(e)
-        s.commit()
-    return sent
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import datetime as dt
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import event, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .db import SessionLocal
+from .models import CacheVersion
+
+
+# Version stamps for process-local caches shared by all uvicorn workers.
+#
+# Writers bump a named stamp (in the same transaction as their change when a
+# session is passed); readers take stamp(name) before loading and rebuild when it
+# no longer matches. The DB part is re-read from the small cache_versions table at
+# most once per _POLL_SEC per process, so other workers see a bump within that
+# interval; the local part moves as soon as this worker's bump commits.
+
+_POLL_SEC = 1.0
+
+Stamp = tuple[int, int]  # (db version, local bumps)
+
+_lock = threading.Lock()
+_db_versions: dict[str, int] = {}
+_local: dict[str, int] = {}
+_polled_at = 0.0
+
+
+def _poll() -> None:
+    global _polled_at
+    try:
+        with SessionLocal() as s:
+            rows = s.query(CacheVersion.name, CacheVersion.version).all()
+    except Exception:
+        # table missing (before init_db) or DB hiccup: keep serving the last stamps
+        rows = None
+    with _lock:
+        if rows is not None:
+            _db_versions.clear()
+            _db_versions.update({name: int(version or 0) for name, version in rows})
+        _polled_at = time.monotonic()
+
+
+def stamp(name: str) -> Stamp:
+    if time.monotonic() - _polled_at >= _POLL_SEC:
+        _poll()
+    with _lock:
+        return _db_versions.get(name, 0), _local.get(name, 0)
+
+
+def _bump_local(name: str) -> None:
+    with _lock:
+        _local[name] = _local.get(name, 0) + 1
+
+
+def _bump(s: Session, name: str) -> None:
+    now = dt.datetime.utcnow()
+    stmt = update(CacheVersion).where(CacheVersion.name == name).values(version=CacheVersion.version + 1, updated_at=now)
+    if s.execute(stmt).rowcount:
+        return
+    try:
+        with s.begin_nested():
+            s.add(CacheVersion(name=name, version=1, updated_at=now))
+    except IntegrityError:
+        # another worker created the row first
+        s.execute(stmt)
+
+
+def bump(name: str, *, session: Optional[Session] = None) -> None:
+    """Advance the stamp for name. With a session, it takes effect when that session commits."""
+    if session is not None:
+        _bump(session, name)
+        event.listen(session, "after_commit", lambda _s: _bump_local(name), once=True)
+        return
+    with SessionLocal() as s:
+        _bump(s, name)
+        s.commit()
+    _bump_local(name)
@@ -12,6 +12,9 @@ class Settings:
     # payment providers
     STRIPE_SECRET_KEY: str | None = os.getenv("STRIPE_SECRET_KEY")
     STRIPE_WEBHOOK_SECRET: str | None = os.getenv("STRIPE_WEBHOOK_SECRET")
+    # webhooks are stored and acknowledged, then applied by a background worker; 0 applies them inline
+    WEBHOOK_ASYNC_ENABLED: bool = os.getenv("WEBHOOK_ASYNC_ENABLED", "1") in ("1", "true", "True")
+    WEBHOOK_MAX_ATTEMPTS: int = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "10"))
 
     ALIPAY_APP_ID: str | None = os.getenv("ALIPAY_APP_ID")
     ALIPAY_APP_PRIVATE_KEY: str | None = os.getenv("ALIPAY_APP_PRIVATE_KEY")
@@ -28,12 +31,18 @@ class Settings:
     # litellm
     LITELLM_BASE_URL: str | None = os.getenv("LITELLM_BASE_URL")
     LITELLM_MASTER_KEY: str | None = os.getenv("LITELLM_MASTER_KEY")
+    # push budgets as soon as wallets move (coalesced per user for LITELLM_BUDGET_PUSH_DELAY_MS)
     LITELLM_BUDGET_LINKAGE: bool = os.getenv("LITELLM_BUDGET_LINKAGE", "0") in ("1", "true", "True")
+    LITELLM_BUDGET_PUSH_DELAY_MS: int = int(os.getenv("LITELLM_BUDGET_PUSH_DELAY_MS", "2000"))
     LITELLM_BUDGET_DURATION: str | None = os.getenv("LITELLM_BUDGET_DURATION")
     # optional periodic sync from wallet -> LiteLLM budget
     LITELLM_SYNC_ENABLED: bool = os.getenv("LITELLM_SYNC_ENABLED", "0") in ("1", "true", "True")
     LITELLM_SYNC_INTERVAL_SEC: int = int(os.getenv("LITELLM_SYNC_INTERVAL_SEC", "900"))
     LITELLM_SYNC_CURRENCY: str = os.getenv("LITELLM_SYNC_CURRENCY", "USD")
+    LITELLM_SYNC_CONCURRENCY: int = int(os.getenv("LITELLM_SYNC_CONCURRENCY", "8"))
+    # chat proxy upstream connection pool
+    LITELLM_PROXY_MAX_CONNECTIONS: int = int(os.getenv("LITELLM_PROXY_MAX_CONNECTIONS", "100"))
+    LITELLM_PROXY_TIMEOUT_SEC: int = int(os.getenv("LITELLM_PROXY_TIMEOUT_SEC", "30"))
     # degrade default (demo): fallback model when policy=degrade and overflow
     DEGRADE_DEFAULT_MODEL: str = os.getenv("DEGRADE_DEFAULT_MODEL", "gpt-4o-mini")
     # overdraft next-request strong gating
@@ -41,9 +50,33 @@ class Settings:
     OVERDRAFT_GATING_MODE: str = os.getenv("OVERDRAFT_GATING_MODE", "block")  # block|degrade
     # configurable degrade mapping: "pattern->fallback,pattern2->fallback2"
     DEGRADE_MAPPING: str = os.getenv("DEGRADE_MAPPING", "")
+    # in-memory daily spend counters: how often to re-sync them with the usage table (0 = never)
+    SPEND_COUNTER_RECONCILE_SEC: int = int(os.getenv("SPEND_COUNTER_RECONCILE_SEC", "60"))
+    # write-behind usage recorder (batched inserts of usage rows)
+    USAGE_RECORDER_ENABLED: bool = os.getenv("USAGE_RECORDER_ENABLED", "1") in ("1", "true", "True")
+    USAGE_RECORDER_BATCH_SIZE: int = int(os.getenv("USAGE_RECORDER_BATCH_SIZE", "200"))
+    USAGE_RECORDER_FLUSH_MS: int = int(os.getenv("USAGE_RECORDER_FLUSH_MS", "500"))
+    USAGE_RECORDER_MAX_QUEUE: int = int(os.getenv("USAGE_RECORDER_MAX_QUEUE", "10000"))
+    # usage rollups for reports (hourly/daily buckets maintained from a high-water mark)
+    USAGE_ROLLUPS_ENABLED: bool = os.getenv("USAGE_ROLLUPS_ENABLED", "1") in ("1", "true", "True")
+    USAGE_ROLLUP_INTERVAL_SEC: int = int(os.getenv("USAGE_ROLLUP_INTERVAL_SEC", "60"))
+    USAGE_ROLLUP_SETTLE_SEC: int = int(os.getenv("USAGE_ROLLUP_SETTLE_SEC", "120"))
+    # wallet vs ledger reconciliation from per-wallet checkpoints; interval 0 disables the job
+    LEDGER_RECONCILE_INTERVAL_SEC: int = int(os.getenv("LEDGER_RECONCILE_INTERVAL_SEC", "3600"))
+    LEDGER_CHECKPOINT_SETTLE_SEC: int = int(os.getenv("LEDGER_CHECKPOINT_SETTLE_SEC", "300"))
+    # prepaid metering: hold/settle proxy spend against in-memory wallet balances
+    PREPAID_METERING_ENABLED: bool = os.getenv("PREPAID_METERING_ENABLED", "0") in ("1", "true", "True")
+    PREPAID_METERING_CURRENCY: str = os.getenv("PREPAID_METERING_CURRENCY", "USD")
+    PREPAID_FLUSH_MS: int = int(os.getenv("PREPAID_FLUSH_MS", "1000"))
+    PREPAID_REFRESH_SEC: int = int(os.getenv("PREPAID_REFRESH_SEC", "5"))
+    # admin list totals (COUNT(*)) are cached per filter set for this long; 0 = always exact
+    LIST_TOTAL_CACHE_SEC: int = int(os.getenv("LIST_TOTAL_CACHE_SEC", "30"))
 
     # dev api auth
     DEV_API_KEY: str | None = os.getenv("DEV_API_KEY")
+    # /v1/proxy API keys: resolved contexts cached per process (LRU, TTL)
+    API_KEY_CACHE_TTL_SEC: int = int(os.getenv("API_KEY_CACHE_TTL_SEC", "300"))
+    API_KEY_CACHE_SIZE: int = int(os.getenv("API_KEY_CACHE_SIZE", "10000"))
 
     # stripe publishable key for Payment Element
     STRIPE_PUBLISHABLE_KEY: str | None = os.getenv("STRIPE_PUBLISHABLE_KEY")
@@ -52,9 +85,22 @@ class Settings:
     RATE_LIMIT_ENABLED: bool = os.getenv("RATE_LIMIT_ENABLED", "1") in ("1", "true", "True")
     RATE_LIMIT_WINDOW_SEC: int = int(os.getenv("RATE_LIMIT_WINDOW_SEC", "60"))
     RATE_LIMIT_MAX_REQUESTS: int = int(os.getenv("RATE_LIMIT_MAX_REQUESTS", "120"))
+    # identities tracked by the in-process limiter; least recently seen evicted first
+    RATE_LIMIT_MAX_IDENTITIES: int = int(os.getenv("RATE_LIMIT_MAX_IDENTITIES", "100000"))
+    # where counters live: memory (per process) | shm (workers of one host) | sql (all hosts)
+    RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    RATE_LIMIT_SHM_NAME: str = os.getenv("RATE_LIMIT_SHM_NAME", "rabbit_ratelimit")
+    RATE_LIMIT_SHM_SLOTS: int = int(os.getenv("RATE_LIMIT_SHM_SLOTS", "65536"))
 
     # outbox retries
     OUTBOX_MAX_ATTEMPTS: int = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+    # outbox dispatch: endpoints sent in parallel, rows leased per claim, batch-capable endpoints (comma-separated path suffixes)
+    OUTBOX_CONCURRENCY: int = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+    OUTBOX_LEASE_SEC: int = int(os.getenv("OUTBOX_LEASE_SEC", "300"))
+    OUTBOX_BATCH_SIZE: int = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+    OUTBOX_BATCH_ENDPOINTS: str = os.getenv("OUTBOX_BATCH_ENDPOINTS", "")
+    # sent rows older than this move to event_outbox_archive; 0 keeps them
+    OUTBOX_RETENTION_DAYS: int = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
 
     # Logto (OIDC / Management API)
     LOGTO_ENDPOINT: str | None = os.getenv("LOGTO_ENDPOINT")  # e.g. https://tenant.logto.app
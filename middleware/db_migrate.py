@@ -1,11 +1,27 @@
 from __future__ import annotations
 
+import datetime as dt
+import logging
 from typing import Optional
-from sqlalchemy import text
-from .db import engine, SessionLocal
+from sqlalchemy import func, inspect, select, text
+from .db import Base, engine, SessionLocal
 
 
-TARGET_DB_LAYER = 3  # increment when adding new migrations
+TARGET_DB_LAYER = 9  # increment when adding new migrations
+
+logger = logging.getLogger(__name__)
+
+# layer 4: indexes behind the hot-path filters (declared on the models as well,
+# so fresh databases get them from init_db)
+HOT_INDEXES = {
+    "usage": ["ix_usage_user_created", "ix_usage_team_created", "ix_usage_request_id"],
+    "overdraft_alerts": ["ix_overdraft_alerts_user_created"],
+    "ledger_entries": ["ix_ledger_entries_wallet_id"],
+    "invoices": ["ix_invoices_stripe_invoice_id"],
+    "subscriptions": ["ix_subscriptions_stripe_subscription_id"],
+    "plan_assignments": ["ix_plan_assignments_entity"],
+    "lago_payments": ["ix_lago_payments_user_event_created", "ix_lago_payments_team_event_created"],
+}
 
 
 def _get_current_layer(session) -> int:
@@ -21,7 +37,7 @@ def _get_current_layer(session) -> int:
         r = session.execute(text("SELECT value FROM settings WHERE key='db_layer'"))
         row = r.first()
         if not row:
-            session.execute(text("INSERT OR REPLACE INTO settings(key, value) VALUES('db_layer', '0')"))
+            session.execute(text("INSERT INTO settings(key, value) VALUES('db_layer', '0')"))
             return 0
         try:
             return int(row[0])
@@ -37,11 +53,28 @@ def _set_layer(session, layer: int) -> None:
 
 
 def _column_exists(session, table: str, column: str) -> bool:
-    res = session.execute(text(f"PRAGMA table_info({table})"))
-    cols = [row[1] for row in res.fetchall()]
+    cols = [c["name"] for c in inspect(session.connection()).get_columns(table)]
     return column in cols
 
 
+def _create_indexes(session, indexes: dict[str, list[str]]) -> int:
+    """Create the named model indexes that are missing. Returns how many were created."""
+    from .lago import service as _lago  # noqa: F401 registers lago_payments
+
+    conn = session.connection()
+    insp = inspect(conn)
+    created = 0
+    for table, names in indexes.items():
+        if not insp.has_table(table):
+            continue  # created with its indexes by init_db
+        existing = {ix["name"] for ix in insp.get_indexes(table)}
+        for ix in Base.metadata.tables[table].indexes:
+            if ix.name in names and ix.name not in existing:
+                ix.create(bind=conn)
+                created += 1
+    return created
+
+
 def run_migrations() -> int:
     """Run DB migrations up to TARGET_DB_LAYER. Returns final layer number."""
     with SessionLocal() as s:
@@ -80,5 +113,113 @@ def run_migrations() -> int:
             _set_layer(s, 3)
             cur = 3
 
+        # layer 4: composite indexes for hot queries
+        if cur < 4:
+            n = _create_indexes(s, HOT_INDEXES)
+            logger.info("db.indexes_created count=%s", n)
+            _set_layer(s, 4)
+            cur = 4
+
+        # layer 5: outbox leases for multi-worker dispatch
+        if cur < 5:
+            if not _column_exists(s, 'event_outbox', 'locked_by'):
+                s.execute(text("ALTER TABLE event_outbox ADD COLUMN locked_by VARCHAR(64)"))
+            if not _column_exists(s, 'event_outbox', 'locked_until'):
+                s.execute(text("ALTER TABLE event_outbox ADD COLUMN locked_until TIMESTAMP"))
+            _set_layer(s, 5)
+            cur = 5
+
+        # layer 6: outbox dead-letter status; partial indexes over pending rows only
+        if cur < 6:
+            s.execute(text("UPDATE event_outbox SET status='dead' WHERE status='failed'"))
+            existing = {ix["name"] for ix in inspect(s.connection()).get_indexes("event_outbox")}
+            for name in ("ix_event_outbox_endpoint_status", "ix_event_outbox_status_next"):  # superseded (layer 5)
+                if name in existing:
+                    s.execute(text(f"DROP INDEX {name}"))
+            _create_indexes(s, {"event_outbox": ["ix_event_outbox_pending", "ix_event_outbox_pending_endpoint", "ix_event_outbox_status_created"]})
+            _set_layer(s, 6)
+            cur = 6
+
+        # layer 7: provider_events doubles as the webhook intake queue
+        if cur < 7:
+            for col, ddl in (
+                ("event_type", "VARCHAR(64)"),
+                ("status", "VARCHAR(16) NOT NULL DEFAULT 'processed'"),
+                ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+                ("next_attempt_at", "TIMESTAMP"),
+                ("locked_until", "TIMESTAMP"),
+                ("last_error", "VARCHAR(512)"),
+                ("request_id", "VARCHAR(64)"),
+                ("processed_at", "TIMESTAMP"),
+            ):
+                if not _column_exists(s, 'provider_events', col):
+                    s.execute(text(f"ALTER TABLE provider_events ADD COLUMN {col} {ddl}"))
+            _create_indexes(s, {"provider_events": ["ix_provider_events_status"]})
+            _set_layer(s, 7)
+            cur = 7
+
+        # layer 8: per-key request/token/cost per-minute limits
+        if cur < 8:
+            for col in ("rpm_limit", "tpm_limit", "cost_per_minute_cents"):
+                if not _column_exists(s, 'api_keys', col):
+                    s.execute(text(f"ALTER TABLE api_keys ADD COLUMN {col} INTEGER"))
+            _set_layer(s, 8)
+            cur = 8
+
+        # layer 9: API keys carry their LiteLLM key; usage records the key it was charged to
+        if cur < 9:
+            if not _column_exists(s, 'api_keys', 'litellm_api_key'):
+                s.execute(text("ALTER TABLE api_keys ADD COLUMN litellm_api_key VARCHAR(256)"))
+            if not _column_exists(s, 'usage', 'api_key_id'):
+                s.execute(text("ALTER TABLE usage ADD COLUMN api_key_id INTEGER"))
+            _create_indexes(s, {"usage": ["ix_usage_api_key_created"]})
+            _set_layer(s, 9)
+            cur = 9
+
         s.commit()
         return cur
+
+
+def _hot_queries() -> list[tuple[str, object]]:
+    from .lago.service import LagoPayment
+    from .models import Invoice, LedgerEntry, OverdraftAlert, PlanAssignment, Subscription, Usage
+
+    since = dt.datetime.utcnow() - dt.timedelta(days=1)
+    return [
+        ("usage_user_spend", select(Usage.user_id, func.sum(Usage.computed_amount_cents)).where(Usage.user_id.in_([1, 2]), Usage.created_at >= since, Usage.currency == "USD").group_by(Usage.user_id)),
+        ("usage_team_period", select(Usage.model, func.sum(Usage.computed_amount_cents)).where(Usage.team_id == 1, Usage.created_at >= since).group_by(Usage.model)),
+        ("usage_request_id", select(Usage.request_id).where(Usage.request_id.in_(["a", "b"]))),
+        ("overdraft_user_window", select(OverdraftAlert.id).where(OverdraftAlert.user_id == 1, OverdraftAlert.created_at >= since)),
+        ("ledger_by_wallet", select(LedgerEntry.id).where(LedgerEntry.wallet_id == 1)),
+        ("invoice_by_stripe_id", select(Invoice.id).where(Invoice.stripe_invoice_id == "in_x")),
+        ("subscription_by_stripe_id", select(Subscription.id).where(Subscription.stripe_subscription_id == "sub_x")),
+        ("active_assignment", select(PlanAssignment.id).where(PlanAssignment.entity_type == "user", PlanAssignment.entity_id == 1, PlanAssignment.status == "active")),
+        ("lago_user_topups", select(func.sum(LagoPayment.amount_cents)).where(LagoPayment.user_id == 1, LagoPayment.event_type == "wallet_topup", LagoPayment.created_at >= since)),
+        ("lago_team_topups", select(func.sum(LagoPayment.amount_cents)).where(LagoPayment.team_id == 1, LagoPayment.event_type == "wallet_topup", LagoPayment.created_at >= since)),
+    ]
+
+
+def explain_hot_queries() -> list[dict]:
+    """EXPLAIN each hot query and report whether the planner picks an index.
+
+    On Postgres sequential scans are disabled for the check (SET LOCAL), since
+    the planner prefers them on small tables regardless of available indexes.
+    """
+    dialect = engine.dialect.name
+    out: list[dict] = []
+    # read-only; the transaction (and SET LOCAL) is rolled back when the connection closes
+    with engine.connect() as conn:
+        if dialect == "postgresql":
+            conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        for name, stmt in _hot_queries():
+            sql = str(stmt.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+            if dialect == "sqlite":
+                rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+                plan = [str(r[-1]) for r in rows]
+                uses_index = any("USING" in p for p in plan) and not any(p.startswith("SCAN") and "USING" not in p for p in plan)
+            else:
+                rows = conn.exec_driver_sql(f"EXPLAIN {sql}").fetchall()
+                plan = [str(r[0]) for r in rows]
+                uses_index = any("Index" in p for p in plan) and not any("Seq Scan" in p for p in plan)
+            out.append({"name": name, "uses_index": uses_index, "plan": plan})
+    return out
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import json
+import threading
+from typing import Any, Optional
+
+import httpx
+
+from ..config import settings
+from ..runtime_config import get as rc_get
+
+
+# One pooled client per process: keeps keep-alive connections to LITELLM_BASE_URL
+# open across requests instead of paying a TCP/TLS handshake per chat call.
+_client: Optional[httpx.AsyncClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is not None and not _client.is_closed:
+        return _client
+    with _client_lock:
+        if _client is None or _client.is_closed:
+            max_conns = max(1, int(rc_get("LITELLM_PROXY_MAX_CONNECTIONS", int, settings.LITELLM_PROXY_MAX_CONNECTIONS)))
+            timeout = float(rc_get("LITELLM_PROXY_TIMEOUT_SEC", int, settings.LITELLM_PROXY_TIMEOUT_SEC))
+            _client = httpx.AsyncClient(
+                timeout=httpx.Timeout(timeout, connect=min(timeout, 10.0)),
+                limits=httpx.Limits(
+                    max_connections=max_conns,
+                    max_keepalive_connections=max_conns,
+                    keepalive_expiry=60.0,
+                ),
+            )
+        return _client
+
+
+async def aclose_client() -> None:
+    global _client
+    client, _client = _client, None
+    if client is not None and not client.is_closed:
+        await client.aclose()
+
+
+def chat_url(base_url: str) -> str:
+    return base_url.rstrip("/") + "/chat/completions"
+
+
+def auth_headers(api_key: str) -> dict[str, str]:
+    return {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+
+
+class SSEUsageTracker:
+    """Scan an SSE byte stream for the OpenAI-style `usage` object.
+
+    Chunks are passed through untouched; only complete `data:` lines are parsed,
+    so a JSON event split across network reads is still picked up.
+    """
+
+    def __init__(self) -> None:
+        self._buf = b""
+        self.usage: dict[str, Any] | None = None
+        self.done = False
+
+    def feed(self, chunk: bytes) -> None:
+        self._buf += chunk
+        while b"\n" in self._buf:
+            line, self._buf = self._buf.split(b"\n", 1)
+            self._handle_line(line.strip())
+
+    def close(self) -> None:
+        if self._buf.strip():
+            self._handle_line(self._buf.strip())
+        self._buf = b""
+
+    def _handle_line(self, line: bytes) -> None:
+        if not line.startswith(b"data:"):
+            return
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            self.done = True
+            return
+        # cheap pre-filter: most chunks are content deltas without usage
+        if b'"usage"' not in data:
+            return
+        try:
+            j = json.loads(data.decode("utf-8"))
+        except Exception:
+            return
+        usage = j.get("usage") if isinstance(j, dict) else None
+        if isinstance(usage, dict) and usage:
+            self.usage = usage
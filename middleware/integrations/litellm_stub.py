@@ -8,11 +8,8 @@ from ..config import settings
 from ..runtime_config import get as rc_get
 
 
-def update_budget_for_user(*, litellm_user_id: str | None, max_budget_cents: int | None, budget_duration: str | None) -> None:
-    """Best-effort call to LiteLLM to update user's budget; non-fatal if not configured.
-
-    Uses /user/new with fields to upsert budget according to LiteLLM docs.
-    """
+def budget_request(*, litellm_user_id: str | None, max_budget_cents: int | None, budget_duration: str | None) -> tuple[str, dict, dict] | None:
+    """(url, headers, body) of the budget upsert call, or None if LiteLLM is not configured."""
     if not rc_get("LITELLM_BASE_URL", str, settings.LITELLM_BASE_URL) or not rc_get("LITELLM_MASTER_KEY", str, settings.LITELLM_MASTER_KEY) or not litellm_user_id:
         return None
 
@@ -24,12 +21,24 @@ def update_budget_for_user(*, litellm_user_id: str | None, max_budget_cents: int
     bd = budget_duration or rc_get("LITELLM_BUDGET_DURATION", str, settings.LITELLM_BUDGET_DURATION)
     if bd:
         body["budget_duration"] = bd
-
-    data = json.dumps(body).encode("utf-8")
-    req = urllib.request.Request(url, data=data, headers={
+    headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {rc_get('LITELLM_MASTER_KEY', str, settings.LITELLM_MASTER_KEY)}",
-    })
+    }
+    return url, headers, body
+
+
+def update_budget_for_user(*, litellm_user_id: str | None, max_budget_cents: int | None, budget_duration: str | None) -> None:
+    """Best-effort call to LiteLLM to update user's budget; non-fatal if not configured.
+
+    Uses /user/new with fields to upsert budget according to LiteLLM docs.
+    """
+    call = budget_request(litellm_user_id=litellm_user_id, max_budget_cents=max_budget_cents, budget_duration=budget_duration)
+    if call is None:
+        return None
+    url, headers, body = call
+    data = json.dumps(body).encode("utf-8")
+    req = urllib.request.Request(url, data=data, headers=headers)
     try:
         with urllib.request.urlopen(req, timeout=5) as resp:  # nosec - trusted URL from config
             _ = resp.read()
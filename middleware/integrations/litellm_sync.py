@@ -1,56 +1,192 @@
 from __future__ import annotations
 
+import asyncio
+import datetime as dt
 import logging
+import threading
+import time
 from typing import Optional
 
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, func, insert, or_, select, update
 
 from ..db import SessionLocal
-from ..models import User, Wallet
+from ..models import LedgerEntry, LiteLLMBudgetSync, User, Wallet
 from ..config import settings
 from ..runtime_config import get as rc_get
-from .litellm_stub import update_budget_for_user
+from .litellm_proxy import get_client
+from .litellm_stub import budget_request
 
 logger = logging.getLogger(__name__)
 
 
-def _sync_user_wallet_to_litellm(session: Session, user: User, currency: str = "USD") -> None:
-    if not user.litellm_user_id:
-        return
-    w: Optional[Wallet] = (
-        session.query(Wallet)
-        .filter(Wallet.user_id == user.id, Wallet.currency == currency.upper())
-        .first()
-    )
-    if not w:
+# Incremental wallet -> LiteLLM budget sync.
+#
+# litellm_budget_sync keeps the balance last pushed per user. A run selects, in one
+# query, the wallets with ledger entries above the previous run's high-water mark
+# (all wallets on the first run of a process) whose balance differs from what was
+# pushed, and sends the updates through a bounded number of concurrent requests
+# on the proxy's pooled keep-alive client. Failed users are not recorded, and the
+# mark only moves when every push succeeded, so they are picked up again next run.
+#
+# With LITELLM_BUDGET_LINKAGE on, wallet movements also report the users they touched
+# (budget_changed). Those are coalesced for LITELLM_BUDGET_PUSH_DELAY_MS and pushed
+# by run_budget_events through the same path, so a top-up reaches LiteLLM within
+# seconds instead of at the next polling run.
+
+_SETTLE_SEC = 60
+
+_state_lock = threading.Lock()
+_last_entry_id: Optional[int] = None  # ledger high-water mark of the last clean run
+_pending: set[int] = set()  # users with a budget change not yet pushed
+_listening = False  # run_budget_events is draining _pending
+
+
+def _changed_wallets(currency: str, user_ids: Optional[list[int]] = None) -> tuple[list[tuple[int, str, int]], int, int]:
+    """([(user_id, litellm_user_id, balance_cents)] to push, unchanged count, ledger mark).
+
+    With user_ids only those users are considered, regardless of the ledger mark.
+    """
+    with _state_lock:
+        since = _last_entry_id
+    sync = LiteLLMBudgetSync
+    with SessionLocal() as s:
+        # entries this young may still sit behind an uncommitted lower id: keep them above the mark
+        cutoff = dt.datetime.utcnow() - dt.timedelta(seconds=_SETTLE_SEC)
+        mark = int(s.query(func.max(LedgerEntry.id)).filter(LedgerEntry.created_at < cutoff).scalar() or since or 0)
+        q = (
+            select(User.id, User.litellm_user_id, Wallet.balance_cents, sync.pushed_balance_cents, sync.currency)
+            .join(Wallet, and_(Wallet.user_id == User.id, Wallet.currency == currency))
+            .outerjoin(sync, sync.user_id == User.id)
+            .where(User.litellm_user_id.is_not(None), User.litellm_user_id != "")
+        )
+        if user_ids is not None:
+            q = q.where(User.id.in_(user_ids))
+        elif since is not None:
+            active = select(LedgerEntry.wallet_id).where(LedgerEntry.id > since)
+            q = q.where(or_(Wallet.id.in_(active), sync.user_id.is_(None)))
+        todo: list[tuple[int, str, int]] = []
+        unchanged = 0
+        for uid, luid, balance, pushed, pushed_currency in s.execute(q):
+            balance = int(balance or 0)
+            if pushed is not None and int(pushed) == balance and pushed_currency == currency:
+                unchanged += 1
+            else:
+                todo.append((int(uid), luid, balance))
+    return todo, unchanged, mark
+
+
+def _record_pushed(pushed: list[tuple[int, int]], currency: str) -> None:
+    if not pushed:
         return
-    # Use wallet balance (in cents) as LiteLLM max_budget (USD units expected by LiteLLM)
-    max_budget_cents = int(w.balance_cents or 0)
-    update_budget_for_user(
-        litellm_user_id=user.litellm_user_id,
-        max_budget_cents=max_budget_cents,
-        budget_duration=rc_get("LITELLM_BUDGET_DURATION", str, settings.LITELLM_BUDGET_DURATION),
-    )
+    now = dt.datetime.utcnow()
+    with SessionLocal() as s:
+        ids = [uid for uid, _ in pushed]
+        existing = {uid for (uid,) in s.query(LiteLLMBudgetSync.user_id).filter(LiteLLMBudgetSync.user_id.in_(ids)).all()}
+        rows = [{"user_id": uid, "currency": currency, "pushed_balance_cents": bal, "pushed_at": now} for uid, bal in pushed]
+        new = [r for r in rows if r["user_id"] not in existing]
+        old = [r for r in rows if r["user_id"] in existing]
+        if new:
+            s.execute(insert(LiteLLMBudgetSync), new)
+        if old:
+            s.execute(update(LiteLLMBudgetSync), old)
+        s.commit()
+
+
+def _configured() -> bool:
+    return bool(rc_get("LITELLM_BASE_URL", str, settings.LITELLM_BASE_URL) and rc_get("LITELLM_MASTER_KEY", str, settings.LITELLM_MASTER_KEY))
+
+
+async def _push_all(todo: list[tuple[int, str, int]], currency: str) -> int:
+    """Push budgets with bounded concurrency and record the successful ones. Returns failures."""
+    if not todo:
+        return 0
+    duration = rc_get("LITELLM_BUDGET_DURATION", str, settings.LITELLM_BUDGET_DURATION)
+    client = get_client()
+    gate = asyncio.Semaphore(max(1, int(rc_get("LITELLM_SYNC_CONCURRENCY", int, settings.LITELLM_SYNC_CONCURRENCY))))
+
+    async def _push(uid: int, luid: str, balance: int) -> bool:
+        call = budget_request(litellm_user_id=luid, max_budget_cents=balance, budget_duration=duration)
+        if call is None:
+            return False
+        url, headers, body = call
+        async with gate:
+            try:
+                resp = await client.post(url, json=body, headers=headers)
+                resp.raise_for_status()
+            except Exception as e:
+                logger.warning("litellm.sync.error user_id=%s currency=%s err=%s", uid, currency, e)
+                return False
+        return True
+
+    results = await asyncio.gather(*(_push(*w) for w in todo))
+    pushed = [(uid, balance) for (uid, _luid, balance), ok in zip(todo, results) if ok]
+    await asyncio.to_thread(_record_pushed, pushed, currency)
+    return len(todo) - len(pushed)
+
+
+async def sync_wallets_to_litellm(currency: str = "USD") -> dict:
+    """Push changed wallet balances to LiteLLM budgets.
+
+    Returns {"pushed", "skipped", "failed", "elapsed_ms"}; skipped counts wallets with
+    ledger activity whose balance already matches the last push.
+    """
+    started = time.monotonic()
+    summary = {"pushed": 0, "skipped": 0, "failed": 0, "elapsed_ms": 0}
+    if not _configured():
+        logger.info("litellm.sync.skip reason=not_configured")
+        return summary
+    global _last_entry_id
+    currency = currency.upper()
+    todo, unchanged, mark = await asyncio.to_thread(_changed_wallets, currency)
+    failed = await _push_all(todo, currency)
+    if not failed:
+        with _state_lock:
+            _last_entry_id = mark
+    summary.update(pushed=len(todo) - failed, skipped=unchanged, failed=failed, elapsed_ms=int((time.monotonic() - started) * 1000))
     logger.info(
-        "litellm.sync user_id=%s litellm_user_id=%s currency=%s balance_cents=%s",
-        user.id,
-        user.litellm_user_id,
-        currency.upper(),
-        max_budget_cents,
+        "litellm.sync.done currency=%s pushed=%s skipped=%s failed=%s elapsed_ms=%s",
+        currency,
+        summary["pushed"],
+        summary["skipped"],
+        summary["failed"],
+        summary["elapsed_ms"],
     )
+    return summary
 
 
-def sync_wallets_to_litellm(currency: str = "USD") -> None:
-    """Best-effort periodic sync of wallet balances to LiteLLM budgets."""
-    if not rc_get("LITELLM_BASE_URL", str, settings.LITELLM_BASE_URL) or not rc_get("LITELLM_MASTER_KEY", str, settings.LITELLM_MASTER_KEY):
-        logger.info("litellm.sync.skip reason=not_configured")
+def budget_changed(user_ids) -> None:
+    """Note users whose wallet balance moved; pushed after the coalescing window. Thread-safe."""
+    if not _listening:
         return
-    with SessionLocal() as s:
-        users = s.query(User).all()
-        for u in users:
+    with _state_lock:
+        _pending.update(int(u) for u in user_ids)
+
+
+async def flush_budget_events(currency: str = "USD") -> int:
+    """Push the budgets of all users noted so far. Returns the number of users considered."""
+    with _state_lock:
+        users = sorted(_pending)
+        _pending.clear()
+    if not users or not _configured():
+        return 0
+    currency = currency.upper()
+    todo, _unchanged, _mark = await asyncio.to_thread(_changed_wallets, currency, users)
+    failed = await _push_all(todo, currency)
+    logger.info("litellm.budget_events.pushed users=%s pushed=%s failed=%s", len(users), len(todo) - failed, failed)
+    return len(users)
+
+
+async def run_budget_events(currency: str = "USD") -> None:
+    """Drain budget_changed() notifications every LITELLM_BUDGET_PUSH_DELAY_MS until cancelled."""
+    global _listening
+    _listening = True
+    try:
+        while True:
+            delay = max(100, int(rc_get("LITELLM_BUDGET_PUSH_DELAY_MS", int, settings.LITELLM_BUDGET_PUSH_DELAY_MS))) / 1000.0
+            await asyncio.sleep(delay)
             try:
-                _sync_user_wallet_to_litellm(s, u, currency=currency)
-            except Exception as e:  # pragma: no cover
-                logger.warning(
-                    "litellm.sync.error user_id=%s currency=%s err=%s", u.id, currency.upper(), e
-                )
+                await flush_budget_events(currency)
+            except Exception as e:
+                logger.error("litellm.budget_events.failed err=%s", e)
+    finally:
+        _listening = False
@@ -7,9 +7,9 @@ from typing import Optional
 from sqlalchemy.orm import Session
 
 from ..db import SessionLocal
-from ..models import Usage
+from .. import usage_recorder
 from ..models import Base
-from ..models import BigInteger, Integer, String, DateTime, Boolean, mapped_column  # type: ignore
+from ..models import BigInteger, Integer, String, DateTime, Boolean, Index, mapped_column  # type: ignore
 import datetime as dt
 
 logger = logging.getLogger(__name__)
@@ -17,6 +17,10 @@ logger = logging.getLogger(__name__)
 
 class LagoPayment(Base):
     __tablename__ = "lago_payments"
+    __table_args__ = (
+        Index("ix_lago_payments_user_event_created", "user_id", "event_type", "created_at"),
+        Index("ix_lago_payments_team_event_created", "team_id", "event_type", "created_at"),
+    )
     id = mapped_column(Integer, primary_key=True)
     event_type = mapped_column(String(32))
     provider = mapped_column(String(32))
@@ -62,25 +66,24 @@ def ingest_payment_event(payload: dict) -> None:
 
 
 def ingest_usage_event(payload: dict) -> None:
-    # Map to existing Usage table for aggregation/day-limit
+    # Map to existing Usage table for aggregation/day-limit.
+    # Proxied calls already recorded this usage under the same request_id; the
+    # recorder drops such mirrors instead of counting the spend twice.
     subject = payload.get("subject") or {}
     tokens = payload.get("tokens") or {}
     pricing = payload.get("pricing") or {}
-    with _session() as s:
-        u = Usage(
-            user_id=subject.get("user_id"),
-            team_id=subject.get("team_id"),
-            model=payload.get("model"),
-            unit=payload.get("unit") or "token",
-            input_tokens=int(tokens.get("input") or 0),
-            output_tokens=int(tokens.get("output") or 0),
-            total_tokens=int(tokens.get("total") or 0),
-            computed_amount_cents=int(pricing.get("computed_amount_cents") or 0),
-            currency=str(pricing.get("currency") or "USD").upper(),
-            success=bool(payload.get("success") if payload.get("success") is not None else True),
-            request_id=payload.get("request_id"),
-        )
-        s.add(u)
-        s.commit()
-        logger.info("lago.ingest.usage user_id=%s model=%s amount_cents=%s", u.user_id, u.model, u.computed_amount_cents)
-
+    usage_recorder.record(
+        mirror=True,
+        user_id=subject.get("user_id"),
+        team_id=subject.get("team_id"),
+        model=payload.get("model"),
+        unit=payload.get("unit") or "token",
+        input_tokens=int(tokens.get("input") or 0),
+        output_tokens=int(tokens.get("output") or 0),
+        total_tokens=int(tokens.get("total") or 0),
+        computed_amount_cents=int(pricing.get("computed_amount_cents") or 0),
+        currency=str(pricing.get("currency") or "USD").upper(),
+        success=bool(payload.get("success") if payload.get("success") is not None else True),
+        request_id=payload.get("request_id"),
+    )
+    logger.info("lago.ingest.usage user_id=%s model=%s amount_cents=%s", subject.get("user_id"), payload.get("model"), pricing.get("computed_amount_cents"))
@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import datetime as dt
+import logging
+import time
+from typing import Optional
+
+from sqlalchemy import bindparam, case, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from .config import settings
+from .db import SessionLocal
+from .models import LedgerCheckpoint, LedgerEntry, Wallet
+from .runtime_config import get as rc_get
+
+
+# Wallet balance vs ledger reconciliation.
+#
+# Each wallet has a checkpoint holding SUM(ledger_entries.amount_cents) through some
+# entry id. A run only replays entries after the checkpoints: one grouped statement
+# returns, per wallet, the stored balance and the ledger sum since its checkpoint, so
+# both are read from the same snapshot and nothing is diffed row by row. Checkpoints
+# then advance to the newest entry older than LEDGER_CHECKPOINT_SETTLE_SEC, leaving
+# recent ids alone in case an older transaction has not committed yet. A checkpoint
+# records the ledger, not the wallet, so a discrepant wallet keeps being reported.
+
+logger = logging.getLogger(__name__)
+
+
+def _write_checkpoints(s, new_cps: list[dict], old_cps: list[dict]) -> None:
+    """Insert/advance checkpoints; safe against a concurrent run writing the same ones.
+
+    A checkpoint is only ever moved forward, so a slower run cannot undo a newer one.
+    """
+    if new_cps:
+        try:
+            with s.begin_nested():
+                s.execute(insert(LedgerCheckpoint), new_cps)
+        except IntegrityError:
+            # another run created some of them meanwhile: advance those instead
+            for values in new_cps:
+                try:
+                    with s.begin_nested():
+                        s.execute(insert(LedgerCheckpoint), [values])
+                except IntegrityError:
+                    old_cps.append(values)
+    if old_cps:
+        t = LedgerCheckpoint.__table__
+        s.execute(
+            update(t)
+            .where(t.c.wallet_id == bindparam("b_wallet_id"), t.c.last_entry_id < bindparam("b_last_entry_id"))
+            .values(last_entry_id=bindparam("b_last_entry_id"), balance_cents=bindparam("b_balance_cents"), updated_at=bindparam("b_updated_at")),
+            [{f"b_{k}": v for k, v in values.items()} for values in old_cps],
+        )
+
+
+def reconcile(*, full: bool = False, write_checkpoints: bool = True) -> dict:
+    """Compare every wallet balance with its ledger. full=True ignores checkpoints.
+
+    Returns {"wallets", "replayed_entries", "checkpointed", "discrepancies", "elapsed_ms"}.
+    """
+    started = time.monotonic()
+    settle = max(0, int(rc_get("LEDGER_CHECKPOINT_SETTLE_SEC", int, settings.LEDGER_CHECKPOINT_SETTLE_SEC)))
+    cutoff = dt.datetime.utcnow() - dt.timedelta(seconds=settle)
+    le, cp = LedgerEntry, LedgerCheckpoint
+    with SessionLocal() as s:
+        bound: Optional[int] = s.query(func.max(le.id)).filter(le.created_at < cutoff).scalar() if write_checkpoints else None
+        # the oldest checkpoint (0 for a wallet without one) bounds the index range scanned
+        lo = 0
+        if not full:
+            lo = int(s.query(func.min(func.coalesce(cp.last_entry_id, 0))).select_from(Wallet).outerjoin(cp, cp.wallet_id == Wallet.id).scalar() or 0)
+        last = func.coalesce(cp.last_entry_id, 0) if not full else 0
+        delta = (
+            select(
+                le.wallet_id.label("wallet_id"),
+                func.coalesce(func.sum(le.amount_cents), 0).label("delta"),
+                func.coalesce(func.sum(case((le.id <= (bound or 0), le.amount_cents), else_=0)), 0).label("settled"),
+                func.count(le.id).label("n"),
+            )
+            .select_from(le)
+            .outerjoin(cp, cp.wallet_id == le.wallet_id)
+            .where(le.id > lo, le.id > last)
+            .group_by(le.wallet_id)
+            .subquery()
+        )
+        base = cp.balance_cents if not full else 0
+        rows = s.execute(
+            select(
+                Wallet.id,
+                Wallet.user_id,
+                Wallet.currency,
+                Wallet.balance_cents,
+                func.coalesce(base, 0),
+                func.coalesce(cp.last_entry_id, -1),
+                func.coalesce(delta.c.delta, 0),
+                func.coalesce(delta.c.settled, 0),
+                func.coalesce(delta.c.n, 0),
+            )
+            .outerjoin(cp, cp.wallet_id == Wallet.id)
+            .outerjoin(delta, delta.c.wallet_id == Wallet.id)
+        ).all()
+
+        discrepancies: list[dict] = []
+        new_cps: list[dict] = []
+        old_cps: list[dict] = []
+        replayed = 0
+        now = dt.datetime.utcnow()
+        for wallet_id, user_id, currency, balance, cp_balance, cp_last, d_all, d_settled, n in rows:
+            replayed += int(n)
+            ledger = int(cp_balance) + int(d_all)
+            if int(balance or 0) != ledger:
+                discrepancies.append({
+                    "wallet_id": wallet_id,
+                    "user_id": user_id,
+                    "currency": currency,
+                    "balance_cents": int(balance or 0),
+                    "ledger_cents": ledger,
+                    "diff_cents": int(balance or 0) - ledger,
+                })
+            if bound is not None and bound > int(cp_last) and not full:
+                values = {"wallet_id": wallet_id, "last_entry_id": bound, "balance_cents": int(cp_balance) + int(d_settled), "updated_at": now}
+                (new_cps if int(cp_last) < 0 else old_cps).append(values)
+        _write_checkpoints(s, new_cps, old_cps)
+        s.commit()
+
+    elapsed_ms = int((time.monotonic() - started) * 1000)
+    for d in discrepancies[:50]:
+        logger.warning("ledger.discrepancy wallet_id=%s user_id=%s currency=%s balance=%s ledger=%s", d["wallet_id"], d["user_id"], d["currency"], d["balance_cents"], d["ledger_cents"])
+    logger.info("ledger.reconciled wallets=%s replayed=%s discrepancies=%s elapsed_ms=%s", len(rows), replayed, len(discrepancies), elapsed_ms)
+    return {
+        "wallets": len(rows),
+        "replayed_entries": replayed,
+        "checkpointed": len(new_cps) + len(old_cps),
+        "discrepancies": discrepancies,
+        "elapsed_ms": elapsed_ms,
+    }
@@ -11,10 +11,12 @@ from sqlalchemy import (
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
     UniqueConstraint,
+    text,
 )
 from sqlalchemy.dialects.sqlite import JSON as SQLITE_JSON
 from sqlalchemy.orm import Mapped, mapped_column, relationship
@@ -62,9 +64,14 @@ class ApiKey(Base):
     key_hash: Mapped[str] = mapped_column(String(128), unique=True, nullable=False)
     key_last4: Mapped[str] = mapped_column(String(4), nullable=False)
     litellm_key_hash: Mapped[Optional[str]] = mapped_column(String(128), unique=True)
+    litellm_api_key: Mapped[Optional[str]] = mapped_column(String(256))  # forwarded upstream; never returned
     model_allowlist: Mapped[Optional[str]] = mapped_column(Text)  # csv list
     max_budget_cents: Mapped[Optional[int]] = mapped_column(Integer)
     budget_duration: Mapped[Optional[str]] = mapped_column(String(16))  # e.g. 30d, 24h
+    # per-minute limits (NULL = none); plans may set the same keys in Plan.meta
+    rpm_limit: Mapped[Optional[int]] = mapped_column(Integer)
+    tpm_limit: Mapped[Optional[int]] = mapped_column(Integer)
+    cost_per_minute_cents: Mapped[Optional[int]] = mapped_column(Integer)
     active: Mapped[bool] = mapped_column(Boolean, default=True)
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
 
@@ -90,6 +97,7 @@ class Wallet(Base):
 
 class LedgerEntry(Base):
     __tablename__ = "ledger_entries"
+    __table_args__ = (Index("ix_ledger_entries_wallet_id", "wallet_id"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     wallet_id: Mapped[int] = mapped_column(ForeignKey("wallets.id"), nullable=False)
     amount_cents: Mapped[int] = mapped_column(BigInteger)
@@ -99,6 +107,22 @@ class LedgerEntry(Base):
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
 
 
+class LedgerCheckpoint(Base):
+    __tablename__ = "ledger_checkpoints"
+    wallet_id: Mapped[int] = mapped_column(ForeignKey("wallets.id"), primary_key=True)
+    last_entry_id: Mapped[int] = mapped_column(BigInteger, default=0)  # ledger_entries.id covered
+    balance_cents: Mapped[int] = mapped_column(BigInteger, default=0)  # SUM(amount_cents) through last_entry_id
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
+
+
+class LiteLLMBudgetSync(Base):
+    __tablename__ = "litellm_budget_sync"
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True)
+    currency: Mapped[str] = mapped_column(String(8), nullable=False)
+    pushed_balance_cents: Mapped[int] = mapped_column(BigInteger, default=0)  # last max_budget sent to LiteLLM
+    pushed_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
+
+
 class Order(Base):
     __tablename__ = "orders"
     __table_args__ = (UniqueConstraint("order_id", name="uq_order_id"),)
@@ -139,11 +163,21 @@ class ProviderEvent(Base):
     __tablename__ = "provider_events"
     __table_args__ = (
         UniqueConstraint("provider", "event_id", name="uq_provider_event"),
+        Index("ix_provider_events_status", "status", "next_attempt_at"),
     )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     provider: Mapped[str] = mapped_column(String(32), nullable=False)
     event_id: Mapped[str] = mapped_column(String(128), nullable=False)
     raw: Mapped[Optional[dict]] = mapped_column(SQLITE_JSON)
+    # webhook intake queue; events handled inline (older rows, other providers) are born processed
+    event_type: Mapped[Optional[str]] = mapped_column(String(64))
+    status: Mapped[str] = mapped_column(String(16), default="processed")  # received|processing|processed|failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime)
+    locked_until: Mapped[Optional[dt.datetime]] = mapped_column(DateTime)
+    last_error: Mapped[Optional[str]] = mapped_column(String(512))
+    request_id: Mapped[Optional[str]] = mapped_column(String(64))
+    processed_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime)
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
 
 
@@ -196,6 +230,7 @@ class PriceRule(Base):
 
 class PlanAssignment(Base):
     __tablename__ = "plan_assignments"
+    __table_args__ = (Index("ix_plan_assignments_entity", "entity_type", "entity_id", "status"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     entity_type: Mapped[str] = mapped_column(String(16), nullable=False)  # user|team
     entity_id: Mapped[int] = mapped_column(Integer, nullable=False)
@@ -209,6 +244,12 @@ class PlanAssignment(Base):
 
 class Usage(Base):
     __tablename__ = "usage"
+    __table_args__ = (
+        Index("ix_usage_user_created", "user_id", "created_at"),
+        Index("ix_usage_team_created", "team_id", "created_at"),
+        Index("ix_usage_request_id", "request_id"),
+        Index("ix_usage_api_key_created", "api_key_id", "created_at"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[Optional[int]] = mapped_column(Integer)
     team_id: Mapped[Optional[int]] = mapped_column(Integer)
@@ -221,11 +262,48 @@ class Usage(Base):
     currency: Mapped[str] = mapped_column(String(8), default="USD")
     success: Mapped[bool] = mapped_column(Boolean, default=True)
     request_id: Mapped[Optional[str]] = mapped_column(String(64))
+    api_key_id: Mapped[Optional[int]] = mapped_column(Integer)  # the proxy API key that was charged
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
 
 
+class UsageRollupHourly(Base):
+    __tablename__ = "usage_rollup_hourly"
+    __table_args__ = (UniqueConstraint("bucket_start", "user_id", "team_id", "model", "success", name="uq_usage_rollup_hourly_key"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    bucket_start: Mapped[dt.datetime] = mapped_column(DateTime, nullable=False, index=True)  # UTC hour
+    user_id: Mapped[Optional[int]] = mapped_column(Integer)
+    team_id: Mapped[Optional[int]] = mapped_column(Integer)
+    model: Mapped[str] = mapped_column(String(128))
+    success: Mapped[bool] = mapped_column(Boolean, default=True)
+    amount_cents: Mapped[int] = mapped_column(BigInteger, default=0)
+    total_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    request_count: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class UsageRollupDaily(Base):
+    __tablename__ = "usage_rollup_daily"
+    __table_args__ = (UniqueConstraint("bucket_start", "user_id", "team_id", "model", "success", name="uq_usage_rollup_daily_key"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    bucket_start: Mapped[dt.datetime] = mapped_column(DateTime, nullable=False, index=True)  # UTC+8 day start, in UTC
+    user_id: Mapped[Optional[int]] = mapped_column(Integer)
+    team_id: Mapped[Optional[int]] = mapped_column(Integer)
+    model: Mapped[str] = mapped_column(String(128))
+    success: Mapped[bool] = mapped_column(Boolean, default=True)
+    amount_cents: Mapped[int] = mapped_column(BigInteger, default=0)
+    total_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    request_count: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class UsageRollupState(Base):
+    __tablename__ = "usage_rollup_state"
+    name: Mapped[str] = mapped_column(String(32), primary_key=True)  # usage
+    last_usage_id: Mapped[int] = mapped_column(BigInteger, default=0)  # high-water mark on usage.id
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
+
+
 class OverdraftAlert(Base):
     __tablename__ = "overdraft_alerts"
+    __table_args__ = (Index("ix_overdraft_alerts_user_created", "user_id", "created_at"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(Integer, nullable=False)
     model: Mapped[str] = mapped_column(String(128))
@@ -254,6 +332,7 @@ class Customer(Base):
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
+    __table_args__ = (Index("ix_subscriptions_stripe_subscription_id", "stripe_subscription_id"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     customer_id: Mapped[int] = mapped_column(ForeignKey("customers.id"))
     plan_id: Mapped[int] = mapped_column(ForeignKey("plans.id"))
@@ -264,6 +343,7 @@ class Subscription(Base):
 
 class Invoice(Base):
     __tablename__ = "invoices"
+    __table_args__ = (Index("ix_invoices_stripe_invoice_id", "stripe_invoice_id"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     customer_id: Mapped[int] = mapped_column(ForeignKey("customers.id"))
     period_start: Mapped[dt.datetime] = mapped_column(DateTime)
@@ -290,17 +370,47 @@ class InvoiceItem(Base):
 
 class EventOutbox(Base):
     __tablename__ = "event_outbox"
+    __table_args__ = (
+        # partial indexes over pending rows only, covering the dispatcher's queue-head lookup
+        Index(
+            "ix_event_outbox_pending",
+            "id", "endpoint", "next_attempt_at", "locked_until", "status",
+            sqlite_where=text("status = 'pending'"),
+            postgresql_where=text("status = 'pending'"),
+        ),
+        Index(
+            "ix_event_outbox_pending_endpoint",
+            "endpoint", "id", "status",
+            sqlite_where=text("status = 'pending'"),
+            postgresql_where=text("status = 'pending'"),
+        ),
+        Index("ix_event_outbox_status_created", "status", "created_at"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     event_type: Mapped[str] = mapped_column(String(64))
     payload: Mapped[Optional[dict]] = mapped_column(SQLITE_JSON)
     endpoint: Mapped[Optional[str]] = mapped_column(String(256))
-    status: Mapped[str] = mapped_column(String(16), default="pending")  # pending|sent|failed
+    status: Mapped[str] = mapped_column(String(16), default="pending")  # pending|sent|dead
     attempts: Mapped[int] = mapped_column(Integer, default=0)
     next_attempt_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime)
     last_error: Mapped[Optional[str]] = mapped_column(String(512))
+    locked_by: Mapped[Optional[str]] = mapped_column(String(64))  # claim token of the dispatcher holding the row
+    locked_until: Mapped[Optional[dt.datetime]] = mapped_column(DateTime)  # lease expiry
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
 
 
+class EventOutboxArchive(Base):
+    __tablename__ = "event_outbox_archive"  # sent rows moved out of event_outbox by the retention job
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)  # event_outbox.id
+    event_type: Mapped[str] = mapped_column(String(64))
+    payload: Mapped[Optional[dict]] = mapped_column(SQLITE_JSON)
+    endpoint: Mapped[Optional[str]] = mapped_column(String(256))
+    status: Mapped[str] = mapped_column(String(16))
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime)
+    archived_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
+
+
 class StripePriceMapping(Base):
     __tablename__ = "stripe_price_mappings"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -309,3 +419,23 @@ class StripePriceMapping(Base):
     stripe_price_id: Mapped[str] = mapped_column(String(128), nullable=False)
     active: Mapped[bool] = mapped_column(Boolean, default=True)
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
+
+
+# -----------------------------
+# Cross-worker cache invalidation
+# -----------------------------
+
+class CacheVersion(Base):
+    __tablename__ = "cache_versions"
+    name: Mapped[str] = mapped_column(String(32), primary_key=True)  # plans|...
+    version: Mapped[int] = mapped_column(BigInteger, default=0)
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow)
+
+
+class RateLimitCounter(Base):
+    __tablename__ = "rate_limit_counters"
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)  # hash of the limited identity
+    window_idx: Mapped[int] = mapped_column(BigInteger, default=0)  # epoch // window of curr_count
+    curr_count: Mapped[int] = mapped_column(Integer, default=0)
+    prev_count: Mapped[int] = mapped_column(Integer, default=0)
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime, default=dt.datetime.utcnow, index=True)
@@ -0,0 +1,308 @@
+from __future__ import annotations
+
+import datetime as dt
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import httpx
+from sqlalchemy import bindparam, case, delete, exists, func, insert, or_, select, update
+from sqlalchemy.orm import aliased
+
+from .config import settings
+from .db import SessionLocal
+from .models import EventOutbox, EventOutboxArchive
+from .pagination import keyset_page
+from .runtime_config import get as rc_get
+
+
+# Outbox dispatcher, safe to run in every worker process.
+#
+# Rows are claimed per endpoint: a dispatcher leases the oldest pending row of an
+# endpoint (FOR UPDATE SKIP LOCKED on Postgres; on SQLite the conditional lease
+# update alone decides) and with it up to OUTBOX_BATCH_SIZE rows queued behind it.
+# Only the oldest pending row can be leased, so an endpoint is held by one
+# dispatcher at a time and its rows go out in id order. A head row waiting out its
+# retry backoff holds back the rows behind it. Endpoints are sent in parallel on a
+# pooled HTTP client; endpoints listed in OUTBOX_BATCH_ENDPOINTS get their rows
+# coalesced into POST <endpoint>/batch {"events": [...]}. A crashed dispatcher's
+# rows become claimable again when its lease (OUTBOX_LEASE_SEC) expires.
+#
+# Rows out of attempts (or unsendable) go to status "dead" and stay there until an
+# admin replays them. Sent rows older than OUTBOX_RETENTION_DAYS are moved to
+# event_outbox_archive in chunks, so event_outbox only holds recent history.
+
+logger = logging.getLogger(__name__)
+
+_TIMEOUT = 5.0
+_ARCHIVE_CHUNK = 1000
+
+_client: Optional[httpx.Client] = None
+_client_lock = threading.Lock()
+
+
+def _get_client() -> httpx.Client:
+    global _client
+    with _client_lock:
+        if _client is None or _client.is_closed:
+            n = max(1, int(rc_get("OUTBOX_CONCURRENCY", int, settings.OUTBOX_CONCURRENCY)))
+            _client = httpx.Client(timeout=_TIMEOUT, limits=httpx.Limits(max_connections=n * 2, max_keepalive_connections=n * 2))
+        return _client
+
+
+def close() -> None:
+    global _client
+    with _client_lock:
+        client, _client = _client, None
+    if client is not None:
+        client.close()
+
+
+def _batch_url(endpoint: str) -> Optional[str]:
+    conf = rc_get("OUTBOX_BATCH_ENDPOINTS", str, settings.OUTBOX_BATCH_ENDPOINTS) or ""
+    for suffix in (c.strip().rstrip("/") for c in conf.split(",")):
+        if suffix and endpoint.rstrip("/").endswith(suffix):
+            return endpoint.rstrip("/") + "/batch"
+    return None
+
+
+def _headers(endpoint: str) -> dict[str, str]:
+    headers = {"Content-Type": "application/json"}
+    # rows queued by the Lago client are stored without credentials
+    base = rc_get("LAGO_API_URL", str, settings.LAGO_API_URL)
+    key = rc_get("LAGO_API_KEY", str, settings.LAGO_API_KEY)
+    if base and key and endpoint.startswith(base.rstrip("/")):
+        headers["Authorization"] = f"Bearer {key}"
+    return headers
+
+
+def claim(max_endpoints: int, per_endpoint: int) -> tuple[str, list[EventOutbox]]:
+    """Lease due rows for up to max_endpoints endpoints. Returns (claim token, rows by id)."""
+    token = uuid.uuid4().hex
+    now = dt.datetime.utcnow()
+    until = now + dt.timedelta(seconds=max(10, int(rc_get("OUTBOX_LEASE_SEC", int, settings.OUTBOX_LEASE_SEC))))
+    o, older = EventOutbox, aliased(EventOutbox)
+    unleased = or_(o.locked_until == None, o.locked_until <= now)  # noqa: E711
+    is_head = ~exists().where(older.endpoint == o.endpoint, older.status == "pending", older.id < o.id)
+    with SessionLocal() as s:
+        heads = s.execute(
+            select(o.id, o.endpoint)
+            .where(o.status == "pending", or_(o.next_attempt_at == None, o.next_attempt_at <= now), unleased, is_head)  # noqa: E711
+            .order_by(o.id)
+            .limit(max_endpoints)
+            .with_for_update(skip_locked=True)
+        ).all()
+        lease = update(o).values(locked_by=token, locked_until=until).execution_options(synchronize_session=False)
+        for head_id, endpoint in heads:
+            if not s.execute(lease.where(o.id == head_id, unleased)).rowcount:
+                continue  # taken by another dispatcher meanwhile
+            if endpoint is None or per_endpoint <= 1:
+                continue
+            behind = [
+                i for (i,) in s.execute(
+                    select(o.id).where(o.endpoint == endpoint, o.status == "pending", o.id > head_id, unleased).order_by(o.id).limit(per_endpoint - 1)
+                )
+            ]
+            if behind:
+                s.execute(lease.where(o.id.in_(behind), unleased))
+        s.commit()
+        rows = s.query(o).filter(o.locked_by == token).order_by(o.id).all() if heads else []
+    return token, rows
+
+
+def _post(url: str, endpoint: str, body) -> None:
+    resp = _get_client().post(url, json=body, headers=_headers(endpoint))
+    resp.raise_for_status()
+
+
+def _send_endpoint(endpoint: str, rows: list[EventOutbox]) -> tuple[list[int], list[tuple[int, str]], list[int]]:
+    """Send rows in order; stop at the first failure.
+
+    Returns (sent ids, [(failed id, error)], unsupported ids). Rows after a failure
+    are neither sent nor failed; their lease is just released.
+    """
+    sent: list[int] = []
+    unsupported = [r.id for r in rows if r.event_type != "http_post" or not r.endpoint or r.payload is None]
+    if unsupported:
+        return sent, [], unsupported
+    batch_url = _batch_url(endpoint)
+    size = max(1, int(rc_get("OUTBOX_BATCH_SIZE", int, settings.OUTBOX_BATCH_SIZE))) if batch_url else 1
+    for i in range(0, len(rows), size):
+        chunk = rows[i:i + size]
+        try:
+            if batch_url:
+                _post(batch_url, endpoint, {"events": [r.payload for r in chunk]})
+            else:
+                _post(endpoint, endpoint, chunk[0].payload)
+        except Exception as e:
+            return sent, [(r.id, str(e)[:400]) for r in chunk], []
+        sent.extend(r.id for r in chunk)
+    return sent, [], []
+
+
+def _finish(token: str, rows: list[EventOutbox], sent: list[int], failed: list[tuple[int, str]], unsupported: list[int]) -> None:
+    attempts = {r.id: int(r.attempts or 0) for r in rows}
+    max_attempts = int(rc_get("OUTBOX_MAX_ATTEMPTS", int, settings.OUTBOX_MAX_ATTEMPTS))
+    now = dt.datetime.utcnow()
+    mine = (EventOutbox.id == bindparam("b_id"), EventOutbox.locked_by == token)
+    done: list[dict] = [{"b_id": i, "status": "sent", "attempts": attempts[i], "next_attempt_at": None, "last_error": None} for i in sent]
+    done += [{"b_id": i, "status": "dead", "attempts": attempts[i], "next_attempt_at": None, "last_error": "unsupported event_type/payload"} for i in unsupported]
+    for i, err in failed:
+        n = attempts[i] + 1
+        if n >= max_attempts:
+            # mark as dead after configured attempts
+            done.append({"b_id": i, "status": "dead", "attempts": n, "next_attempt_at": None, "last_error": f"dead after {n} attempts: {err}"})
+        else:
+            backoff = min(3600, 2 ** min(10, n))
+            done.append({"b_id": i, "status": "pending", "attempts": n, "next_attempt_at": now + dt.timedelta(seconds=backoff), "last_error": err})
+    with SessionLocal() as s:
+        if done:
+            # plain executemany keyed on (id, claim token), not an ORM bulk update
+            s.connection().execute(
+                update(EventOutbox).where(*mine).values(
+                    status=bindparam("status"),
+                    attempts=bindparam("attempts"),
+                    next_attempt_at=bindparam("next_attempt_at"),
+                    last_error=bindparam("last_error"),
+                    locked_by=None,
+                    locked_until=None,
+                ),
+                done,
+            )
+        # whatever is left (behind a failure) goes back to the queue untouched
+        s.execute(
+            update(EventOutbox)
+            .where(EventOutbox.locked_by == token)
+            .values(locked_by=None, locked_until=None)
+            .execution_options(synchronize_session=False)
+        )
+        s.commit()
+
+
+def dispatch_once(max_endpoints: Optional[int] = None) -> int:
+    """Claim, send and settle one round of due outbox rows. Returns rows sent."""
+    workers = max(1, int(rc_get("OUTBOX_CONCURRENCY", int, settings.OUTBOX_CONCURRENCY)))
+    per_endpoint = max(1, int(rc_get("OUTBOX_BATCH_SIZE", int, settings.OUTBOX_BATCH_SIZE)))
+    token, rows = claim(max_endpoints or workers, per_endpoint)
+    if not rows:
+        return 0
+    groups: dict[str, list[EventOutbox]] = {}
+    for r in rows:
+        # rows without an endpoint are independent of each other
+        groups.setdefault(r.endpoint if r.endpoint else f"#{r.id}", []).append(r)
+    sent: list[int] = []
+    failed: list[tuple[int, str]] = []
+    unsupported: list[int] = []
+    try:
+        with ThreadPoolExecutor(max_workers=min(workers, len(groups)), thread_name_prefix="outbox") as pool:
+            for ok, bad, skip in pool.map(lambda kv: _send_endpoint(kv[0], kv[1]), groups.items()):
+                sent.extend(ok)
+                failed.extend(bad)
+                unsupported.extend(skip)
+    finally:
+        _finish(token, rows, sent, failed, unsupported)
+    if failed:
+        logger.warning("outbox.dispatch sent=%s failed=%s endpoints=%s", len(sent), len(failed), len(groups))
+    else:
+        logger.info("outbox.dispatch sent=%s endpoints=%s", len(sent), len(groups))
+    return len(sent)
+
+
+def _dead_filters(endpoint: Optional[str], created_from: Optional[dt.datetime], created_to: Optional[dt.datetime], ids: Optional[list[int]]) -> list:
+    f = [EventOutbox.status == "dead"]
+    if endpoint:
+        f.append(EventOutbox.endpoint == endpoint)
+    if created_from is not None:
+        f.append(EventOutbox.created_at >= created_from)
+    if created_to is not None:
+        f.append(EventOutbox.created_at < created_to)
+    if ids:
+        f.append(EventOutbox.id.in_(ids))
+    return f
+
+
+def list_dead(*, endpoint: Optional[str] = None, created_from: Optional[dt.datetime] = None, created_to: Optional[dt.datetime] = None, limit: int = 50, cursor: Optional[str] = None) -> tuple[list[EventOutbox], Optional[str]]:
+    with SessionLocal() as s:
+        q = s.query(EventOutbox).filter(*_dead_filters(endpoint, created_from, created_to, None))
+        return keyset_page(q, EventOutbox.id, limit=limit, cursor=cursor)
+
+
+def replay_dead(*, endpoint: Optional[str] = None, created_from: Optional[dt.datetime] = None, created_to: Optional[dt.datetime] = None, ids: Optional[list[int]] = None) -> int:
+    """Put matching dead rows back in the queue with a fresh attempt budget. Returns rows requeued."""
+    with SessionLocal() as s:
+        n = s.execute(
+            update(EventOutbox)
+            .where(*_dead_filters(endpoint, created_from, created_to, ids))
+            .values(status="pending", attempts=0, next_attempt_at=dt.datetime.utcnow(), last_error=None, locked_by=None, locked_until=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        s.commit()
+    logger.info("outbox.replayed rows=%s endpoint=%s", n, endpoint)
+    return int(n or 0)
+
+
+def archive_sent(older_than_days: Optional[int] = None, *, max_rows: int = 100_000) -> int:
+    """Move sent rows older than the retention window to event_outbox_archive. Returns rows moved."""
+    days = int(rc_get("OUTBOX_RETENTION_DAYS", int, settings.OUTBOX_RETENTION_DAYS)) if older_than_days is None else int(older_than_days)
+    if days <= 0:
+        return 0
+    cutoff = dt.datetime.utcnow() - dt.timedelta(days=days)
+    cols = [EventOutbox.id, EventOutbox.event_type, EventOutbox.payload, EventOutbox.endpoint, EventOutbox.status, EventOutbox.attempts, EventOutbox.created_at]
+    moved = 0
+    while moved < max_rows:
+        with SessionLocal() as s:
+            ids = [
+                i for (i,) in s.execute(
+                    select(EventOutbox.id).where(EventOutbox.status == "sent", EventOutbox.created_at < cutoff).order_by(EventOutbox.id).limit(_ARCHIVE_CHUNK)
+                )
+            ]
+            if not ids:
+                break
+            # one chunk per transaction: copy, then delete exactly the rows copied
+            s.execute(
+                insert(EventOutboxArchive).from_select(
+                    ["id", "event_type", "payload", "endpoint", "status", "attempts", "created_at"],
+                    select(*cols).where(EventOutbox.id.in_(ids)),
+                )
+            )
+            s.execute(delete(EventOutbox).where(EventOutbox.id.in_(ids)).execution_options(synchronize_session=False))
+            s.commit()
+        moved += len(ids)
+    if moved:
+        logger.info("outbox.archived rows=%s older_than_days=%s", moved, days)
+    return moved
+
+
+def destination_stats(window_hours: int = 24) -> list[dict]:
+    """Per endpoint: queue depth, oldest pending age, dead rows, and success rate over the window."""
+    now = dt.datetime.utcnow()
+    since = now - dt.timedelta(hours=max(1, int(window_hours)))
+    o = EventOutbox
+    recent = o.created_at >= since
+    with SessionLocal() as s:
+        rows = s.execute(
+            select(
+                o.endpoint,
+                func.sum(case((o.status == "pending", 1), else_=0)),
+                func.min(case((o.status == "pending", o.created_at))),
+                func.sum(case((o.status == "dead", 1), else_=0)),
+                func.sum(case(((o.status == "sent") & recent, 1), else_=0)),
+                func.sum(case(((o.status == "dead") & recent, 1), else_=0)),
+            ).group_by(o.endpoint)
+        ).all()
+    out: list[dict] = []
+    for endpoint, pending, oldest, dead, sent_w, dead_w in rows:
+        done = int(sent_w or 0) + int(dead_w or 0)
+        out.append({
+            "endpoint": endpoint,
+            "pending": int(pending or 0),
+            "oldest_pending_age_sec": int((now - oldest).total_seconds()) if oldest is not None else None,
+            "dead": int(dead or 0),
+            "sent_in_window": int(sent_w or 0),
+            "dead_in_window": int(dead_w or 0),
+            "success_rate": round(int(sent_w or 0) / done, 4) if done else None,
+        })
+    out.sort(key=lambda r: (-r["pending"], r["endpoint"] or ""))
+    return out
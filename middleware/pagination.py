@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import base64
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from sqlalchemy.orm import Query
+
+from .config import settings
+from .runtime_config import get as rc_get
+
+
+# Keyset pagination for admin list endpoints.
+#
+# Lists are ordered by id descending. Each page carries an opaque cursor holding the
+# last id returned; the next page filters on id < cursor instead of OFFSET, so a deep
+# page costs the same index range scan as the first one. OFFSET stays accepted for
+# existing callers. Totals need a full COUNT(*), so they are opt-out per request and
+# cached per filter set for LIST_TOTAL_CACHE_SEC.
+
+_TOTALS_MAX = 1024
+
+_lock = threading.Lock()
+_totals: dict[tuple, tuple[float, int]] = {}
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(f"id:{int(last_id)}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        prefix, _, value = raw.partition(":")
+        if prefix != "id":
+            raise ValueError
+        return int(value)
+    except Exception:
+        raise ValueError("invalid cursor")
+
+
+def keyset_page(
+    query: Query,
+    id_col,
+    *,
+    limit: int,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    key: Callable[[Any], int] = lambda r: r.id,
+) -> tuple[list, Optional[str]]:
+    """One page of query ordered by id_col descending. Returns (rows, next_cursor).
+
+    next_cursor is None on the last page. cursor takes precedence over offset.
+    """
+    query = query.order_by(id_col.desc())
+    if cursor:
+        query = query.filter(id_col < decode_cursor(cursor))
+    elif offset:
+        query = query.offset(offset)
+    rows = list(query.limit(limit + 1).all())
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(key(rows[-1]))
+
+
+def cached_total(query: Query, *, key: tuple) -> int:
+    """COUNT(*) of query, reused for LIST_TOTAL_CACHE_SEC per key (list name + filters)."""
+    ttl = max(0, int(rc_get("LIST_TOTAL_CACHE_SEC", int, settings.LIST_TOTAL_CACHE_SEC)))
+    now = time.monotonic()
+    if ttl:
+        with _lock:
+            hit = _totals.get(key)
+        if hit is not None and now - hit[0] < ttl:
+            return hit[1]
+    total = int(query.order_by(None).count())
+    if ttl:
+        with _lock:
+            if len(_totals) >= _TOTALS_MAX:
+                for k in [k for k, (at, _) in _totals.items() if now - at >= ttl] or list(_totals):
+                    del _totals[k]
+            _totals[key] = (now, total)
+    return total
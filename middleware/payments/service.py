@@ -1,16 +1,15 @@
 from __future__ import annotations
 
 from contextlib import contextmanager
-from typing import Iterator
+from typing import Callable, Iterator
 
 from sqlalchemy.orm import Session
 import logging
 
 from ..db import SessionLocal
-from ..models import Order, Payment, ProviderEvent, User, Refund
+from ..models import Order, Payment, ProviderEvent, Refund
 from ..wallets import credit_wallet, debit_wallet
 from ..integrations.lago_stub import record_credit, record_payment
-from ..integrations.litellm_stub import update_budget_for_user
 from .registry import provider_registry
 from .types import InitResult, PaymentEvent, RefundResult, PaymentStatus
 from .load_providers import load_default_providers
@@ -79,9 +78,17 @@ def create_checkout(
         return init
 
 
-def process_webhook(*, provider_name: str, headers: dict, body: bytes, request_id: str | None = None) -> PaymentEvent:
+def process_webhook(*, provider_name: str, headers: dict, body: bytes, request_id: str | None = None, event: PaymentEvent | None = None) -> PaymentEvent:
+    """Apply a payment webhook. With event given it was already verified and recorded
+    in provider_events by the webhook intake, so the idempotency insert is skipped.
+
+    Order, payment, wallet and ledger change in one transaction; Lago reporting
+    runs only after it has committed, so no HTTP happens while rows are locked.
+    """
     provider = provider_registry.get(provider_name)
-    event = provider.handle_webhook(headers, body)
+    recorded = event is not None
+    if event is None:
+        event = provider.handle_webhook(headers, body)
     logger.info(
         "service.webhook.received provider=%s event_type=%s order_id=%s provider_txn_id=%s",
         provider.name,
@@ -90,79 +97,97 @@ def process_webhook(*, provider_name: str, headers: dict, body: bytes, request_i
         getattr(event, "provider_txn_id", None),
     )
 
+    after_commit: list[Callable[[], None]] = []
     with session_scope() as s:
-        # idempotency guard
-        pe = ProviderEvent(provider=provider.name, event_id=(event.event_id or event.provider_txn_id), raw=event.raw)
+        _settle(s, provider.name, event, recorded=recorded, request_id=request_id, after_commit=after_commit)
+    for fn in after_commit:
+        try:
+            fn()
+        except Exception as e:
+            logger.warning("service.webhook.side_effect_failed provider=%s order_id=%s err=%s", provider.name, event.order_id, e)
+    return event
+
+
+# orders that were credited (and maybe refunded since): a later payment_succeeded or
+# payment_failed must not move them. A failed order stays open, since providers retry
+# a failed payment intent and may still report it succeeded.
+_FINAL_ORDER_STATUSES = ("succeeded", "refunded")
+
+
+def _settle(s: Session, provider_name: str, event: PaymentEvent, *, recorded: bool, request_id: str | None, after_commit: list[Callable[[], None]]) -> None:
+    # idempotency guard
+    if not recorded:
+        pe = ProviderEvent(provider=provider_name, event_id=(event.event_id or event.provider_txn_id), raw=event.raw)
         s.add(pe)
         try:
             s.flush()
         except Exception:
             # duplicate event id; safe to return existing event semantics
-            logger.info("service.webhook.duplicate provider=%s event_id=%s", provider.name, event.event_id or event.provider_txn_id)
-            return event
-
-        # Find the Order by external order_id
-        order = s.query(Order).filter_by(order_id=event.order_id).first()
-        if order is None:
-            logger.warning("service.webhook.no_order provider=%s order_id=%s", provider.name, event.order_id)
-            return event
-
-        payment = (
-            s.query(Payment)
-            .filter_by(order_id=order.id, provider=provider.name)
-            .order_by(Payment.id.desc())
-            .first()
+            logger.info("service.webhook.duplicate provider=%s event_id=%s", provider_name, event.event_id or event.provider_txn_id)
+            return
+
+    # Find the Order by external order_id; the row lock serializes concurrent events for it
+    order = s.query(Order).filter_by(order_id=event.order_id).with_for_update().first()
+    if order is None:
+        logger.warning("service.webhook.no_order provider=%s order_id=%s", provider_name, event.order_id)
+        return
+
+    payment = (
+        s.query(Payment)
+        .filter_by(order_id=order.id, provider=provider_name)
+        .order_by(Payment.id.desc())
+        .first()
+    )
+    if payment is None:
+        payment = Payment(
+            order_id=order.id,
+            provider=provider_name,
+            provider_txn_id=event.provider_txn_id,
+            amount_cents=event.amount_cents,
+            currency=event.currency,
+            status="processing",
+            raw=event.raw,
         )
-        if payment is None:
-            payment = Payment(
-                order_id=order.id,
-                provider=provider.name,
-                provider_txn_id=event.provider_txn_id,
-                amount_cents=event.amount_cents,
-                currency=event.currency,
-                status="processing",
-                raw=event.raw,
-            )
-            s.add(payment)
-
-        # Update statuses
-        if event.event_type == "payment_succeeded":
-            payment.status = "succeeded"
-            order.status = "succeeded"
-            # Credit user's wallet (by currency). Amount is the top-up value.
-            credit_wallet(user_id=order.user_id, currency=event.currency, amount_cents=event.amount_cents, reason="recharge", meta={"provider": provider.name, "order_id": order.order_id})
-            # Record credit in Lago (stub)
-            record_credit(user_id=order.user_id, currency=event.currency, amount_cents=event.amount_cents, order_id=order.order_id)
-            # Emit payment event to Lago (wallet_topup)
-            try:
-                record_payment(event_type="wallet_topup", provider=provider.name, provider_txn_id=(event.provider_txn_id or ""), order_id=order.order_id, amount_cents=event.amount_cents, currency=event.currency, user_id=order.user_id, team_id=None, status="succeeded", request_id=request_id, meta={})
-            except Exception:
-                pass
-            # Update LiteLLM budgets for the user (stub – decide policy later)
-            u = s.query(User).filter_by(id=order.user_id).first()
-            litellm_user_id = u.litellm_user_id if u else None
-            update_budget_for_user(litellm_user_id=litellm_user_id, max_budget_cents=None, budget_duration=None)
-            logger.info(
-                "service.webhook.succeeded provider=%s order_id=%s amount_cents=%s currency=%s",
-                provider.name,
-                order.order_id,
-                event.amount_cents,
-                event.currency,
-            )
-        elif event.event_type == "payment_failed":
-            payment.status = "failed"
-            order.status = "failed"
-            logger.info("service.webhook.failed provider=%s order_id=%s", provider.name, order.order_id)
-        elif event.event_type == "refunded":
-            payment.status = "refunded"
-            order.status = "refunded"
-            logger.info("service.webhook.refunded provider=%s order_id=%s", provider.name, order.order_id)
-            try:
-                record_payment(event_type="refund", provider=provider.name, provider_txn_id=(event.provider_txn_id or ""), order_id=order.order_id, amount_cents=event.amount_cents, currency=event.currency, user_id=order.user_id, team_id=None, status="refunded", request_id=request_id, meta={})
-            except Exception:
-                pass
-
-        return event
+        s.add(payment)
+
+    # Update statuses
+    if event.event_type == "payment_succeeded":
+        if order.status in _FINAL_ORDER_STATUSES:
+            # already settled by another event (or a retry under a new id), or since
+            # refunded: crediting again would pay the order out twice
+            logger.info("service.webhook.already_settled provider=%s order_id=%s status=%s", provider_name, order.order_id, order.status)
+            return
+        payment.status = "succeeded"
+        order.status = "succeeded"
+        # Credit user's wallet (by currency) in this transaction; the wallet
+        # reports the user for the LiteLLM budget push once it commits.
+        credit_wallet(user_id=order.user_id, currency=event.currency, amount_cents=event.amount_cents, reason="recharge", meta={"provider": provider_name, "order_id": order.order_id}, session=s)
+        user_id, order_id = order.user_id, order.order_id
+        # Record credit in Lago (stub) and emit the wallet_topup payment event
+        after_commit.append(lambda: record_credit(user_id=user_id, currency=event.currency, amount_cents=event.amount_cents, order_id=order_id))
+        after_commit.append(lambda: record_payment(event_type="wallet_topup", provider=provider_name, provider_txn_id=(event.provider_txn_id or ""), order_id=order_id, amount_cents=event.amount_cents, currency=event.currency, user_id=user_id, team_id=None, status="succeeded", request_id=request_id, meta={}))
+        logger.info(
+            "service.webhook.succeeded provider=%s order_id=%s amount_cents=%s currency=%s",
+            provider_name,
+            order.order_id,
+            event.amount_cents,
+            event.currency,
+        )
+    elif event.event_type == "payment_failed":
+        if order.status in _FINAL_ORDER_STATUSES:
+            # a late failure of an earlier attempt; reopening the order would let a
+            # replayed success credit it again
+            logger.info("service.webhook.already_settled provider=%s order_id=%s status=%s", provider_name, order.order_id, order.status)
+            return
+        payment.status = "failed"
+        order.status = "failed"
+        logger.info("service.webhook.failed provider=%s order_id=%s", provider_name, order.order_id)
+    elif event.event_type == "refunded":
+        payment.status = "refunded"
+        order.status = "refunded"
+        logger.info("service.webhook.refunded provider=%s order_id=%s", provider_name, order.order_id)
+        user_id, order_id = order.user_id, order.order_id
+        after_commit.append(lambda: record_payment(event_type="refund", provider=provider_name, provider_txn_id=(event.provider_txn_id or ""), order_id=order_id, amount_cents=event.amount_cents, currency=event.currency, user_id=user_id, team_id=None, status="refunded", request_id=request_id, meta={}))
 
 
 def _find_payment_record(session: Session, *, provider_name: str, provider_txn_id: str | None, order_id: str | None) -> tuple[Order, Payment] | None:
@@ -202,8 +227,8 @@ def refund_payment(*, provider_name: str, provider_txn_id: str | None = None, or
         s.add(r)
         payment.status = "refunded"
         order.status = "refunded"
-        # debit wallet to keep ledger consistent
-        debit_wallet(user_id=order.user_id, currency=payment.currency, amount_cents=refunded_amount, reason="refund", meta={"provider": provider.name, "order_id": order.order_id, "provider_refund_id": res.provider_refund_id})
+        # debit wallet in the same transaction to keep ledger consistent
+        debit_wallet(user_id=order.user_id, currency=payment.currency, amount_cents=refunded_amount, reason="refund", meta={"provider": provider.name, "order_id": order.order_id, "provider_refund_id": res.provider_refund_id}, session=s)
         logger.info(
             "service.refund.ok provider=%s order_id=%s provider_txn_id=%s amount_cents=%s",
             provider.name,
@@ -61,14 +61,15 @@ class StripeProvider:
                 payload=body.decode("utf-8"), sig_header=sig, secret=webhook_secret
             )
             data = event
-            obj = event["data"]["object"]
-            event_type = event["type"]
-            event_id = event.get("id")
         else:
             data = json.loads(body.decode("utf-8"))
-            obj = data.get("data", {}).get("object", {})
-            event_type = data.get("type")
-            event_id = data.get("id")
+        return self.parse_event(data)
+
+    def parse_event(self, data) -> PaymentEvent:
+        """PaymentEvent from an already verified Stripe event (dict or StripeObject)."""
+        obj = data["data"]["object"] if "data" in data else {}
+        event_type = data.get("type")
+        event_id = data.get("id")
 
         if event_type == "payment_intent.succeeded":
             status = "payment_succeeded"
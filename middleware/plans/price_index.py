@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import datetime as dt
+import threading
+from typing import Iterable, Optional
+
+from sqlalchemy.orm import Session
+
+from .. import cache_versions
+from ..models import PriceRule
+
+
+# Compiled model-pattern matcher per (plan_id, unit).
+#
+# Keeps the semantics of the linear scan it replaces: an exact pattern wins, else
+# the first matching wildcard ("prefix*", "*suffix" or "*") by rule id. Exact
+# patterns live in a dict; prefix and suffix patterns in character tries walked
+# along the model name (the suffix trie along the reversed name), so a lookup is
+# O(len(model)) regardless of how many rules a plan has. Rules outside their
+# effective_from/effective_to window are skipped at lookup time.
+
+
+class _Node:
+    __slots__ = ("children", "rules")
+
+    def __init__(self) -> None:
+        self.children: dict[str, _Node] = {}
+        self.rules: list[PriceRule] = []
+
+
+def _insert(root: _Node, key: str, rule: PriceRule) -> None:
+    node = root
+    for ch in key:
+        node = node.children.setdefault(ch, _Node())
+    node.rules.append(rule)
+
+
+def _effective(rule: PriceRule, now: dt.datetime) -> bool:
+    if rule.effective_from is not None and now < rule.effective_from:
+        return False
+    if rule.effective_to is not None and now >= rule.effective_to:
+        return False
+    return True
+
+
+def _first(rules: Iterable[PriceRule], now: dt.datetime) -> Optional[PriceRule]:
+    for r in rules:
+        if _effective(r, now):
+            return r
+    return None
+
+
+class PriceIndex:
+    def __init__(self, rules: Iterable[PriceRule]) -> None:
+        self.exact: dict[str, list[PriceRule]] = {}
+        self.any: list[PriceRule] = []
+        self._prefix = _Node()
+        self._suffix = _Node()
+        self.size = 0
+        for r in sorted(rules, key=lambda r: r.id):
+            p = r.model_pattern or ""
+            self.size += 1
+            if p == "*":
+                self.any.append(r)
+            elif p.endswith("*"):
+                _insert(self._prefix, p[:-1], r)
+            elif p.startswith("*"):
+                _insert(self._suffix, p[:0:-1], r)
+            else:
+                self.exact.setdefault(p, []).append(r)
+
+    def match(self, model: str, *, now: Optional[dt.datetime] = None) -> Optional[PriceRule]:
+        now = now or dt.datetime.utcnow()
+        hit = _first(self.exact.get(model, ()), now)
+        if hit is not None:
+            return hit
+        best = _first(self.any, now)
+        for root, key in ((self._prefix, model), (self._suffix, model[::-1])):
+            node: Optional[_Node] = root
+            i = 0
+            while node is not None:
+                cand = _first(node.rules, now)
+                if cand is not None and (best is None or cand.id < best.id):
+                    best = cand
+                if i == len(key):
+                    break
+                node = node.children.get(key[i])
+                i += 1
+        return best
+
+
+_lock = threading.Lock()
+_indexes: dict[tuple[int, str], tuple[cache_versions.Stamp, PriceIndex]] = {}
+
+
+def get_price_index(session: Session, plan_id: int, unit: str = "token") -> PriceIndex:
+    """Compiled index for the plan's rules; rebuilt once the "plans" cache stamp moves."""
+    key = (plan_id, unit)
+    stamp = cache_versions.stamp("plans")
+    with _lock:
+        cached = _indexes.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    idx = PriceIndex(session.query(PriceRule).filter_by(plan_id=plan_id, unit=unit).all())
+    with _lock:
+        # drop entries from older stamps while here
+        for k in [k for k, (st, _) in _indexes.items() if st != stamp]:
+            del _indexes[k]
+        _indexes[key] = (stamp, idx)
+    return idx
@@ -1,15 +1,22 @@
 from __future__ import annotations
 
 import datetime as dt
+import threading
+import time
 from contextlib import contextmanager
+from dataclasses import dataclass, field
 from typing import Iterator, Optional, Tuple
 
 from sqlalchemy.orm import Session
 
 from ..db import SessionLocal
 from ..runtime_config import get as rc_get
-from ..models import Plan, DailyLimitPlan, UsagePlan, PriceRule, PlanAssignment, Usage, OverdraftAlert
-from sqlalchemy import func
+from ..models import Plan, DailyLimitPlan, UsagePlan, PriceRule, PlanAssignment, OverdraftAlert
+from .. import cache_versions
+from . import spend
+from .price_index import PriceIndex, get_price_index
+from .. import usage_recorder
+from ..pagination import cached_total, keyset_page
 
 
 @contextmanager
@@ -25,6 +32,39 @@ def session_scope() -> Iterator[Session]:
         s.close()
 
 
+# Process-local caches of plan data read on every proxied request. Any write to
+# plans, price rules or assignments bumps the "plans" stamp, which drops them here
+# immediately and in other workers within a poll interval (see cache_versions).
+PLANS_CACHE = "plans"
+
+_cache_lock = threading.Lock()
+_cache_stamp: Optional[cache_versions.Stamp] = None
+_assignment_cache: dict[tuple[str, int], Optional[PlanAssignment]] = {}
+_daily_limit_cache: dict[int, Optional[DailyLimitPlan]] = {}
+_plan_meta_cache: dict[int, dict] = {}
+
+
+def _cache_get(cache: dict, key) -> tuple[cache_versions.Stamp, bool, object]:
+    global _cache_stamp
+    stamp = cache_versions.stamp(PLANS_CACHE)
+    with _cache_lock:
+        if _cache_stamp != stamp:
+            _assignment_cache.clear()
+            _daily_limit_cache.clear()
+            _plan_meta_cache.clear()
+            _cache_stamp = stamp
+        if key in cache:
+            return stamp, True, cache[key]
+    return stamp, False, None
+
+
+def _cache_put(cache: dict, key, value, stamp: cache_versions.Stamp) -> None:
+    # a value loaded under an older stamp may predate the write that bumped it
+    with _cache_lock:
+        if _cache_stamp == stamp:
+            cache[key] = value
+
+
 def create_plan(*, name: str, type: str, currency: str = "USD") -> Plan:
     with session_scope() as s:
         p = Plan(name=name, type=type, currency=currency)
@@ -44,6 +84,7 @@ def upsert_daily_limit(plan_id: int, *, daily_limit_cents: int, overflow_policy:
             dlp.overflow_policy = overflow_policy
             dlp.reset_time = reset_time
             dlp.timezone = timezone
+        cache_versions.bump(PLANS_CACHE, session=s)
         return dlp
 
 
@@ -57,6 +98,7 @@ def upsert_usage_plan(plan_id: int, *, billing_cycle: str = "monthly", min_commi
             up.billing_cycle = billing_cycle
             up.min_commit_cents = min_commit_cents
             up.credit_grant_cents = credit_grant_cents
+        cache_versions.bump(PLANS_CACHE, session=s)
         return up
 
 
@@ -65,6 +107,7 @@ def add_price_rule(plan_id: int, *, model_pattern: str, unit: str, unit_base_pri
         pr = PriceRule(plan_id=plan_id, model_pattern=model_pattern, unit=unit, unit_base_price_cents=unit_base_price_cents, input_multiplier=input_multiplier, output_multiplier=output_multiplier, price_multiplier=price_multiplier, min_charge_cents=min_charge_cents)
         s.add(pr)
         s.flush()
+        cache_versions.bump(PLANS_CACHE, session=s)
         return pr
 
 
@@ -73,6 +116,7 @@ def assign_plan(entity_type: str, entity_id: int, plan_id: int, *, timezone: str
         pa = PlanAssignment(entity_type=entity_type, entity_id=entity_id, plan_id=plan_id, status=status, effective_from=effective_from, effective_to=effective_to, timezone=timezone)
         s.add(pa)
         s.flush()
+        cache_versions.bump(PLANS_CACHE, session=s)
         return pa
 
 
@@ -81,10 +125,19 @@ def get_plan(plan_id: int) -> Optional[Plan]:
         return s.get(Plan, plan_id)
 
 
-def list_plans(*, q: Optional[str] = None, type: Optional[str] = None, status: Optional[str] = None, limit: int = 50, offset: int = 0) -> tuple[list[Plan], int]:
+def list_plans(
+    *,
+    q: Optional[str] = None,
+    type: Optional[str] = None,
+    status: Optional[str] = None,
+    limit: int = 50,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    with_total: bool = True,
+) -> tuple[list[Plan], Optional[int], Optional[str]]:
     """List plans with optional name filter and type filter.
 
-    Returns (rows, total).
+    Returns (rows, total, next_cursor); total is None when with_total is False.
     """
     with session_scope() as s:
         query = s.query(Plan)
@@ -94,9 +147,9 @@ def list_plans(*, q: Optional[str] = None, type: Optional[str] = None, status: O
             query = query.filter(Plan.type == type)
         if status in ("active", "archived"):
             query = query.filter(Plan.status == status)
-        total = query.count()
-        rows = query.order_by(Plan.id.desc()).offset(offset).limit(limit).all()
-        return list(rows), int(total)
+        total = cached_total(query, key=("plans", q, type, status)) if with_total else None
+        rows, next_cursor = keyset_page(query, Plan.id, limit=limit, offset=offset, cursor=cursor)
+        return rows, total, next_cursor
 
 
 def set_plan_status(plan_id: int, *, status: str) -> Plan:
@@ -112,6 +165,7 @@ def set_plan_status(plan_id: int, *, status: str) -> Plan:
             raise ValueError("plan not found")
         p.status = status
         s.flush()
+        cache_versions.bump(PLANS_CACHE, session=s)
         return p
 
 
@@ -121,16 +175,72 @@ def update_plan_meta(plan_id: int, meta: dict) -> None:
         if not p:
             raise ValueError("plan not found")
         p.meta = meta
+        cache_versions.bump(PLANS_CACHE, session=s)
+
+
+def _active_assignment_query(session: Session, entity_type: str, entity_id: int, *entities):
+    return (
+        session.query(*(entities or (PlanAssignment,)))
+        .filter(PlanAssignment.entity_type == entity_type, PlanAssignment.entity_id == entity_id, PlanAssignment.status == "active")
+        .order_by(PlanAssignment.id.desc())
+    )
+
+
+def get_assignment(entity_type: str, entity_id: int, *, session: Optional[Session] = None) -> Optional[PlanAssignment]:
+    """Latest active assignment, served from the versioned process cache."""
+    key = (entity_type, entity_id)
+    stamp, hit, pa = _cache_get(_assignment_cache, key)
+    if hit:
+        return pa  # type: ignore[return-value]
+    if session is not None:
+        pa = _active_assignment_query(session, entity_type, entity_id).first()
+    else:
+        with session_scope() as s:
+            pa = _active_assignment_query(s, entity_type, entity_id).first()
+    _cache_put(_assignment_cache, key, pa, stamp)
+    return pa
+
+
+def get_daily_limit_plan(plan_id: int, *, session: Optional[Session] = None) -> Optional[DailyLimitPlan]:
+    stamp, hit, dlp = _cache_get(_daily_limit_cache, plan_id)
+    if hit:
+        return dlp  # type: ignore[return-value]
+    if session is not None:
+        dlp = session.get(DailyLimitPlan, plan_id)
+    else:
+        with session_scope() as s:
+            dlp = s.get(DailyLimitPlan, plan_id)
+    _cache_put(_daily_limit_cache, plan_id, dlp, stamp)
+    return dlp
+
+
+def get_plan_meta(plan_id: int, *, session: Optional[Session] = None) -> dict:
+    """Plan.meta ({} when unset), served from the versioned process cache."""
+    stamp, hit, meta = _cache_get(_plan_meta_cache, plan_id)
+    if hit:
+        return meta  # type: ignore[return-value]
+    if session is not None:
+        meta = session.query(Plan.meta).filter(Plan.id == plan_id).scalar()
+    else:
+        with session_scope() as s:
+            meta = s.query(Plan.meta).filter(Plan.id == plan_id).scalar()
+    meta = dict(meta or {})
+    _cache_put(_plan_meta_cache, plan_id, meta, stamp)
+    return meta
 
 
-def get_assignment(entity_type: str, entity_id: int) -> Optional[PlanAssignment]:
+def set_assignment_status(assignment_id: int, *, status: str) -> PlanAssignment:
+    """Pause, cancel or re-activate an assignment."""
+    if status not in ("active", "paused", "canceled"):
+        raise ValueError("invalid_status")
     with session_scope() as s:
-        return (
-            s.query(PlanAssignment)
-            .filter_by(entity_type=entity_type, entity_id=entity_id, status="active")
-            .order_by(PlanAssignment.id.desc())
-            .first()
-        )
+        pa = s.get(PlanAssignment, assignment_id)
+        if not pa:
+            raise ValueError("assignment not found")
+        pa.status = status
+        s.flush()
+        cache_versions.bump(PLANS_CACHE, session=s)
+        return pa
 
 
 def utc8_day_start(now: Optional[dt.datetime] = None, hhmm: str = "00:00") -> dt.datetime:
@@ -155,13 +265,8 @@ def _match_pattern(model: str, pattern: str) -> bool:
 
 
 def find_price_rule(session: Session, plan_id: int, model: str, unit: str = "token") -> Optional[PriceRule]:
-    rules = session.query(PriceRule).filter_by(plan_id=plan_id, unit=unit).all()
-    # Prefer exact > prefix/suffix wildcard; keep first match
-    exact = [r for r in rules if _match_pattern(model, r.model_pattern) and r.model_pattern == model]
-    if exact:
-        return exact[0]
-    wildcard = [r for r in rules if _match_pattern(model, r.model_pattern)]
-    return wildcard[0] if wildcard else None
+    # Prefer exact > prefix/suffix wildcard; first matching rule by id (see price_index)
+    return get_price_index(session, plan_id, unit).match(model)
 
 
 def estimate_token_cost_cents(pr: PriceRule, *, input_tokens: int = 0, output_tokens: int = 0, total_tokens: Optional[int] = None) -> int:
@@ -182,7 +287,7 @@ def estimate_token_cost_cents(pr: PriceRule, *, input_tokens: int = 0, output_to
 
 def estimate_cost_for_tokens(user_id: int, *, model: str, input_tokens: int, output_tokens: int, total_tokens: Optional[int] = None) -> Tuple[int, Optional[str]]:
     with session_scope() as s:
-        pa = get_assignment("user", user_id)
+        pa = get_assignment("user", user_id, session=s)
         if not pa:
             return 0, None
         pr = find_price_rule(s, pa.plan_id, model, unit="token")
@@ -192,6 +297,40 @@ def estimate_cost_for_tokens(user_id: int, *, model: str, input_tokens: int, out
         return cents, pa.timezone
 
 
+# Overdraft flags for the current day, so gating does not query overdraft_alerts on
+# every request. A set flag stays set until the day rolls over (alerts are never
+# removed); an unset one is re-read after _OVERDRAFT_RECHECK_SEC so alerts written
+# by other workers still gate within seconds. Alerts written here set it at once.
+_OVERDRAFT_RECHECK_SEC = 5.0
+_OVERDRAFT_MAX_USERS = 100_000
+
+_overdraft_lock = threading.Lock()
+# user_id -> (day start, flag, monotonic time of the read)
+_overdraft_flags: dict[int, tuple[dt.datetime, bool, float]] = {}
+
+
+def _note_overdraft(user_id: int, start: dt.datetime, flag: bool) -> None:
+    with _overdraft_lock:
+        if len(_overdraft_flags) >= _OVERDRAFT_MAX_USERS and user_id not in _overdraft_flags:
+            for uid in [u for u, (st, _f, _t) in _overdraft_flags.items() if st != start]:
+                del _overdraft_flags[uid]
+            if len(_overdraft_flags) >= _OVERDRAFT_MAX_USERS:
+                _overdraft_flags.clear()
+        _overdraft_flags[user_id] = (start, flag, time.monotonic())
+
+
+def _overdraft_today(session: Session, user_id: int) -> bool:
+    start = utc8_day_start(hhmm="00:00")
+    with _overdraft_lock:
+        hit = _overdraft_flags.get(user_id)
+    if hit is not None and hit[0] == start and (hit[1] or time.monotonic() - hit[2] < _OVERDRAFT_RECHECK_SEC):
+        return hit[1]
+    q = session.query(OverdraftAlert).filter(OverdraftAlert.user_id == user_id, OverdraftAlert.created_at >= start)
+    flag = bool(session.query(q.exists()).scalar())
+    _note_overdraft(user_id, start, flag)
+    return flag
+
+
 def has_today_overdraft(user_id: int) -> bool:
     with session_scope() as s:
         start = utc8_day_start(hhmm="00:00")
@@ -222,18 +361,18 @@ def get_degrade_fallback(model: str) -> str:
 
 
 def _today_spend_cents(session: Session, user_id: int, *, reset_time: str = "00:00") -> int:
+    # served from the running counter; the DB is only summed on (re)seed and reconcile
     start = utc8_day_start(hhmm=reset_time)
-    total = session.query(func.coalesce(func.sum(Usage.computed_amount_cents), 0)).filter(Usage.user_id == user_id, Usage.created_at >= start, Usage.currency == "USD").scalar() or 0
-    return int(total)
+    return spend.spent_since(session, user_id, reset_time=reset_time, start=start)
 
 
 def get_daily_limit_status(user_id: int) -> Tuple[Optional[DailyLimitPlan], int, int]:
     """Return (dlp, spent_today_cents, remaining_cents). If no plan/dlp, dlp is None and remaining is a large number."""
     with session_scope() as s:
-        pa = get_assignment("user", user_id)
+        pa = get_assignment("user", user_id, session=s)
         if not pa:
             return None, 0, 10**12
-        dlp = s.get(DailyLimitPlan, pa.plan_id)
+        dlp = get_daily_limit_plan(pa.plan_id, session=s)
         if not dlp:
             return None, 0, 10**12
         spent = _today_spend_cents(s, user_id, reset_time=dlp.reset_time)
@@ -246,40 +385,39 @@ def check_daily_limit(user_id: int, *, add_amount_cents: int, timezone: str = "U
     Returns (allowed, policy, reason, remaining_cents_before).
     """
     with session_scope() as s:
-        pa = get_assignment("user", user_id)
+        pa = get_assignment("user", user_id, session=s)
         if not pa:
             return True, "none", "no plan", 10**12
-        dlp = s.get(DailyLimitPlan, pa.plan_id)
+        dlp = get_daily_limit_plan(pa.plan_id, session=s)
         if not dlp:
             return True, "none", "no daily limit", 10**12
         spent = _today_spend_cents(s, user_id, reset_time=dlp.reset_time)
-        remaining = max(0, int(dlp.daily_limit_cents) - spent)
-        if spent + add_amount_cents <= dlp.daily_limit_cents:
-            return True, dlp.overflow_policy, "within limit", remaining
-        # overflow
-        if dlp.overflow_policy == "block":
-            return False, dlp.overflow_policy, "daily limit exceeded", remaining
-        elif dlp.overflow_policy in ("grace", "degrade"):
-            return True, dlp.overflow_policy, "overflow grace/degrade", remaining
-        return False, dlp.overflow_policy, "exceeded", remaining
+        return _check_limit(dlp, spent, add_amount_cents)
+
+
+def _check_limit(dlp: DailyLimitPlan, spent: int, add_amount_cents: int) -> Tuple[bool, str, Optional[str], int]:
+    remaining = max(0, int(dlp.daily_limit_cents) - spent)
+    if spent + add_amount_cents <= dlp.daily_limit_cents:
+        return True, dlp.overflow_policy, "within limit", remaining
+    # overflow
+    if dlp.overflow_policy == "block":
+        return False, dlp.overflow_policy, "daily limit exceeded", remaining
+    elif dlp.overflow_policy in ("grace", "degrade"):
+        return True, dlp.overflow_policy, "overflow grace/degrade", remaining
+    return False, dlp.overflow_policy, "exceeded", remaining
 
 
 def record_usage_row(user_id: int, *, model: str, input_tokens: int, output_tokens: int, total_tokens: Optional[int], computed_amount_cents: int, request_id: Optional[str]) -> None:
-    with session_scope() as s:
-        u = Usage(
-            user_id=user_id,
-            team_id=None,
-            model=model,
-            unit="token",
-            input_tokens=input_tokens,
-            output_tokens=output_tokens,
-            total_tokens=total_tokens or (input_tokens + output_tokens),
-            computed_amount_cents=computed_amount_cents,
-            currency="USD",
-            success=True,
-            request_id=request_id,
-        )
-        s.add(u)
+    # write-behind: the row is flushed in a batch by usage_recorder
+    usage_recorder.record(
+        user_id=user_id,
+        model=model,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        total_tokens=total_tokens or (input_tokens + output_tokens),
+        computed_amount_cents=computed_amount_cents,
+        request_id=request_id,
+    )
 
 
 def record_overdraft_alert(user_id: int, *, model: str, request_id: Optional[str], overflow_policy: str, final_amount_cents: int, charged_amount_cents: int, remaining_before_cents: int) -> None:
@@ -294,3 +432,124 @@ def record_overdraft_alert(user_id: int, *, model: str, request_id: Optional[str
             remaining_before_cents=remaining_before_cents,
         )
         s.add(a)
+    _note_overdraft(user_id, utc8_day_start(hhmm="00:00"), True)
+
+
+# -----------------------------
+# Per-request billing context
+# -----------------------------
+
+@dataclass
+class BillingContext:
+    """Billing state for one user, loaded once and reused by gating and settlement.
+
+    Replaces the per-step helpers above on the proxy hot path, each of which
+    opened its own session and re-read the assignment.
+    """
+
+    user_id: int
+    assignment: Optional[PlanAssignment] = None
+    daily_limit: Optional[DailyLimitPlan] = None
+    prices: PriceIndex = field(default_factory=lambda: PriceIndex(()))
+    spent_today_cents: int = 0
+    has_overdraft_today: bool = False
+    plan_meta: dict = field(default_factory=dict)
+    api_key_id: Optional[int] = None  # proxy API key the usage is charged to
+
+    @property
+    def remaining_cents(self) -> int:
+        if self.daily_limit is None:
+            return 10**12
+        return max(0, int(self.daily_limit.daily_limit_cents) - self.spent_today_cents)
+
+    def price_rule(self, model: str) -> Optional[PriceRule]:
+        return self.prices.match(model)
+
+    def estimate_cost(self, model: str, *, input_tokens: int, output_tokens: int, total_tokens: Optional[int] = None) -> int:
+        pr = self.price_rule(model)
+        if not pr:
+            return 0
+        return estimate_token_cost_cents(pr, input_tokens=input_tokens, output_tokens=output_tokens, total_tokens=total_tokens)
+
+    def check_daily_limit(self, *, add_amount_cents: int) -> Tuple[bool, str, Optional[str], int]:
+        """Same contract as check_daily_limit(), answered from the loaded state."""
+        if self.assignment is None:
+            return True, "none", "no plan", 10**12
+        if self.daily_limit is None:
+            return True, "none", "no daily limit", 10**12
+        return _check_limit(self.daily_limit, self.spent_today_cents, add_amount_cents)
+
+
+@dataclass
+class UsageSettlement:
+    final_amount_cents: int = 0
+    charged_amount_cents: int = 0
+    overdraft: bool = False
+
+
+def load_billing_context(user_id: int, *, include_overdraft: bool = True, unit: str = "token") -> BillingContext:
+    """Resolve assignment, daily-limit plan, price index and today's spend.
+
+    Everything but the overdraft flag comes from process caches; the session is
+    only used on a cache miss.
+    """
+    ctx = BillingContext(user_id=user_id)
+    with session_scope() as s:
+        if include_overdraft:
+            ctx.has_overdraft_today = _overdraft_today(s, user_id)
+        ctx.assignment = get_assignment("user", user_id, session=s)
+        if ctx.assignment is None:
+            return ctx
+        ctx.daily_limit = get_daily_limit_plan(ctx.assignment.plan_id, session=s)
+        ctx.plan_meta = get_plan_meta(ctx.assignment.plan_id, session=s)
+        ctx.prices = get_price_index(s, ctx.assignment.plan_id, unit)
+        if ctx.daily_limit is not None:
+            ctx.spent_today_cents = _today_spend_cents(s, user_id, reset_time=ctx.daily_limit.reset_time)
+    return ctx
+
+
+def settle_usage(ctx: BillingContext, *, model: str, input_tokens: int, output_tokens: int, total_tokens: Optional[int], request_id: Optional[str]) -> UsageSettlement:
+    """Price final usage, queue the Usage row and record an overdraft alert if needed.
+
+    grace: overflow beyond the remaining allowance is not charged.
+    block: overflow is capped the same way and an OverdraftAlert is recorded.
+    """
+    total_tokens = total_tokens or (input_tokens + output_tokens)
+    result = UsageSettlement(final_amount_cents=ctx.estimate_cost(model, input_tokens=input_tokens, output_tokens=output_tokens, total_tokens=total_tokens))
+    if result.final_amount_cents <= 0:
+        return result
+    result.charged_amount_cents = result.final_amount_cents
+    dlp = ctx.daily_limit
+    if dlp is not None:
+        with session_scope() as s:
+            # the upstream call took a while; pick up spend from concurrent requests
+            ctx.spent_today_cents = _today_spend_cents(s, ctx.user_id, reset_time=dlp.reset_time)
+            remaining = ctx.remaining_cents
+            if dlp.overflow_policy in ("grace", "block") and result.final_amount_cents > remaining:
+                result.charged_amount_cents = max(0, min(result.final_amount_cents, remaining))
+                if dlp.overflow_policy == "block":
+                    result.overdraft = True
+                    s.add(OverdraftAlert(
+                        user_id=ctx.user_id,
+                        model=model,
+                        request_id=request_id,
+                        overflow_policy=dlp.overflow_policy,
+                        final_amount_cents=result.final_amount_cents,
+                        charged_amount_cents=result.charged_amount_cents,
+                        remaining_before_cents=remaining,
+                    ))
+        if result.overdraft:
+            # committed above: gate this user's next request without a re-read
+            _note_overdraft(ctx.user_id, utc8_day_start(hhmm="00:00"), True)
+    usage_recorder.record(
+        user_id=ctx.user_id,
+        model=model,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        total_tokens=total_tokens,
+        computed_amount_cents=result.charged_amount_cents,
+        request_id=request_id,
+        api_key_id=ctx.api_key_id,
+    )
+    ctx.spent_today_cents += result.charged_amount_cents
+    return result
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import datetime as dt
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from ..db import SessionLocal
+from ..models import Usage
+
+
+# Running per-user spend for the current daily-limit window.
+#
+# Counters are keyed by (user_id, reset_time) and remember the window start they
+# were seeded for, so a lookup after the window rolls over reseeds from the usage
+# table once and is O(1) afterwards. Usage written by this process bumps the
+# counter directly; usage written by other workers is folded in by reconcile().
+# Only USD usage counts, matching the daily-limit plans.
+
+logger = logging.getLogger(__name__)
+
+# drop counters for windows older than this (users that went idle)
+_STALE_AFTER = dt.timedelta(days=2)
+_IN_CHUNK = 500
+_LOAD_ATTEMPTS = 3
+
+
+@dataclass
+class _Window:
+    start: dt.datetime
+    cents: int
+
+
+_lock = threading.Lock()
+_counters: dict[int, dict[str, _Window]] = {}
+# bumps that land while a counter is being (re)seeded from the DB: (user_id, reset_time) -> window
+_pending: dict[tuple[int, str], _Window] = {}
+
+
+def _sum_since(session: Session, user_ids: Iterable[int], start: dt.datetime) -> dict[int, int]:
+    ids = list(user_ids)
+    out: dict[int, int] = {}
+    for i in range(0, len(ids), _IN_CHUNK):
+        rows = (
+            session.query(Usage.user_id, func.coalesce(func.sum(Usage.computed_amount_cents), 0))
+            .filter(Usage.user_id.in_(ids[i:i + _IN_CHUNK]), Usage.created_at >= start, Usage.currency == "USD")
+            .group_by(Usage.user_id)
+            .all()
+        )
+        for uid, total in rows:
+            out[int(uid)] = int(total or 0)
+    return out
+
+
+def _load(session: Session, start: dt.datetime, keys: list[tuple[int, str]]) -> dict[int, int]:
+    """DB total plus not-yet-flushed usage for keys' users; starts collecting bumps for keys.
+
+    The buffer is snapshotted (and bump collection started) under the buffer lock,
+    then the table is summed without holding off batch writes; if a batch write
+    began in between, some rows may be in both, so it is retried. After
+    _LOAD_ATTEMPTS collisions batch writes are held off for the SUM instead.
+    """
+    from .. import usage_recorder
+
+    uids = {uid for uid, _ in keys}
+    for _ in range(_LOAD_ATTEMPTS):
+        with usage_recorder.buffer_lock():
+            epoch = usage_recorder.write_epoch()
+            if epoch is not None:
+                pending = usage_recorder.pending_cents(uids, start)
+                _start_collecting(keys, start)
+        if epoch is None:
+            time.sleep(0.005)  # a batch is being written
+            continue
+        totals = _sum_since(session, uids, start)
+        if usage_recorder.write_epoch() == epoch:
+            for uid, cents in pending.items():
+                totals[uid] = totals.get(uid, 0) + cents
+            return totals
+        with _lock:
+            for key in keys:
+                _pending.pop(key, None)
+    with usage_recorder.hold_flush():
+        totals = _sum_since(session, uids, start)
+        with usage_recorder.buffer_lock():
+            for uid, cents in usage_recorder.pending_cents(uids, start).items():
+                totals[uid] = totals.get(uid, 0) + cents
+            _start_collecting(keys, start)
+    return totals
+
+
+def _start_collecting(keys: list[tuple[int, str]], start: dt.datetime) -> None:
+    with _lock:
+        for key in keys:
+            _pending[key] = _Window(start=start, cents=0)
+
+
+def _collect(key: tuple[int, str], start: dt.datetime) -> int:
+    # caller holds _lock
+    p = _pending.pop(key, None)
+    return p.cents if p is not None and p.start == start else 0
+
+
+def spent_since(session: Session, user_id: int, *, reset_time: str, start: dt.datetime) -> int:
+    """Spend of user_id since window start; seeds the counter from the DB on first use."""
+    key = (user_id, reset_time)
+    with _lock:
+        w = _counters.get(user_id, {}).get(reset_time)
+        if w is not None and w.start == start:
+            return w.cents
+    try:
+        total = _load(session, start, [key]).get(user_id, 0)
+    except Exception:
+        with _lock:
+            _pending.pop(key, None)
+        raise
+    with _lock:
+        total += _collect(key, start)
+        _counters.setdefault(user_id, {})[reset_time] = _Window(start=start, cents=total)
+    return total
+
+
+def bump(user_id: Optional[int], amount_cents: int, *, currency: str = "USD", at: Optional[dt.datetime] = None) -> None:
+    """Account a freshly committed Usage row in every live window of the user."""
+    if not user_id or not amount_cents or (currency or "").upper() != "USD":
+        return
+    at = at or dt.datetime.utcnow()
+    with _lock:
+        for w in (_counters.get(user_id) or {}).values():
+            if at >= w.start:
+                w.cents += int(amount_cents)
+        for (uid, _rt), w in _pending.items():
+            if uid == user_id and at >= w.start:
+                w.cents += int(amount_cents)
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _pending.clear()
+
+
+def reconcile(session: Optional[Session] = None) -> int:
+    """Re-read live counters from the usage table; picks up writes from other workers.
+
+    Returns the number of counters that were corrected.
+    """
+    cutoff = dt.datetime.utcnow() - _STALE_AFTER
+    targets: dict[dt.datetime, list[tuple[int, str]]] = {}
+    with _lock:
+        for uid in list(_counters):
+            wins = _counters[uid]
+            for rt in list(wins):
+                if wins[rt].start < cutoff:
+                    del wins[rt]
+                elif (uid, rt) not in _pending:  # skip counters being seeded right now
+                    targets.setdefault(wins[rt].start, []).append((uid, rt))
+            if not wins:
+                del _counters[uid]
+    if not targets:
+        return 0
+    own = session is None
+    s = session or SessionLocal()
+    fixed = 0
+    try:
+        for start, keys in targets.items():
+            try:
+                totals = _load(s, start, keys)
+            except Exception:
+                with _lock:
+                    for key in keys:
+                        _pending.pop(key, None)
+                raise
+            with _lock:
+                for uid, rt in keys:
+                    delta = _collect((uid, rt), start)
+                    w = (_counters.get(uid) or {}).get(rt)
+                    if w is None or w.start != start:
+                        continue
+                    fresh = totals.get(uid, 0) + delta
+                    if fresh != w.cents:
+                        w.cents = fresh
+                        fixed += 1
+    finally:
+        if own:
+            s.close()
+    if fixed:
+        logger.info("spend.reconciled counters=%s corrected=%s", sum(len(k) for k in targets.values()), fixed)
+    return fixed
@@ -0,0 +1,321 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy.exc import OperationalError
+
+from .config import settings
+from .db import SessionLocal
+from .models import Wallet
+from .runtime_config import get as rc_get
+from .wallets import WalletMovement, apply_wallet_movements
+
+
+# Prepaid wallet metering for the chat proxy.
+#
+# Balances live in memory, sharded by user id with one lock per shard. A request
+# places a hold for its estimated cost before it is forwarded and settles the
+# actual cost afterwards; available = balance + unflushed - held. A user whose
+# cached balance is exhausted is rejected without touching the database.
+#
+# A daemon thread writes the net settled amount per user to Wallet/LedgerEntry
+# every PREPAID_FLUSH_MS (one ledger row per user per flush, all in one
+# transaction; if that fails for a reason other than the database being down,
+# users are written one by one and the ones that still fail are dropped and
+# logged) and re-reads cached balances every PREPAID_REFRESH_SEC to pick up
+# top-ups, refunds and spend from other workers. Holds are per process.
+#
+# Amounts are priced in USD cents (the price rules' and usage table's currency).
+# There is no exchange rate here, so a hold in any other currency than the
+# PREPAID_METERING_CURRENCY wallet is refused with CurrencyMismatch rather than
+# debited as if it were the same unit.
+
+logger = logging.getLogger(__name__)
+
+_SHARDS = 64
+_IDLE_EVICT_SEC = 600
+_IN_CHUNK = 500
+PRICE_CURRENCY = "USD"
+
+
+class InsufficientBalance(Exception):
+    pass
+
+
+class CurrencyMismatch(Exception):
+    pass
+
+
+@dataclass
+class _Account:
+    balance: int  # wallet balance as last read/written
+    held: int = 0  # open holds
+    unflushed: int = 0  # settled spend not yet written (<= 0)
+    requests: int = 0  # requests settled into unflushed
+    touched: float = 0.0
+
+    def available(self) -> int:
+        return self.balance + self.unflushed - self.held
+
+
+@dataclass
+class Hold:
+    user_id: int
+    cents: int
+    currency: str = PRICE_CURRENCY
+    settled: bool = False
+
+
+class _Shard:
+    __slots__ = ("lock", "accounts")
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.accounts: dict[int, _Account] = {}
+
+
+_shards = [_Shard() for _ in range(_SHARDS)]
+_flush_lock = threading.Lock()  # serializes flush and refresh
+_wake = threading.Event()
+_thread: Optional[threading.Thread] = None
+_stopping = False
+
+
+def enabled() -> bool:
+    return bool(rc_get("PREPAID_METERING_ENABLED", bool, settings.PREPAID_METERING_ENABLED))
+
+
+def _currency() -> str:
+    return str(rc_get("PREPAID_METERING_CURRENCY", str, settings.PREPAID_METERING_CURRENCY) or "USD").upper()
+
+
+def _shard(user_id: int) -> _Shard:
+    return _shards[user_id % _SHARDS]
+
+
+def _db_balances(user_ids: list[int]) -> dict[int, int]:
+    currency = _currency()
+    out: dict[int, int] = {}
+    with SessionLocal() as s:
+        for i in range(0, len(user_ids), _IN_CHUNK):
+            rows = (
+                s.query(Wallet.user_id, Wallet.balance_cents)
+                .filter(Wallet.user_id.in_(user_ids[i:i + _IN_CHUNK]), Wallet.currency == currency)
+                .all()
+            )
+            for uid, bal in rows:
+                out[int(uid)] = int(bal or 0)
+    return out
+
+
+def _account(user_id: int) -> _Account:
+    """Cached account; loaded from the wallet table on first use."""
+    sh = _shard(user_id)
+    with sh.lock:
+        acc = sh.accounts.get(user_id)
+        if acc is not None:
+            acc.touched = time.monotonic()
+            return acc
+    # a new account has nothing unflushed, so the stored balance is all there is
+    balance = _db_balances([user_id]).get(user_id, 0)
+    with sh.lock:
+        acc = sh.accounts.get(user_id)
+        if acc is None:
+            acc = sh.accounts[user_id] = _Account(balance=balance)
+        acc.touched = time.monotonic()
+        return acc
+
+
+def check(user_id: int) -> None:
+    """Reject a user whose cached balance is exhausted; never queries the database."""
+    sh = _shard(user_id)
+    with sh.lock:
+        acc = sh.accounts.get(user_id)
+        if acc is not None and acc.available() <= 0:
+            raise InsufficientBalance("insufficient balance")
+
+
+def reserve(user_id: int, cents: int, *, currency: str = PRICE_CURRENCY) -> Hold:
+    """Hold estimated cost before forwarding; raises InsufficientBalance or CurrencyMismatch."""
+    cents = max(0, int(cents))
+    currency = (currency or "").upper()
+    wallet_currency = _currency()
+    if currency != wallet_currency:
+        raise CurrencyMismatch(f"prepaid wallets are in {wallet_currency}, cost is priced in {currency}")
+    acc = _account(user_id)
+    sh = _shard(user_id)
+    with sh.lock:
+        avail = acc.available()
+        if avail <= 0 or cents > avail:
+            raise InsufficientBalance("insufficient balance")
+        acc.held += cents
+    return Hold(user_id=user_id, cents=cents, currency=currency)
+
+
+def release(hold: Optional[Hold]) -> None:
+    """Drop a hold without charging (upstream failed, nothing consumed)."""
+    settle(hold, 0)
+
+
+def settle(hold: Optional[Hold], actual_cents: int) -> None:
+    """Replace the hold by the actual cost; written to the wallet by the next flush."""
+    if hold is None or hold.settled:
+        return
+    hold.settled = True
+    if actual_cents > 0 and hold.currency != _currency():
+        # PREPAID_METERING_CURRENCY changed while the request was in flight
+        logger.error("prepaid.currency_changed user_id=%s cents=%s hold_currency=%s; not charged", hold.user_id, actual_cents, hold.currency)
+        actual_cents = 0
+    sh = _shard(hold.user_id)
+    with sh.lock:
+        acc = sh.accounts.get(hold.user_id)
+        if acc is None:  # evicted meanwhile; cannot happen while held, but stay safe
+            acc = sh.accounts[hold.user_id] = _Account(balance=0)
+        acc.held = max(0, acc.held - hold.cents)
+        if actual_cents > 0:
+            acc.unflushed -= int(actual_cents)
+            acc.requests += 1
+        acc.touched = time.monotonic()
+
+
+def flush() -> int:
+    """Write settled spend to Wallet/LedgerEntry in one transaction. Returns users written."""
+    with _flush_lock:
+        taken: list[tuple[int, int, int]] = []  # (user_id, cents, requests)
+        for sh in _shards:
+            with sh.lock:
+                for uid, acc in sh.accounts.items():
+                    if acc.unflushed:
+                        taken.append((uid, acc.unflushed, acc.requests))
+                        acc.balance += acc.unflushed
+                        acc.unflushed = 0
+                        acc.requests = 0
+        if not taken:
+            return 0
+        currency = _currency()
+        movements = [WalletMovement(uid, currency, cents, "usage", {"source": "prepaid", "requests": n}) for uid, cents, n in taken]
+        try:
+            written = list(zip(taken, apply_wallet_movements(movements)))
+        except OperationalError:
+            # database unavailable: keep everything for the next flush
+            _restore(taken)
+            raise
+        except Exception as e:
+            logger.error("prepaid.flush_batch_failed users=%s err=%s; writing one by one", len(taken), e)
+            written = _flush_each(taken, movements)
+        # adopt the stored balance: it includes top-ups and other workers' spend
+        for (uid, _cents, _n), bal in written:
+            sh = _shard(uid)
+            with sh.lock:
+                acc = sh.accounts.get(uid)
+                if acc is not None:
+                    acc.balance = bal
+        logger.debug("prepaid.flushed users=%s", len(written))
+        return len(written)
+
+
+def _restore(taken: list[tuple[int, int, int]]) -> None:
+    for uid, cents, n in taken:
+        sh = _shard(uid)
+        with sh.lock:
+            acc = sh.accounts.get(uid)
+            if acc is not None:
+                acc.balance -= cents
+                acc.unflushed += cents
+                acc.requests += n
+
+
+def _flush_each(taken: list[tuple[int, int, int]], movements: list[WalletMovement]) -> list[tuple[tuple[int, int, int], int]]:
+    """Write movements one per transaction so one bad user cannot hold back the rest.
+
+    A movement that fails on its own (no user or wallet row) is dropped and
+    logged; one that fails because the database is unavailable is kept.
+    """
+    written: list[tuple[tuple[int, int, int], int]] = []
+    for t, m in zip(taken, movements):
+        try:
+            (bal,) = apply_wallet_movements([m])
+        except OperationalError:
+            _restore([t])
+            continue
+        except Exception as e:
+            uid, cents, n = t
+            logger.error("prepaid.movement_dropped user_id=%s cents=%s requests=%s err=%s", uid, cents, n, e)
+            continue
+        written.append((t, bal))
+    return written
+
+
+def refresh() -> int:
+    """Re-read cached balances from the wallet table and evict idle accounts. Returns accounts refreshed."""
+    now = time.monotonic()
+    with _flush_lock:
+        uids: list[int] = []
+        for sh in _shards:
+            with sh.lock:
+                for uid in [u for u, a in sh.accounts.items() if not a.held and not a.unflushed and now - a.touched > _IDLE_EVICT_SEC]:
+                    del sh.accounts[uid]
+                uids.extend(sh.accounts)
+        if not uids:
+            return 0
+        fresh = _db_balances(uids)
+        for uid in uids:
+            sh = _shard(uid)
+            with sh.lock:
+                acc = sh.accounts.get(uid)
+                if acc is not None:
+                    acc.balance = fresh.get(uid, 0)
+        return len(uids)
+
+
+def _run() -> None:
+    backoff = 0.0
+    last_refresh = time.monotonic()
+    while not _stopping:
+        interval = max(50, int(rc_get("PREPAID_FLUSH_MS", int, settings.PREPAID_FLUSH_MS))) / 1000.0
+        _wake.wait(timeout=max(interval, backoff))
+        _wake.clear()
+        try:
+            flush()
+            refresh_sec = max(1, int(rc_get("PREPAID_REFRESH_SEC", int, settings.PREPAID_REFRESH_SEC)))
+            if time.monotonic() - last_refresh >= refresh_sec:
+                refresh()
+                last_refresh = time.monotonic()
+            backoff = 0.0
+        except Exception as e:
+            backoff = min(30.0, (backoff or 0.5) * 2)
+            logger.error("prepaid.flush_failed err=%s retry_in=%.1fs", e, backoff)
+
+
+def start() -> None:
+    # started even while metering is off: it can be switched on at runtime, and
+    # settle() leaves all wallet writes to this thread
+    global _thread, _stopping
+    if _thread is not None:
+        return
+    _stopping = False
+    _thread = threading.Thread(target=_run, name="prepaid-flusher", daemon=True)
+    _thread.start()
+
+
+def stop(timeout: float = 10.0) -> None:
+    """Stop the flusher and write everything still settled in memory."""
+    global _thread, _stopping
+    t = _thread
+    if t is None:
+        return
+    _stopping = True
+    _wake.set()
+    t.join(timeout)
+    _thread = None
+    flush()
+
+
+def reset() -> None:
+    for sh in _shards:
+        with sh.lock:
+            sh.accounts.clear()
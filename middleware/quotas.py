@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass, field
+from typing import NamedTuple, Optional
+
+from .models import ApiKey
+from .ratelimit import Decision, get_limiter
+
+
+# Per-minute request (RPM), token (TPM) and cost limits for the chat proxy.
+#
+# Limits come from the caller's ApiKey (rpm_limit, tpm_limit, cost_per_minute_cents)
+# and from the user's plan (the same keys in Plan.meta); each is counted in its own
+# scope, key:<id> and user:<id>, on the configured rate-limit backend. Before
+# forwarding, a request is pre-charged one request, its estimated tokens and its
+# estimated cost; an estimate above a limit is charged as the whole limit so one
+# large request can still pass an idle window. Once the upstream answers the token
+# and cost charges are corrected to the reported usage (zero when a stream reports
+# none) while the request stays counted; only a failed upstream call gives the
+# whole charge back.
+
+WINDOW_SEC = 60
+
+_OUTPUT_TOKENS_GUESS = 256  # pre-charge when the caller gives no output hint
+_DIMENSIONS = (("requests", "rpm"), ("tokens", "tpm"), ("cost", "cost_cents"))
+_HEADER_NAMES = {"requests": "Requests", "tokens": "Tokens", "cost": "Cost-Cents"}
+
+
+class Limits(NamedTuple):
+    rpm: Optional[int] = None
+    tpm: Optional[int] = None
+    cost_cents: Optional[int] = None
+
+    def __bool__(self) -> bool:
+        return any(v is not None for v in self)
+
+
+def _positive(v) -> Optional[int]:
+    try:
+        v = int(v)
+    except (TypeError, ValueError):
+        return None
+    return v if v > 0 else None
+
+
+def limits_from_meta(meta: Optional[dict]) -> Limits:
+    meta = meta or {}
+    return Limits(_positive(meta.get("rpm_limit")), _positive(meta.get("tpm_limit")), _positive(meta.get("cost_per_minute_cents")))
+
+
+def limits_for_key(key: Optional[ApiKey]) -> Limits:
+    if key is None:
+        return Limits()
+    return Limits(_positive(key.rpm_limit), _positive(key.tpm_limit), _positive(key.cost_per_minute_cents))
+
+
+def estimate_tokens(messages: list[dict], *, input_tokens: Optional[int] = None, output_tokens: Optional[int] = None) -> tuple[int, int]:
+    """(input, output) tokens to pre-charge: the caller's hints, else ~4 characters per token."""
+    if input_tokens is None:
+        chars = sum(len(str(m.get("content") or "")) for m in messages if isinstance(m, dict))
+        input_tokens = chars // 4 + 4 * len(messages)
+    if output_tokens is None:
+        output_tokens = _OUTPUT_TOKENS_GUESS
+    return max(0, int(input_tokens)), max(0, int(output_tokens))
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, dimension: str, decision: Decision, headers: dict[str, str]) -> None:
+        super().__init__(f"rate limit exceeded: {dimension} per minute")
+        self.dimension = dimension
+        self.decision = decision
+        self.headers = headers
+
+
+@dataclass
+class Charge:
+    tokens: int
+    cents: int
+    # (ident, dimension, amount added)
+    entries: list[tuple[str, str, int]] = field(default_factory=list)
+    # tightest decision per dimension, for the response headers
+    decisions: dict[str, Decision] = field(default_factory=dict)
+    settled: bool = False
+
+
+def _amounts(tokens: int, cents: int) -> dict[str, int]:
+    return {"requests": 1, "tokens": tokens, "cost": cents}
+
+
+def _note(decisions: dict[str, Decision], dimension: str, d: Decision) -> None:
+    cur = decisions.get(dimension)
+    if cur is None or d.remaining < cur.remaining:
+        decisions[dimension] = d
+
+
+def precharge(scopes: list[tuple[str, Limits]], *, tokens: int, cents: int) -> Optional[Charge]:
+    """Charge one request plus estimated tokens/cost to every limited scope.
+
+    Returns None when no scope has limits; raises QuotaExceeded (nothing charged).
+    """
+    scopes = [(scope, lim) for scope, lim in scopes if lim]
+    if not scopes:
+        return None
+    limiter = get_limiter()
+    now = time.time()
+    charge = Charge(tokens=int(tokens), cents=int(cents))
+    amounts = _amounts(charge.tokens, charge.cents)
+    for scope, lim in scopes:
+        for dimension, attr in _DIMENSIONS:
+            limit = getattr(lim, attr)
+            if limit is None:
+                continue
+            ident = f"{dimension}:{scope}"
+            amount = min(amounts[dimension], limit)
+            d = limiter.hit(ident, limit, WINDOW_SEC, now, amount)
+            if not d.allowed:
+                release(charge)
+                decisions = dict(charge.decisions)
+                _note(decisions, dimension, d)
+                raise QuotaExceeded(dimension, d, _headers(decisions, retry_after=d.retry_after))
+            charge.entries.append((ident, dimension, amount))
+            _note(charge.decisions, dimension, d)
+    return charge
+
+
+def settle(charge: Optional[Charge], *, tokens: int, cents: int) -> None:
+    """Replace the estimated tokens/cost by the actual ones; the request stays counted."""
+    if charge is None or charge.settled:
+        return
+    charge.settled = True
+    limiter = get_limiter()
+    now = time.time()
+    actual = _amounts(int(tokens), int(cents))
+    for ident, dimension, amount in charge.entries:
+        delta = actual[dimension] - amount
+        if dimension == "requests" or not delta:
+            continue
+        limiter.adjust(ident, WINDOW_SEC, now, delta)
+        d = charge.decisions.get(dimension)
+        if d is not None:
+            charge.decisions[dimension] = d._replace(remaining=max(0, d.remaining - delta))
+
+
+def release(charge: Optional[Charge]) -> None:
+    """Give the whole charge back (the upstream call failed, nothing was consumed)."""
+    if charge is None or charge.settled:
+        return
+    charge.settled = True
+    limiter = get_limiter()
+    now = time.time()
+    for ident, _dimension, amount in charge.entries:
+        limiter.adjust(ident, WINDOW_SEC, now, -amount)
+
+
+def _headers(decisions: dict[str, Decision], *, retry_after: Optional[int] = None) -> dict[str, str]:
+    out: dict[str, str] = {}
+    for dimension, d in decisions.items():
+        name = _HEADER_NAMES[dimension]
+        out[f"X-RateLimit-Limit-{name}"] = str(d.limit)
+        out[f"X-RateLimit-Remaining-{name}"] = str(d.remaining)
+        out[f"X-RateLimit-Reset-{name}"] = str(d.reset_at)
+    if retry_after is not None:
+        out["Retry-After"] = str(retry_after)
+    return out
+
+
+def headers(charge: Optional[Charge]) -> dict[str, str]:
+    """X-RateLimit-{Limit,Remaining,Reset}-{Requests,Tokens,Cost-Cents} for the tightest scope."""
+    return _headers(charge.decisions) if charge is not None else {}
@@ -0,0 +1,326 @@
+from __future__ import annotations
+
+import abc
+import datetime as dt
+import hashlib
+import logging
+import math
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, NamedTuple, Optional
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from .config import settings
+from .db import SessionLocal
+from .models import RateLimitCounter
+from .runtime_config import get as rc_get
+
+logger = logging.getLogger(__name__)
+
+
+# Request rate limiting for the HTTP middleware.
+#
+# Sliding-window counter: per identity we keep only the current fixed window's
+# index and count plus the previous window's count, and estimate the requests in
+# the last `window` seconds as prev * (1 - elapsed / window) + curr. A check is
+# O(1) whatever the limit.
+#
+# RATE_LIMIT_BACKEND picks where the counters live:
+#   memory  per process, in an LRU of at most RATE_LIMIT_MAX_IDENTITIES entries
+#           (N workers allow N times the limit)
+#   shm     a shared-memory table used by all workers on the host
+#   sql     the rate_limit_counters table, shared by all hosts
+# All backends return the same Decision, so responses carry the same headers.
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    reset_at: int  # epoch seconds at which the current window ends
+    retry_after: int = 0  # seconds; set when not allowed
+
+
+def _roll(idx: int, entry_idx: int, curr: int, prev: int) -> tuple[int, int]:
+    """(curr, prev) for window idx, given counts last written in window entry_idx."""
+    if entry_idx == idx:
+        return curr, prev
+    # the old count only carries over into the next window
+    return 0, (curr if entry_idx == idx - 1 else 0)
+
+
+def _decide(limit: int, window: int, now: float, curr: int, prev: int, cost: int = 1) -> Decision:
+    idx = int(now // window)
+    elapsed = now - idx * window
+    reset_at = (idx + 1) * window
+    used = prev * (1.0 - elapsed / window) + curr
+    if used + cost > limit:
+        return Decision(False, limit, max(0, int(limit - used)), reset_at, _retry_after(limit, window, elapsed, curr, prev, cost))
+    return Decision(True, limit, max(0, int(limit - used - cost)), reset_at)
+
+
+def _retry_after(limit: int, window: int, elapsed: float, curr: int, prev: int, cost: int = 1) -> int:
+    """Seconds until the estimate leaves room for cost more."""
+    if curr + cost > limit or prev <= 0:
+        # the current window alone is full: wait for it to end
+        return max(1, math.ceil(window - elapsed))
+    # prev * (1 - t / window) + curr <= limit - cost
+    t = window * (1.0 - (limit - cost - curr) / prev)
+    return max(1, math.ceil(t - elapsed))
+
+
+def _key_hash(ident: str) -> int:
+    # stable across processes (hash() is salted per interpreter); 0 marks a free slot
+    return int.from_bytes(hashlib.blake2b(ident.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+
+class _Limiter(abc.ABC):
+    blocking = False  # True when hit/adjust do I/O and should run off the event loop
+
+    @abc.abstractmethod
+    def _apply(self, ident: str, window: int, now: float, op: Callable[[int, int], tuple[int, Any]]) -> Any:
+        """Atomically replace ident's current-window count by op(curr, prev)[0]; returns op's [1]."""
+
+    def hit(self, ident: str, limit: int, window: int, now: float, cost: int = 1) -> Decision:
+        """Count cost (1 = one request) for ident unless it would exceed limit per window seconds."""
+
+        def op(curr: int, prev: int) -> tuple[int, Decision]:
+            d = _decide(limit, window, now, curr, prev, cost)
+            return (curr + cost if d.allowed else curr), d
+
+        return self._apply(ident, window, now, op)
+
+    def adjust(self, ident: str, window: int, now: float, delta: int) -> None:
+        """Correct an earlier hit by delta (negative gives back); the count never drops below 0."""
+        if delta:
+            self._apply(ident, window, now, lambda curr, prev: (max(0, curr + delta), None))
+
+
+class SlidingWindowLimiter(_Limiter):
+    """In-process limiter; thread-safe."""
+
+    def __init__(self, max_identities: int = 100_000) -> None:
+        self.max_identities = max(1, int(max_identities))
+        self._lock = threading.Lock()
+        # ident -> [window index, count in that window, count in the window before]
+        self._entries: OrderedDict[str, list[int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _apply(self, ident: str, window: int, now: float, op: Callable[[int, int], tuple[int, Any]]) -> Any:
+        idx = int(now // window)
+        with self._lock:
+            entry = self._entries.get(ident)
+            if entry is None:
+                entry = self._entries[ident] = [idx, 0, 0]
+                if len(self._entries) > self.max_identities:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(ident)
+                if entry[0] != idx:
+                    entry[1], entry[2] = _roll(idx, entry[0], entry[1], entry[2])
+                    entry[0] = idx
+            entry[1], res = op(entry[1], entry[2])
+        return res
+
+    def reset(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedMemoryLimiter(_Limiter):
+    """Limiter shared by the worker processes of one host.
+
+    Counters live in a fixed table of RATE_LIMIT_SHM_SLOTS slots in a named
+    shared-memory segment, each slot (key hash, window index, curr, prev) with
+    64-bit counts, since token and cent weights outgrow 32 bits. A key
+    probes _PROBE slots from hash % slots; when none is free or its own, the
+    slot with the oldest window is taken over. Slots are guarded by striped
+    fcntl byte-range locks on a lock file, plus a thread lock per stripe since
+    fcntl locks are per process.
+    """
+
+    _SLOT = struct.Struct("<Qqqq")
+    _MAX_COUNT = 2**63 - 1
+    _PROBE = 8
+    _STRIPES = 64
+
+    def __init__(self, name: str = "rabbit_ratelimit", slots: int = 65536) -> None:
+        import fcntl  # POSIX only
+        from multiprocessing import resource_tracker, shared_memory
+
+        self._fcntl = fcntl
+        self.slots = -(-max(1, int(slots)) // self._PROBE) * self._PROBE
+        size = self.slots * self._SLOT.size
+        # the slot size is part of the name: workers of a release with another
+        # layout must not attach to this segment
+        name = f"{name}_{self._SLOT.size}"
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            # keep the segment when the creating worker exits; the others still use it
+            resource_tracker.unregister(self._shm._name, "shared_memory")  # type: ignore[attr-defined]
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self._shm._name, "shared_memory")  # type: ignore[attr-defined]
+            if self._shm.size < size:
+                raise RuntimeError(f"shared memory {name} has {self._shm.size} bytes, need {size}")
+        self._buf = self._shm.buf
+        self._lock_fd = os.open(os.path.join(tempfile.gettempdir(), f"{name}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        self._tlocks = [threading.Lock() for _ in range(self._STRIPES)]
+
+    @contextmanager
+    def _locked(self, stripe: int) -> Iterator[None]:
+        with self._tlocks[stripe]:
+            self._fcntl.lockf(self._lock_fd, self._fcntl.LOCK_EX, 1, stripe)
+            try:
+                yield
+            finally:
+                self._fcntl.lockf(self._lock_fd, self._fcntl.LOCK_UN, 1, stripe)
+
+    def _apply(self, ident: str, window: int, now: float, op: Callable[[int, int], tuple[int, Any]]) -> Any:
+        h = _key_hash(ident)
+        idx = int(now // window)
+        # all probes of a key stay in the stripe of its home slot
+        home = h % self.slots
+        base = home - home % self._PROBE
+        slot_of = self._SLOT
+        with self._locked((base // self._PROBE) % self._STRIPES):
+            target, oldest, oldest_idx = None, base, None
+            for off in range(self._PROBE):
+                slot = base + (home + off) % self._PROBE
+                key, w_idx, _c, _p = slot_of.unpack_from(self._buf, slot * slot_of.size)
+                if key == h or key == 0:
+                    target = slot
+                    break
+                if oldest_idx is None or w_idx < oldest_idx:
+                    oldest, oldest_idx = slot, w_idx
+            if target is None:
+                target = oldest
+            off = target * slot_of.size
+            key, w_idx, curr, prev = slot_of.unpack_from(self._buf, off)
+            curr, prev = _roll(idx, w_idx, curr, prev) if key == h else (0, 0)
+            curr, res = op(curr, prev)
+            slot_of.pack_into(self._buf, off, h, idx, min(max(0, curr), self._MAX_COUNT), prev)
+        return res
+
+    def reset(self) -> None:
+        self._buf[:] = bytes(len(self._buf))
+
+    def close(self) -> None:
+        self._buf = None
+        self._shm.close()
+        os.close(self._lock_fd)
+
+
+class SqlLimiter(_Limiter):
+    """Limiter shared by all hosts through the rate_limit_counters table.
+
+    Each check is one short transaction that locks the identity's row before
+    reading it. The lock is taken with a no-op UPDATE rather than SELECT .. FOR
+    UPDATE, which SQLite ignores: there the UPDATE takes the database write lock,
+    so concurrent checks queue instead of overwriting each other's counts. Rows
+    untouched for a day are pruned at most once per _PRUNE_SEC per process.
+    """
+
+    blocking = True  # runs a DB round trip; call it off the event loop
+
+    _PRUNE_SEC = 600
+
+    def __init__(self) -> None:
+        self._pruned_at = time.monotonic()
+
+    def _apply(self, ident: str, window: int, now: float, op: Callable[[int, int], tuple[int, Any]]) -> Any:
+        key = f"{_key_hash(ident):016x}"
+        idx = int(now // window)
+        for attempt in range(2):
+            with SessionLocal() as s:
+                s.execute(
+                    update(RateLimitCounter)
+                    .where(RateLimitCounter.key == key)
+                    .values(key=RateLimitCounter.key)
+                    .execution_options(synchronize_session=False)
+                )
+                row = s.query(RateLimitCounter).filter_by(key=key).first()
+                if row is None:
+                    curr, prev = 0, 0
+                else:
+                    curr, prev = _roll(idx, int(row.window_idx), int(row.curr_count), int(row.prev_count))
+                curr, res = op(curr, prev)
+                values = {"window_idx": idx, "curr_count": curr, "prev_count": prev, "updated_at": dt.datetime.utcnow()}
+                if row is None:
+                    s.add(RateLimitCounter(key=key, **values))
+                else:
+                    for k, v in values.items():
+                        setattr(row, k, v)
+                try:
+                    s.commit()
+                except IntegrityError:
+                    # first hit raced another worker's insert: retry against its row
+                    s.rollback()
+                    if attempt:
+                        raise
+                    continue
+            break
+        if time.monotonic() - self._pruned_at > self._PRUNE_SEC:
+            self._pruned_at = time.monotonic()
+            self.prune()
+        return res
+
+    def prune(self, max_age_sec: int = 86400) -> int:
+        cutoff = dt.datetime.utcnow() - dt.timedelta(seconds=max_age_sec)
+        with SessionLocal() as s:
+            n = s.query(RateLimitCounter).filter(RateLimitCounter.updated_at < cutoff).delete(synchronize_session=False)
+            s.commit()
+        return int(n or 0)
+
+    def reset(self) -> None:
+        with SessionLocal() as s:
+            s.query(RateLimitCounter).delete(synchronize_session=False)
+            s.commit()
+
+
+BACKENDS = ("memory", "shm", "sql")
+
+_limiter_lock = threading.Lock()
+_limiter: Optional[tuple[str, object]] = None
+
+
+def get_limiter():
+    """Limiter for the configured RATE_LIMIT_BACKEND; shm falls back to memory if unavailable."""
+    global _limiter
+    backend = str(rc_get("RATE_LIMIT_BACKEND", str, settings.RATE_LIMIT_BACKEND) or "memory").lower()
+    cur = _limiter
+    if cur is not None and cur[0] == backend:
+        limiter = cur[1]
+    else:
+        with _limiter_lock:
+            cur = _limiter
+            if cur is None or cur[0] != backend:
+                if backend == "sql":
+                    limiter = SqlLimiter()
+                elif backend == "shm":
+                    try:
+                        limiter = SharedMemoryLimiter(
+                            rc_get("RATE_LIMIT_SHM_NAME", str, settings.RATE_LIMIT_SHM_NAME) or "rabbit_ratelimit",
+                            int(rc_get("RATE_LIMIT_SHM_SLOTS", int, settings.RATE_LIMIT_SHM_SLOTS)),
+                        )
+                    except Exception as e:
+                        logger.error("ratelimit.shm_unavailable err=%s fallback=memory", e)
+                        limiter = SlidingWindowLimiter(settings.RATE_LIMIT_MAX_IDENTITIES)
+                else:
+                    limiter = SlidingWindowLimiter(settings.RATE_LIMIT_MAX_IDENTITIES)
+                # a replaced limiter is not closed: requests in flight may still hold it
+                _limiter = (backend, limiter)
+            else:
+                limiter = cur[1]
+    if isinstance(limiter, SlidingWindowLimiter):
+        limiter.max_identities = max(1, int(rc_get("RATE_LIMIT_MAX_IDENTITIES", int, settings.RATE_LIMIT_MAX_IDENTITIES)))
+    return limiter
@@ -1,12 +1,18 @@
 from __future__ import annotations
 
+import logging
 import os
+import threading
 import time
-from typing import Any, Callable
+from types import MappingProxyType
+from typing import Any, Callable, Optional
 from sqlalchemy import text
 
+from . import cache_versions
 from .db import SessionLocal
 
+logger = logging.getLogger(__name__)
+
 
 # Keys that must only come from environment variables
 PROTECTED_ENV_KEYS = {"DATABASE_URL", "DEV_API_KEY"}
@@ -27,35 +33,114 @@ SENSITIVE_KEYS = {
 }
 
 
-_cache: dict[str, str] = {}
-_cache_loaded_at: float = 0.0
+# Settings are served from an immutable snapshot of the settings table. Each
+# snapshot memoizes the coerced value per (key, type), so a hot-path get() is two
+# dict lookups. A daemon thread swaps in a new snapshot when the "settings" stamp
+# in cache_versions moves (PATCH /v1/settings bumps it in its transaction, so every
+# worker reloads within about a second) or, as a safety net for direct DB edits,
+# after RUNTIME_CONFIG_TTL_SEC. Without the thread (scripts, tests) get() checks
+# the stamp itself, which reads the DB at most once per poll interval.
+
+SETTINGS_CACHE = "settings"
+
+_MISSING = object()
 _cache_ttl_sec: int = int(os.getenv("RUNTIME_CONFIG_TTL_SEC", "60") or "60")
 
 
+class _Snapshot:
+    __slots__ = ("values", "stamp", "loaded_at", "strict", "_typed")
+
+    def __init__(self, values: dict[str, str], stamp: cache_versions.Stamp) -> None:
+        self.values = MappingProxyType(values)
+        self.stamp = stamp
+        self.loaded_at = time.monotonic()
+        self.strict = os.getenv("STRICT_DB_MODE", "0") in ("1", "true", "True")
+        self._typed: dict[tuple[str, type], Any] = {}
+
+    def lookup(self, key: str, type_: type) -> Any:
+        """Coerced value for key, or _MISSING when the caller's default applies."""
+        memo = self._typed.get((key, type_), _MISSING)
+        if memo is _MISSING:
+            memo = self._typed[(key, type_)] = _resolve(self.values, key, type_, self.strict)
+        return memo
+
+
+_snapshot: Optional[_Snapshot] = None
+_load_lock = threading.Lock()
+_wake = threading.Event()
+_thread: Optional[threading.Thread] = None
+_stopping = False
+
+
 def _load_all_from_db() -> dict[str, str]:
-    global _cache_loaded_at
     with SessionLocal() as s:
         rows = s.execute(text("SELECT key, value FROM settings")).fetchall()
         data: dict[str, str] = {}
         for k, v in rows:
             # normalize to string, None -> empty
             data[str(k)] = "" if v is None else str(v)
-    _cache_loaded_at = time.time()
     return data
 
 
-def _ensure_cache() -> None:
-    now = time.time()
-    if not _cache or (now - _cache_loaded_at) > _cache_ttl_sec:
-        _cache.clear()
-        _cache.update(_load_all_from_db())
+def reload() -> _Snapshot:
+    """Build a new snapshot from the settings table and swap it in."""
+    global _snapshot
+    with _load_lock:
+        stamp = cache_versions.stamp(SETTINGS_CACHE)  # taken first: a bump during the load triggers another
+        snap = _Snapshot(_load_all_from_db(), stamp)
+        _snapshot = snap
+    return snap
+
+
+def _current() -> _Snapshot:
+    snap = _snapshot
+    if snap is None:
+        return reload()
+    if _thread is None and (
+        cache_versions.stamp(SETTINGS_CACHE) != snap.stamp or time.monotonic() - snap.loaded_at > _cache_ttl_sec
+    ):
+        return reload()
+    return snap
 
 
 def clear_cache() -> None:
-    """Clear in-memory cache to force reload on next access."""
-    global _cache_loaded_at
-    _cache.clear()
-    _cache_loaded_at = 0.0
+    """Drop the snapshot so the next access reloads it."""
+    global _snapshot
+    _snapshot = None
+    _wake.set()
+
+
+def _run() -> None:
+    while not _stopping:
+        _wake.wait(timeout=cache_versions._POLL_SEC)
+        _wake.clear()
+        snap = _snapshot
+        try:
+            if snap is None or cache_versions.stamp(SETTINGS_CACHE) != snap.stamp or time.monotonic() - snap.loaded_at > _cache_ttl_sec:
+                reload()
+        except Exception as e:
+            # keep serving the last snapshot
+            logger.error("runtime_config.reload_failed err=%s", e)
+
+
+def start() -> None:
+    global _thread, _stopping
+    if _thread is not None:
+        return
+    _stopping = False
+    _thread = threading.Thread(target=_run, name="runtime-config", daemon=True)
+    _thread.start()
+
+
+def stop(timeout: float = 5.0) -> None:
+    global _thread, _stopping
+    t = _thread
+    if t is None:
+        return
+    _stopping = True
+    _wake.set()
+    t.join(timeout)
+    _thread = None
 
 
 def is_sensitive(key: str) -> bool:
@@ -86,37 +171,38 @@ def _coerce(value: str | None, type_: type) -> Any:
     return str(v)
 
 
-def get(key: str, type_: type = str, default: Any | None = None) -> Any:
-    """Get configuration value.
-
-    Rules:
-    - If key is protected (DATABASE_URL, DEV_API_KEY): return env only.
-    - Else: try DB first, fallback to env if DB empty; when STRICT_DB_MODE=1, env fallback disabled.
-    - Return converted type if possible, otherwise default.
-    """
-    strict = os.getenv("STRICT_DB_MODE", "0") in ("1", "true", "True")
-
+def _resolve(values, key: str, type_: type, strict: bool) -> Any:
     if is_protected_env_key(key):
         env_val = os.getenv(key)
         if env_val is None and key == "DATABASE_URL":
             env_val = "sqlite:///./dev.db"
-        return _coerce(env_val, type_) if env_val is not None else default
+        return _coerce(env_val, type_) if env_val is not None else _MISSING
 
     # DB-first
-    _ensure_cache()
-    db_val = _cache.get(key)
+    db_val = values.get(key)
     if db_val is not None and db_val != "":
         v = _coerce(db_val, type_)
-        return v if v is not None else default
+        return v if v is not None else _MISSING
 
     if strict:
-        return default
+        return _MISSING
 
     # Fallback env
     env_val = os.getenv(key)
     if env_val is not None:
         v = _coerce(env_val, type_)
-        return v if v is not None else default
+        return v if v is not None else _MISSING
 
-    return default
+    return _MISSING
 
+
+def get(key: str, type_: type = str, default: Any | None = None) -> Any:
+    """Get configuration value.
+
+    Rules:
+    - If key is protected (DATABASE_URL, DEV_API_KEY): return env only.
+    - Else: try DB first, fallback to env if DB empty; when STRICT_DB_MODE=1, env fallback disabled.
+    - Return converted type if possible, otherwise default.
+    """
+    v = _current().lookup(key, type_)
+    return default if v is _MISSING else v
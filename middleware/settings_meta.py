@@ -9,6 +9,8 @@ KEYS: list[dict[str, Any]] = [
     # Payments: Stripe
     {"key": "STRIPE_SECRET_KEY", "group": "payments", "label": "Stripe Secret Key", "type": "string", "sensitive": True, "desc": "Server-side secret for Stripe API"},
     {"key": "STRIPE_WEBHOOK_SECRET", "group": "payments", "label": "Stripe Webhook Secret", "type": "string", "sensitive": True, "desc": "Verify Stripe webhook signatures"},
+    {"key": "WEBHOOK_ASYNC_ENABLED", "group": "payments", "label": "Async Webhook Processing", "type": "bool", "sensitive": False, "desc": "Acknowledge webhooks after storing them and apply them in a background worker"},
+    {"key": "WEBHOOK_MAX_ATTEMPTS", "group": "payments", "label": "Webhook Max Attempts", "type": "int", "min": 1, "sensitive": False, "desc": "Failed webhook events are retried with backoff up to this many times"},
     {"key": "STRIPE_PUBLISHABLE_KEY", "group": "payments", "label": "Stripe Publishable Key", "type": "string", "sensitive": False, "desc": "Frontend publishable key"},
 
     # Payments: Alipay (stub)
@@ -27,10 +29,15 @@ KEYS: list[dict[str, Any]] = [
     # LiteLLM
     {"key": "LITELLM_BASE_URL", "group": "litellm", "label": "LiteLLM Base URL", "type": "string", "format": "url", "sensitive": False, "desc": "Base URL of LiteLLM Proxy, e.g. https://llm.example.com"},
     {"key": "LITELLM_MASTER_KEY", "group": "litellm", "label": "LiteLLM Master Key", "type": "string", "sensitive": True},
+    {"key": "LITELLM_BUDGET_LINKAGE", "group": "litellm", "label": "Push Budget on Wallet Change", "type": "bool", "sensitive": False, "desc": "Top-ups, refunds and spend update LiteLLM budgets within seconds (applied on restart)"},
+    {"key": "LITELLM_BUDGET_PUSH_DELAY_MS", "group": "litellm", "label": "Budget Push Delay (ms)", "type": "int", "min": 100, "sensitive": False, "desc": "Changes per user are coalesced over this window"},
     {"key": "LITELLM_BUDGET_DURATION", "group": "litellm", "label": "Budget Duration", "type": "string", "sensitive": False},
     {"key": "LITELLM_SYNC_ENABLED", "group": "litellm", "label": "Wallet→LiteLLM Sync Enabled", "type": "bool", "sensitive": False},
     {"key": "LITELLM_SYNC_INTERVAL_SEC", "group": "litellm", "label": "Sync Interval (sec)", "type": "int", "min": 60, "sensitive": False, "desc": "Minimum 60s"},
     {"key": "LITELLM_SYNC_CURRENCY", "group": "litellm", "label": "Sync Currency", "type": "string", "sensitive": False},
+    {"key": "LITELLM_SYNC_CONCURRENCY", "group": "litellm", "label": "Sync Concurrency", "type": "int", "min": 1, "sensitive": False, "desc": "Budget updates in flight at once"},
+    {"key": "LITELLM_PROXY_MAX_CONNECTIONS", "group": "litellm", "label": "Proxy Max Connections", "type": "int", "min": 1, "sensitive": False, "desc": "Keep-alive pool size to LiteLLM (applied on restart)"},
+    {"key": "LITELLM_PROXY_TIMEOUT_SEC", "group": "litellm", "label": "Proxy Timeout (sec)", "type": "int", "min": 1, "sensitive": False, "desc": "Upstream connect/read timeout (applied on restart)"},
 
     # Auth/Logto
     {"key": "LOGTO_ENDPOINT", "group": "auth", "label": "Logto Endpoint", "type": "string", "format": "url", "sensitive": False, "desc": "e.g. https://tenant.logto.app"},
@@ -45,18 +52,49 @@ KEYS: list[dict[str, Any]] = [
 
     # Admin auth (production temporary scheme)
     {"key": "ADMIN_AUTH_TOKEN", "group": "auth", "label": "Admin Auth Token", "type": "string", "sensitive": True, "desc": "Admin header token for management APIs (x-admin-auth)"},
+    {"key": "API_KEY_CACHE_TTL_SEC", "group": "auth", "label": "API Key Cache TTL (sec)", "type": "int", "min": 1, "sensitive": False, "desc": "Resolved proxy API keys are reused this long; revocation applies at once"},
+    {"key": "API_KEY_CACHE_SIZE", "group": "auth", "label": "API Key Cache Size", "type": "int", "min": 1, "sensitive": False},
 
     # Rate limiting
     {"key": "RATE_LIMIT_ENABLED", "group": "rate_limit", "label": "Rate Limit Enabled", "type": "bool", "sensitive": False},
     {"key": "RATE_LIMIT_WINDOW_SEC", "group": "rate_limit", "label": "Window (sec)", "type": "int", "min": 1, "sensitive": False},
     {"key": "RATE_LIMIT_MAX_REQUESTS", "group": "rate_limit", "label": "Max Requests", "type": "int", "min": 1, "sensitive": False},
+    {"key": "RATE_LIMIT_MAX_IDENTITIES", "group": "rate_limit", "label": "Max Tracked Identities", "type": "int", "min": 1, "sensitive": False, "desc": "Least recently seen clients are evicted beyond this"},
+    {"key": "RATE_LIMIT_BACKEND", "group": "rate_limit", "label": "Backend", "type": "enum", "enum": ["memory", "shm", "sql"], "sensitive": False, "desc": "memory: per worker; shm: shared by workers on one host; sql: shared by all hosts"},
+    {"key": "RATE_LIMIT_SHM_NAME", "group": "rate_limit", "label": "Shared Memory Name", "type": "string", "sensitive": False},
+    {"key": "RATE_LIMIT_SHM_SLOTS", "group": "rate_limit", "label": "Shared Memory Slots", "type": "int", "min": 8, "sensitive": False, "desc": "Identities tracked by the shm backend (32 bytes each)"},
 
     # Overdraft gating / degrade
     {"key": "OVERDRAFT_GATING_ENABLED", "group": "overdraft", "label": "Overdraft Gating Enabled", "type": "bool", "sensitive": False},
     {"key": "OVERDRAFT_GATING_MODE", "group": "overdraft", "label": "Gating Mode", "type": "enum", "enum": ["block", "degrade"], "sensitive": False, "desc": "block: reject; degrade: force fallback model"},
     {"key": "DEGRADE_DEFAULT_MODEL", "group": "overdraft", "label": "Default Fallback Model", "type": "string", "sensitive": False},
     {"key": "DEGRADE_MAPPING", "group": "overdraft", "label": "Degrade Mapping", "type": "string", "sensitive": False},
+    {"key": "SPEND_COUNTER_RECONCILE_SEC", "group": "overdraft", "label": "Spend Counter Reconcile (sec)", "type": "int", "min": 0, "sensitive": False, "desc": "Re-sync in-memory daily spend with the usage table; 0 disables"},
+
+    # Usage recording
+    {"key": "USAGE_RECORDER_ENABLED", "group": "other", "label": "Batched Usage Writes", "type": "bool", "sensitive": False, "desc": "Buffer usage rows and insert them in batches (applied on restart)"},
+    {"key": "USAGE_RECORDER_BATCH_SIZE", "group": "other", "label": "Usage Batch Size", "type": "int", "min": 1, "sensitive": False},
+    {"key": "USAGE_RECORDER_FLUSH_MS", "group": "other", "label": "Usage Flush Interval (ms)", "type": "int", "min": 10, "sensitive": False},
+    {"key": "USAGE_RECORDER_MAX_QUEUE", "group": "other", "label": "Usage Buffer Limit", "type": "int", "min": 1, "sensitive": False, "desc": "When full, usage rows are written inline"},
+
+    {"key": "USAGE_ROLLUPS_ENABLED", "group": "other", "label": "Usage Rollups", "type": "bool", "sensitive": False, "desc": "Reports read pre-aggregated hourly/daily usage"},
+    {"key": "USAGE_ROLLUP_INTERVAL_SEC", "group": "other", "label": "Rollup Interval (sec)", "type": "int", "min": 5, "sensitive": False},
+    {"key": "USAGE_ROLLUP_SETTLE_SEC", "group": "other", "label": "Rollup Settle Delay (sec)", "type": "int", "min": 0, "sensitive": False, "desc": "How long a gap in usage ids is waited on before the rollup passes it"},
+
+    {"key": "LEDGER_RECONCILE_INTERVAL_SEC", "group": "other", "label": "Ledger Reconcile Interval (sec)", "type": "int", "min": 0, "sensitive": False, "desc": "Wallet balances are checked against the ledger; 0 disables"},
+    {"key": "LEDGER_CHECKPOINT_SETTLE_SEC", "group": "other", "label": "Ledger Checkpoint Delay (sec)", "type": "int", "min": 0, "sensitive": False, "desc": "Ledger entries younger than this stay after the checkpoint"},
+
+    {"key": "PREPAID_METERING_ENABLED", "group": "other", "label": "Prepaid Metering", "type": "bool", "sensitive": False, "desc": "Proxy calls are charged against wallet balance; exhausted wallets get 402"},
+    {"key": "PREPAID_METERING_CURRENCY", "group": "other", "label": "Prepaid Currency", "type": "string", "sensitive": False},
+    {"key": "PREPAID_FLUSH_MS", "group": "other", "label": "Prepaid Flush Interval (ms)", "type": "int", "min": 50, "sensitive": False, "desc": "Net spend per user is written to wallet/ledger at this interval"},
+    {"key": "PREPAID_REFRESH_SEC", "group": "other", "label": "Prepaid Balance Refresh (sec)", "type": "int", "min": 1, "sensitive": False, "desc": "How quickly top-ups and other workers' spend become visible"},
+    {"key": "LIST_TOTAL_CACHE_SEC", "group": "other", "label": "List Total Cache (sec)", "type": "int", "min": 0, "sensitive": False, "desc": "Admin list totals are cached per filter set; 0 counts every request"},
 
     # Outbox / retries
     {"key": "OUTBOX_MAX_ATTEMPTS", "group": "other", "label": "Outbox Max Attempts", "type": "int", "sensitive": False},
+    {"key": "OUTBOX_CONCURRENCY", "group": "other", "label": "Outbox Concurrency", "type": "int", "min": 1, "sensitive": False, "desc": "Endpoints sent to in parallel per worker"},
+    {"key": "OUTBOX_LEASE_SEC", "group": "other", "label": "Outbox Lease (sec)", "type": "int", "min": 10, "sensitive": False, "desc": "Claimed rows of a crashed worker are retried after this"},
+    {"key": "OUTBOX_BATCH_SIZE", "group": "other", "label": "Outbox Batch Size", "type": "int", "min": 1, "sensitive": False, "desc": "Rows claimed per endpoint and per batch post"},
+    {"key": "OUTBOX_RETENTION_DAYS", "group": "other", "label": "Outbox Retention (days)", "type": "int", "min": 0, "sensitive": False, "desc": "Sent rows older than this are archived; 0 keeps them"},
+    {"key": "OUTBOX_BATCH_ENDPOINTS", "group": "other", "label": "Outbox Batch Endpoints", "type": "string", "sensitive": False, "desc": "Comma-separated endpoint suffixes accepting POST <endpoint>/batch {\"events\": [...]}"},
 ]
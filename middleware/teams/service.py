@@ -7,18 +7,27 @@ from sqlalchemy import func
 
 from ..db import SessionLocal
 from ..models import Team
-
-
-def list_teams(*, q: Optional[str] = None, organization_id: Optional[int] = None, limit: int = 50, offset: int = 0) -> Tuple[list[Team], int]:
+from ..pagination import cached_total, keyset_page
+
+
+def list_teams(
+    *,
+    q: Optional[str] = None,
+    organization_id: Optional[int] = None,
+    limit: int = 50,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    with_total: bool = True,
+) -> Tuple[list[Team], Optional[int], Optional[str]]:
     with SessionLocal() as s:
         query = s.query(Team)
         if q:
             query = query.filter(Team.name.ilike(f"%{q}%"))
         if organization_id is not None:
             query = query.filter(Team.organization_id == organization_id)
-        total = query.count()
-        rows = query.order_by(Team.id.desc()).offset(offset).limit(limit).all()
-        return list(rows), int(total)
+        total = cached_total(query, key=("teams", q, organization_id)) if with_total else None
+        rows, next_cursor = keyset_page(query, Team.id, limit=limit, offset=offset, cursor=cursor)
+        return rows, total, next_cursor
 
 
 def get_team(team_id: int) -> Optional[Team]:
@@ -0,0 +1,329 @@
+from __future__ import annotations
+
+import datetime as dt
+import json
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+
+from . import api_keys
+from .config import settings
+from .db import SessionLocal
+from .models import Usage
+from .plans import spend
+from .runtime_config import get as rc_get
+
+
+# Write-behind recorder for Usage rows.
+#
+# The chat path only appends to a bounded in-memory buffer; a daemon thread
+# bulk-inserts the buffer when it reaches USAGE_RECORDER_BATCH_SIZE rows or every
+# USAGE_RECORDER_FLUSH_MS. When the recorder is not running (scripts, tests) or the
+# buffer is full, rows are written synchronously instead, so nothing is dropped.
+#
+# Primary rows (the proxy's own settlement) are always written and bump the daily
+# spend counter (and the API key's budget counter) immediately. Mirror rows (Lago usage events) are deduplicated by
+# request_id against recent primary rows and the usage table, and bump the counter
+# only once actually inserted.
+#
+# A batch that keeps failing is split in halves down to single rows; a row that
+# cannot be inserted on its own is logged as usage_recorder.dead_letter (with its
+# values, for manual replay) and dropped, so it cannot block the rows behind it.
+
+logger = logging.getLogger(__name__)
+
+_RECENT_IDS_MAX = 50_000
+_ISOLATE_AFTER = 3  # failed writes of a batch before it is split to find bad rows
+
+_cond = threading.Condition()
+_buf: list[tuple[dict, bool]] = []  # (row, mirror)
+_flush_lock = threading.Lock()  # held while a batch is being written
+# batch writes started / finished, updated under _cond (see write_epoch())
+_writes_started = 0
+_writes_done = 0
+# consecutive failed writes of the head of the buffer
+_failures = 0
+_recent_ids: "OrderedDict[str, None]" = OrderedDict()
+_thread: Optional[threading.Thread] = None
+_stopping = False
+
+
+def _remember(request_id: Optional[str]) -> None:
+    if not request_id:
+        return
+    _recent_ids[request_id] = None
+    _recent_ids.move_to_end(request_id)
+    while len(_recent_ids) > _RECENT_IDS_MAX:
+        _recent_ids.popitem(last=False)
+
+
+def _row(**kw) -> dict:
+    kw.setdefault("team_id", None)
+    kw.setdefault("unit", "token")
+    kw.setdefault("currency", "USD")
+    kw.setdefault("success", True)
+    kw.setdefault("api_key_id", None)
+    kw["computed_amount_cents"] = int(kw.get("computed_amount_cents") or 0)
+    kw["created_at"] = kw.get("created_at") or dt.datetime.utcnow()
+    return kw
+
+
+def record(*, mirror: bool = False, **columns) -> None:
+    """Queue one Usage row (Usage column values as keyword args).
+
+    mirror=True marks a second copy of usage that may already be recorded under the
+    same request_id (e.g. a Lago usage event for a proxied call); it is skipped if so.
+    """
+    row = _row(**columns)
+    with _cond:
+        if mirror and row.get("request_id") in _recent_ids:
+            return
+        if not mirror:
+            _remember(row.get("request_id"))
+        queued = _thread is not None and not _stopping and len(_buf) < _max_queue()
+        if queued:
+            _buf.append((row, mirror))
+            if not mirror:
+                spend.bump(row.get("user_id"), row["computed_amount_cents"], currency=row["currency"], at=row["created_at"])
+                api_keys.bump_spend(row["api_key_id"], row["computed_amount_cents"], currency=row["currency"], at=row["created_at"])
+            if len(_buf) >= _batch_size():
+                _cond.notify()
+        if not queued:
+            _begin_write()
+    if not queued:
+        # recorder not running or buffer full: apply backpressure by writing inline
+        try:
+            with _flush_lock:
+                _write([(row, mirror)], bump_primary=True)
+        finally:
+            _end_write()
+
+
+def _max_queue() -> int:
+    return max(1, int(rc_get("USAGE_RECORDER_MAX_QUEUE", int, settings.USAGE_RECORDER_MAX_QUEUE)))
+
+
+def _batch_size() -> int:
+    return max(1, int(rc_get("USAGE_RECORDER_BATCH_SIZE", int, settings.USAGE_RECORDER_BATCH_SIZE)))
+
+
+def _write(batch: list[tuple[dict, bool]], *, bump_primary: bool = False) -> int:
+    """Insert a batch in one transaction; caller holds _flush_lock. Returns rows inserted."""
+    with SessionLocal() as s:
+        mirror_ids = {r.get("request_id") for r, m in batch if m and r.get("request_id")}
+        existing: set[str] = set()
+        if mirror_ids:
+            existing = {rid for (rid,) in s.query(Usage.request_id).filter(Usage.request_id.in_(list(mirror_ids))).all()}
+        rows: list[dict] = []
+        bumps: list[dict] = []
+        for r, m in batch:
+            rid = r.get("request_id")
+            if m and rid in existing:
+                continue
+            if rid:
+                existing.add(rid)  # also dedupes mirrors within the batch
+            rows.append(r)
+            if m or bump_primary:
+                bumps.append(r)
+        if rows:
+            s.execute(insert(Usage), rows)
+            s.commit()
+    for r in bumps:
+        spend.bump(r.get("user_id"), r["computed_amount_cents"], currency=r["currency"], at=r["created_at"])
+        api_keys.bump_spend(r["api_key_id"], r["computed_amount_cents"], currency=r["currency"], at=r["created_at"])
+    return len(rows)
+
+
+def _take() -> list[tuple[dict, bool]]:
+    global _buf
+    size = _batch_size()
+    batch, _buf = _buf[:size], _buf[size:]
+    return batch
+
+
+def _begin_write() -> None:
+    # caller holds _cond
+    global _writes_started
+    _writes_started += 1
+
+
+def _end_write() -> None:
+    global _writes_done
+    with _cond:
+        _writes_done += 1
+
+
+def _dead_letter(row: dict, err: Exception) -> None:
+    logger.error("usage_recorder.dead_letter err=%s row=%s", err, json.dumps(row, default=str, sort_keys=True))
+
+
+def _write_isolating(batch: list[tuple[dict, bool]]) -> tuple[int, list[tuple[dict, bool]]]:
+    """Write batch in halves down to single rows; a row that fails on its own is dead-lettered.
+
+    Returns (rows inserted, rows to retry): when the database is unavailable the
+    failing part and everything not yet tried are handed back.
+    """
+    written = 0
+    parts = [batch]
+    while parts:
+        part = parts.pop()
+        try:
+            written += _write(part)
+        except OperationalError:
+            return written, part + [r for p in reversed(parts) for r in p]
+        except Exception as e:
+            if len(part) == 1:
+                _dead_letter(part[0][0], e)
+            else:
+                mid = len(part) // 2
+                parts.append(part[mid:])
+                parts.append(part[:mid])
+    return written, []
+
+
+def _flush_batch() -> int:
+    """Write one batch; -1 when the buffer is empty.
+
+    The batch is taken under _flush_lock so rows are never invisible to both the
+    buffer and the table (see hold_flush()). On failure the rows are put back;
+    after _ISOLATE_AFTER failures in a row the batch is split to find the rows
+    that cannot be inserted, which go to the dead-letter log.
+    """
+    global _failures
+    with _flush_lock:
+        with _cond:
+            batch = _take()
+            if not batch:
+                return -1
+            _begin_write()
+        try:
+            if _failures < _ISOLATE_AFTER:
+                try:
+                    n = _write(batch)
+                except Exception as e:
+                    _failures += 1
+                    logger.error("usage_recorder.flush_failed rows=%s attempt=%s err=%s", len(batch), _failures, e)
+                    with _cond:
+                        _buf[:0] = batch
+                    raise
+            else:
+                n, left = _write_isolating(batch)
+                if left:
+                    logger.error("usage_recorder.flush_failed rows=%s attempt=%s err=database unavailable", len(left), _failures + 1)
+                    _failures += 1
+                    with _cond:
+                        _buf[:0] = left
+                    raise RuntimeError("usage table unavailable")
+            _failures = 0
+            return n
+        finally:
+            _end_write()
+
+
+def _run() -> None:
+    backoff = 0.0
+    while True:
+        with _cond:
+            interval = max(10, int(rc_get("USAGE_RECORDER_FLUSH_MS", int, settings.USAGE_RECORDER_FLUSH_MS))) / 1000.0
+            if not _stopping and (backoff or len(_buf) < _batch_size()):
+                _cond.wait(timeout=max(interval, backoff))
+            if _stopping:
+                return
+        try:
+            n = _flush_batch()
+            backoff = 0.0
+            if n > 0:
+                logger.debug("usage_recorder.flushed rows=%s", n)
+        except Exception:
+            # keep the rows and retry; new rows keep queuing until the buffer is full
+            backoff = min(30.0, (backoff or 0.5) * 2)
+
+
+def start() -> None:
+    global _thread, _stopping
+    if not rc_get("USAGE_RECORDER_ENABLED", bool, settings.USAGE_RECORDER_ENABLED):
+        return
+    with _cond:
+        if _thread is not None:
+            return
+        _stopping = False
+        _thread = threading.Thread(target=_run, name="usage-recorder", daemon=True)
+        _thread.start()
+
+
+def stop(timeout: float = 10.0) -> None:
+    """Stop the flusher and durably write everything still buffered."""
+    global _thread, _stopping
+    with _cond:
+        t = _thread
+        if t is None:
+            return
+        _stopping = True
+        _cond.notify_all()
+    t.join(timeout)
+    flush()
+    with _cond:
+        _thread = None
+
+
+def flush() -> int:
+    """Write all buffered rows now (also used on shutdown)."""
+    n = 0
+    while True:
+        written = _flush_batch()
+        if written < 0:
+            return n
+        n += written
+
+
+@contextmanager
+def hold_flush() -> Iterator[None]:
+    """Block batch writes; lets callers read the usage table and the buffer consistently."""
+    with _flush_lock:
+        yield
+
+
+def write_epoch() -> Optional[int]:
+    """Number of batch writes started so far, or None while one is in flight.
+
+    Read it under buffer_lock() together with pending_cents(); if it is unchanged
+    after reading the usage table, no buffered row was written in between.
+    """
+    with _cond:
+        return _writes_started if _writes_started == _writes_done else None
+
+
+@contextmanager
+def buffer_lock() -> Iterator[None]:
+    """Block new rows from being queued (and their spend bumps) while held."""
+    with _cond:
+        yield
+
+
+def pending_cents(user_ids: Iterable[int], start: dt.datetime) -> dict[int, int]:
+    """Buffered (not yet inserted) primary USD spend per user since start."""
+    ids = set(user_ids)
+    out: dict[int, int] = {}
+    with _cond:
+        for r, m in _buf:
+            uid = r.get("user_id")
+            if m or uid not in ids or r["currency"] != "USD" or r["created_at"] < start:
+                continue
+            out[uid] = out.get(uid, 0) + r["computed_amount_cents"]
+    return out
+
+
+def pending_key_cents(key_id: int, start: dt.datetime) -> int:
+    """Buffered (not yet inserted) USD spend charged to an API key since start."""
+    with _cond:
+        return sum(r["computed_amount_cents"] for r, m in _buf if not m and r["api_key_id"] == key_id and r["currency"] == "USD" and r["created_at"] >= start)
+
+
+def queue_depth() -> int:
+    with _cond:
+        return len(_buf)
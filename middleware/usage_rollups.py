@@ -0,0 +1,273 @@
+from __future__ import annotations
+
+import datetime as dt
+import logging
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import String, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.functions import FunctionElement
+
+from .config import settings
+from .db import SessionLocal
+from .models import Usage, UsageRollupDaily, UsageRollupHourly, UsageRollupState
+from .plans.service import utc8_day_start
+from .runtime_config import get as rc_get
+
+
+# Incremental usage rollups for reports.
+#
+# catch_up() folds usage rows above the high-water mark (usage_rollup_state) into
+# hourly (UTC hour) and daily (UTC+8 day) buckets keyed by user, team, model and
+# success. Readers combine the rollups of the granularity they report in with raw
+# rows above the mark in one grouped statement, so a concurrent catch-up can
+# neither drop nor double count a row.
+#
+# Usage ids are allocated at insert but may become visible out of order (a lower
+# id committing after a higher one), so the mark only advances over a run of
+# consecutive ids. A gap is passed once it has stayed open for
+# USAGE_ROLLUP_SETTLE_SEC: by then the id was rolled back, not just uncommitted.
+
+logger = logging.getLogger(__name__)
+
+_STATE = "usage"
+_BATCH = 5000
+
+_gaps_lock = threading.Lock()
+# first missing id of an open gap above the mark -> monotonic time it was first seen
+_gaps: dict[int, float] = {}
+
+
+class utc8_date(FunctionElement):
+    """'YYYY-MM-DD' of a naive UTC timestamp in UTC+8, computed in SQL."""
+
+    type = String()
+    name = "utc8_date"
+    inherit_cache = True
+
+
+@compiles(utc8_date)
+def _utc8_date_sqlite(element, compiler, **kw):
+    return "date(%s, '+8 hours')" % compiler.process(element.clauses, **kw)
+
+
+@compiles(utc8_date, "postgresql")
+def _utc8_date_pg(element, compiler, **kw):
+    return "to_char(%s + interval '8 hours', 'YYYY-MM-DD')" % compiler.process(element.clauses, **kw)
+
+
+@compiles(utc8_date, "mysql")
+def _utc8_date_mysql(element, compiler, **kw):
+    return "DATE_FORMAT(DATE_ADD(%s, INTERVAL 8 HOUR), '%%Y-%%m-%%d')" % compiler.process(element.clauses, **kw)
+
+
+class utc_hour(FunctionElement):
+    """'YYYY-MM-DD HH' of a naive UTC timestamp, computed in SQL."""
+
+    type = String()
+    name = "utc_hour"
+    inherit_cache = True
+
+
+@compiles(utc_hour)
+def _utc_hour_sqlite(element, compiler, **kw):
+    return "strftime('%%Y-%%m-%%d %%H', %s)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(utc_hour, "postgresql")
+def _utc_hour_pg(element, compiler, **kw):
+    return "to_char(%s, 'YYYY-MM-DD HH24')" % compiler.process(element.clauses, **kw)
+
+
+@compiles(utc_hour, "mysql")
+def _utc_hour_mysql(element, compiler, **kw):
+    return "DATE_FORMAT(%s, '%%Y-%%m-%%d %%H')" % compiler.process(element.clauses, **kw)
+
+
+def _day_start(day: str) -> dt.datetime:
+    y, m, d = map(int, day.split("-"))
+    return dt.datetime(y, m, d) - dt.timedelta(hours=8)
+
+
+def _hour_start(hour: str) -> dt.datetime:
+    return dt.datetime.strptime(hour, "%Y-%m-%d %H")
+
+
+def _hour(ts: dt.datetime) -> dt.datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+# granularity -> (rollup table, SQL bucket label, label -> UTC bucket start)
+_GRANULARITIES = {
+    "day": (UsageRollupDaily, utc8_date, _day_start),
+    "hour": (UsageRollupHourly, utc_hour, _hour_start),
+}
+
+
+def enabled() -> bool:
+    return bool(rc_get("USAGE_ROLLUPS_ENABLED", bool, settings.USAGE_ROLLUPS_ENABLED))
+
+
+def _ensure_state(s: Session) -> int:
+    st = s.get(UsageRollupState, _STATE)
+    if st is not None:
+        return int(st.last_usage_id or 0)
+    try:
+        with s.begin_nested():
+            s.add(UsageRollupState(name=_STATE, last_usage_id=0))
+    except IntegrityError:
+        pass
+    return int(s.get(UsageRollupState, _STATE).last_usage_id or 0)
+
+
+def _merge(s: Session, model_cls, agg: dict[tuple, list[int]]) -> None:
+    for bucket in {k[0] for k in agg}:
+        existing = {
+            (r.bucket_start, r.user_id, r.team_id, r.model, bool(r.success)): r
+            for r in s.query(model_cls).filter(model_cls.bucket_start == bucket).all()
+        }
+        for key, (amount, tokens, count) in agg.items():
+            if key[0] != bucket:
+                continue
+            row = existing.get(key)
+            if row is None:
+                s.add(model_cls(bucket_start=key[0], user_id=key[1], team_id=key[2], model=key[3], success=key[4], amount_cents=amount, total_tokens=tokens, request_count=count))
+            else:
+                row.amount_cents = int(row.amount_cents or 0) + amount
+                row.total_tokens = int(row.total_tokens or 0) + tokens
+                row.request_count = int(row.request_count or 0) + count
+
+
+def _settled_upper(hwm: int, ids: list[int], settle: float) -> int:
+    """Highest id the mark may move to: the end of the consecutive run above hwm,
+    extended past gaps that have been open for settle seconds."""
+    now = time.monotonic()
+    upper = hwm
+    with _gaps_lock:
+        for stale in [g for g in _gaps if g <= hwm]:
+            del _gaps[stale]
+        for i in ids:
+            if i != upper + 1:
+                seen = _gaps.setdefault(upper + 1, now)
+                if now - seen < settle:
+                    break
+                logger.info("usage_rollups.gap_skipped from_id=%s to_id=%s", upper + 1, i - 1)
+                del _gaps[upper + 1]
+            upper = i
+    return upper
+
+
+def _catch_up_batch(batch: int) -> int:
+    settle = max(0, int(rc_get("USAGE_ROLLUP_SETTLE_SEC", int, settings.USAGE_ROLLUP_SETTLE_SEC)))
+    with SessionLocal() as s:
+        hwm = _ensure_state(s)
+        s.commit()
+        ids = [i for (i,) in s.query(Usage.id).filter(Usage.id > hwm).order_by(Usage.id).limit(batch)]
+        upper = _settled_upper(hwm, ids, settle)
+        if upper <= hwm:
+            return 0
+        # claim the range first: a concurrent catch-up blocks here and then finds the mark moved
+        claimed = s.execute(
+            update(UsageRollupState)
+            .where(UsageRollupState.name == _STATE, UsageRollupState.last_usage_id == hwm)
+            .values(last_usage_id=upper, updated_at=dt.datetime.utcnow())
+        ).rowcount
+        if not claimed:
+            s.rollback()
+            return 0
+        rows = (
+            s.query(Usage.created_at, Usage.user_id, Usage.team_id, Usage.model, Usage.success, Usage.computed_amount_cents, Usage.total_tokens)
+            .filter(Usage.id > hwm, Usage.id <= upper)
+            .all()
+        )
+        hourly: dict[tuple, list[int]] = {}
+        daily: dict[tuple, list[int]] = {}
+        for created_at, user_id, team_id, model, success, amount, tokens in rows:
+            rest = (user_id, team_id, model, bool(success) if success is not None else True)
+            for agg, bucket in ((hourly, _hour(created_at)), (daily, utc8_day_start(created_at))):
+                acc = agg.setdefault((bucket, *rest), [0, 0, 0])
+                acc[0] += int(amount or 0)
+                acc[1] += int(tokens or 0)
+                acc[2] += 1
+        _merge(s, UsageRollupHourly, hourly)
+        _merge(s, UsageRollupDaily, daily)
+        s.commit()
+        return len(rows)
+
+
+def catch_up(max_rows: int = 200_000) -> int:
+    """Roll up usage rows above the high-water mark. Returns the number of rows folded in."""
+    total = 0
+    while total < max_rows:
+        n = _catch_up_batch(min(_BATCH, max_rows - total))
+        if n <= 0:
+            break
+        total += n
+    if total:
+        logger.info("usage_rollups.caught_up rows=%s", total)
+    return total
+
+
+def usage_buckets(
+    s: Session,
+    *,
+    start: dt.datetime,
+    end: dt.datetime,
+    user_id: Optional[int] = None,
+    team_id: Optional[int] = None,
+    model: Optional[str] = None,
+    success: Optional[bool] = None,
+    granularity: str = "day",
+) -> list[tuple[dt.datetime, str, int, int]]:
+    """(bucket_start, model, amount_cents, total_tokens) per bucket and model in [start, end).
+
+    Buckets are UTC+8 days (granularity "day") or UTC hours ("hour"); start/end
+    must be bucket boundaries. Reads the matching rollups below the high-water
+    mark and raw usage above it.
+    """
+    rollup, bucket_label, bucket_start = _GRANULARITIES[granularity]
+
+    def _filters(cls, ts_col):
+        f = [ts_col >= start, ts_col < end]
+        if user_id is not None:
+            f.append(cls.user_id == user_id)
+        if team_id is not None:
+            f.append(cls.team_id == team_id)
+        if model:
+            f.append(cls.model == model)
+        if success is not None:
+            f.append(cls.success == bool(success))
+        return f
+
+    def _grouped(cls, ts_col, amount_col, tokens_col):
+        bucket = bucket_label(ts_col)
+        return (
+            select(
+                bucket.label("bucket"),
+                cls.model.label("model"),
+                func.coalesce(func.sum(amount_col), 0).label("amount"),
+                func.coalesce(func.sum(tokens_col), 0).label("tokens"),
+            )
+            .where(*_filters(cls, ts_col))
+            .group_by(bucket, cls.model)
+        )
+
+    # one grouped statement; the raw part is bucketed in SQL
+    raw = _grouped(Usage, Usage.created_at, Usage.computed_amount_cents, Usage.total_tokens)
+    if enabled():
+        R = rollup
+        hwm = select(func.coalesce(func.max(UsageRollupState.last_usage_id), 0)).where(UsageRollupState.name == _STATE).scalar_subquery()
+        stmt = _grouped(R, R.bucket_start, R.amount_cents, R.total_tokens).union_all(raw.where(Usage.id > hwm))
+    else:
+        stmt = raw
+
+    out: dict[tuple[str, str], list[int]] = {}
+    for label, m, amount, tokens in s.execute(stmt):
+        acc = out.setdefault((label, m), [0, 0])
+        acc[0] += int(amount or 0)
+        acc[1] += int(tokens or 0)
+    return [(bucket_start(label), m, a, t) for (label, m), (a, t) in sorted(out.items(), key=lambda kv: (kv[0][0], kv[0][1] or ""))]
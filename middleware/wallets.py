@@ -1,16 +1,28 @@
 from __future__ import annotations
 
 from contextlib import contextmanager
-from typing import Iterator
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
 
+from sqlalchemy import event, insert, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 import logging
 
 from .db import SessionLocal
 from .models import Wallet, LedgerEntry, User
+from .integrations.litellm_sync import budget_changed
 
 logger = logging.getLogger(__name__)
 
+
+# Wallet balances only move through a single atomic statement
+#   UPDATE wallets SET balance_cents = balance_cents + :delta ... RETURNING id, balance_cents
+# so concurrent top-ups, refunds and debits on one wallet cannot lose updates, and
+# the ledger rows for a batch are written with one executemany in the same
+# transaction. The user is only looked up when a wallet has to be created. Once
+# the transaction commits, the users touched are reported for LiteLLM budget push.
+
 @contextmanager
 def session_scope() -> Iterator[Session]:
     session = SessionLocal()
@@ -24,46 +36,115 @@ def session_scope() -> Iterator[Session]:
         session.close()
 
 
-def credit_wallet(user_id: int, currency: str, amount_cents: int, reason: str, meta: dict | None = None) -> None:
-    currency = currency.upper()
-    with session_scope() as s:
-        # ensure user exists
-        s.query(User).filter_by(id=user_id).one()
-        wallet = s.query(Wallet).filter_by(user_id=user_id, currency=currency).first()
-        if wallet is None:
-            wallet = Wallet(user_id=user_id, currency=currency, balance_cents=0)
-            s.add(wallet)
+@contextmanager
+def _nullscope(session: Session) -> Iterator[Session]:
+    yield session
+
+
+@dataclass
+class WalletMovement:
+    user_id: int
+    currency: str
+    amount_cents: int  # signed: > 0 credits, < 0 debits
+    reason: str
+    meta: Optional[dict] = None
+
+
+def _bump(s: Session, user_id: int, currency: str, delta: int) -> Optional[tuple[int, int]]:
+    """Atomically add delta; (wallet_id, new_balance) or None if the wallet does not exist."""
+    stmt = (
+        update(Wallet)
+        .where(Wallet.user_id == user_id, Wallet.currency == currency)
+        .values(balance_cents=Wallet.balance_cents + delta)
+        .execution_options(synchronize_session=False)
+    )
+    if s.get_bind().dialect.update_returning:
+        row = s.execute(stmt.returning(Wallet.id, Wallet.balance_cents)).first()
+        return (int(row[0]), int(row[1])) if row is not None else None
+    # no UPDATE .. RETURNING (e.g. MySQL): the row stays locked by the update until commit
+    if not s.execute(stmt).rowcount:
+        return None
+    row = s.execute(select(Wallet.id, Wallet.balance_cents).where(Wallet.user_id == user_id, Wallet.currency == currency)).first()
+    return int(row[0]), int(row[1])
+
+
+def _create_and_bump(s: Session, user_id: int, currency: str, delta: int) -> tuple[int, int]:
+    # ensure user exists (only on the first movement of a currency)
+    s.query(User.id).filter_by(id=user_id).one()
+    try:
+        with s.begin_nested():
+            w = Wallet(user_id=user_id, currency=currency, balance_cents=delta)
+            s.add(w)
             s.flush()
-        wallet.balance_cents += amount_cents
-        entry = LedgerEntry(wallet_id=wallet.id, amount_cents=amount_cents, currency=currency, reason=reason, meta=meta or {})
-        s.add(entry)
-        logger.info(
-            "wallet.credit user_id=%s currency=%s amount_cents=%s wallet_id=%s",
-            user_id,
-            currency,
-            amount_cents,
-            wallet.id,
-        )
-
-
-def debit_wallet(user_id: int, currency: str, amount_cents: int, reason: str, meta: dict | None = None) -> None:
-    """Debit wallet by amount_cents (can go negative for refund completeness)."""
+            return int(w.id), int(delta)
+    except IntegrityError:
+        # created concurrently: fall back to the atomic update
+        res = _bump(s, user_id, currency, delta)
+        if res is None:
+            raise
+        return res
+
+
+def apply_wallet_movements(movements: Iterable[WalletMovement], *, session: Optional[Session] = None) -> list[int]:
+    """Apply many balance changes and their ledger entries in one transaction.
+
+    Movements on the same wallet are summed into one UPDATE; wallets are updated
+    in (user_id, currency) order so concurrent batches cannot deadlock. Returns
+    the balance after each movement, in input order. With session given the
+    caller owns the transaction; otherwise it is committed here.
+    """
+    by_wallet: dict[tuple[int, str], list[tuple[int, WalletMovement]]] = {}
+    n = 0
+    for i, m in enumerate(movements):
+        by_wallet.setdefault((m.user_id, m.currency.upper()), []).append((i, m))
+        n = i + 1
+    if not n:
+        return []
+    balances: list[int] = [0] * n
+    entries: list[dict] = []
+    with (_nullscope(session) if session is not None else session_scope()) as s:
+        for (user_id, currency), moves in sorted(by_wallet.items()):
+            total = sum(int(m.amount_cents) for _, m in moves)
+            res = _bump(s, user_id, currency, total)
+            if res is None:
+                res = _create_and_bump(s, user_id, currency, total)
+            wallet_id, running = res[0], res[1] - total
+            for i, m in moves:
+                running += int(m.amount_cents)
+                balances[i] = running
+                entries.append({"wallet_id": wallet_id, "amount_cents": int(m.amount_cents), "currency": currency, "reason": m.reason, "meta": m.meta or {}})
+        s.execute(insert(LedgerEntry), entries)
+        users = {user_id for user_id, _ in by_wallet}
+        if session is not None:
+            event.listen(session, "after_commit", lambda _s: budget_changed(users), once=True)
+    if session is None:
+        budget_changed(users)
+    return balances
+
+
+def credit_wallet(user_id: int, currency: str, amount_cents: int, reason: str, meta: dict | None = None, *, session: Optional[Session] = None) -> int:
+    """Credit wallet by amount_cents. Returns the new balance."""
     currency = currency.upper()
-    with session_scope() as s:
-        # ensure user exists
-        s.query(User).filter_by(id=user_id).one()
-        wallet = s.query(Wallet).filter_by(user_id=user_id, currency=currency).first()
-        if wallet is None:
-            wallet = Wallet(user_id=user_id, currency=currency, balance_cents=0)
-            s.add(wallet)
-            s.flush()
-        wallet.balance_cents -= amount_cents
-        entry = LedgerEntry(wallet_id=wallet.id, amount_cents=-abs(amount_cents), currency=currency, reason=reason, meta=meta or {})
-        s.add(entry)
-        logger.info(
-            "wallet.debit user_id=%s currency=%s amount_cents=%s wallet_id=%s",
-            user_id,
-            currency,
-            amount_cents,
-            wallet.id,
-        )
+    (balance,) = apply_wallet_movements([WalletMovement(user_id, currency, int(amount_cents), reason, meta)], session=session)
+    logger.info(
+        "wallet.credit user_id=%s currency=%s amount_cents=%s balance_cents=%s",
+        user_id,
+        currency,
+        amount_cents,
+        balance,
+    )
+    return balance
+
+
+def debit_wallet(user_id: int, currency: str, amount_cents: int, reason: str, meta: dict | None = None, *, session: Optional[Session] = None) -> int:
+    """Debit wallet by amount_cents (can go negative for refund completeness). Returns the new balance."""
+    currency = currency.upper()
+    (balance,) = apply_wallet_movements([WalletMovement(user_id, currency, -abs(int(amount_cents)), reason, meta)], session=session)
+    logger.info(
+        "wallet.debit user_id=%s currency=%s amount_cents=%s balance_cents=%s",
+        user_id,
+        currency,
+        amount_cents,
+        balance,
+    )
+    return balance
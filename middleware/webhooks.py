@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import datetime as dt
+import json
+import logging
+import threading
+from typing import Optional
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from .billing.service import process_stripe_invoice_webhook, process_stripe_subscription_webhook
+from .config import settings
+from .db import SessionLocal
+from .models import ProviderEvent
+from .payments.registry import provider_registry
+from .payments.service import process_webhook
+from .runtime_config import get as rc_get
+
+
+# Fast-ack Stripe webhook intake.
+#
+# The request handler verifies the signature, parses the body once and stores the
+# raw event in provider_events (status "received"); the (provider, event_id) unique
+# key dedupes Stripe retries. It answers 200 right away and a daemon thread applies
+# the event: invoice.* and customer.subscription.* to billing, everything else to
+# payments. Failures are retried with backoff up to WEBHOOK_MAX_ATTEMPTS, then the
+# row is left "failed". Rows are claimed with a lease, so several workers can drain
+# the queue; a row stuck in "processing" is picked up again once its lease expires.
+# When the worker is not running (scripts, tests, WEBHOOK_ASYNC_ENABLED=0) events
+# are applied inline before replying, as before.
+
+logger = logging.getLogger(__name__)
+
+_LEASE_SEC = 300
+_BATCH = 50
+
+_wake = threading.Event()
+_thread: Optional[threading.Thread] = None
+_stopping = False
+
+
+class WebhookRejected(Exception):
+    """Signature or payload invalid; answered with 400 so Stripe shows the failure."""
+
+
+def verify_stripe(headers: dict, body: bytes) -> dict:
+    """Check the Stripe-Signature header (when a secret is configured) and parse the event once."""
+    secret = rc_get("STRIPE_WEBHOOK_SECRET", str, settings.STRIPE_WEBHOOK_SECRET)
+    payload = body.decode("utf-8")
+    if secret:
+        try:
+            import stripe  # type: ignore
+        except Exception as e:  # pragma: no cover
+            raise RuntimeError("stripe library not installed") from e
+        sig = headers.get("stripe-signature") or headers.get("Stripe-Signature")
+        if not sig:
+            raise WebhookRejected("Missing Stripe-Signature header")
+        try:
+            stripe.WebhookSignature.verify_header(payload, sig, secret, stripe.Webhook.DEFAULT_TOLERANCE)
+        except Exception as e:
+            raise WebhookRejected(str(e)) from e
+    try:
+        data = json.loads(payload)
+    except ValueError as e:
+        raise WebhookRejected("invalid JSON payload") from e
+    if not isinstance(data, dict) or not data.get("id") or not isinstance(data.get("type"), str):
+        raise WebhookRejected("not a Stripe event")
+    return data
+
+
+def accept_stripe(headers: dict, body: bytes, request_id: Optional[str] = None) -> dict:
+    """Verify and durably store a Stripe webhook; apply it inline if no worker is running.
+
+    Returns {"event_id", "event_type", "duplicate", "queued"}. Raises WebhookRejected.
+    """
+    data = verify_stripe(headers, body)
+    event_id, event_type = str(data["id"]), data["type"]
+    duplicate, status = False, "received"
+    with SessionLocal() as s:
+        pe = ProviderEvent(provider="stripe", event_id=event_id, raw=data, event_type=event_type[:64], status="received", attempts=0, request_id=request_id)
+        s.add(pe)
+        try:
+            s.commit()
+            row_id = pe.id
+        except IntegrityError:
+            s.rollback()
+            duplicate = True
+            row_id, status = s.execute(
+                select(ProviderEvent.id, ProviderEvent.status).where(ProviderEvent.provider == "stripe", ProviderEvent.event_id == event_id)
+            ).one()
+            logger.info("webhook.duplicate provider=stripe event_id=%s status=%s", event_id, status)
+    queued = _thread is not None and not _stopping
+    if queued:
+        _wake.set()
+    elif not duplicate or status == "received":
+        # no worker: apply now; a Stripe retry of an event that failed inline is applied again
+        process_event(row_id, raise_errors=True, due_only=False)
+    return {"event_id": event_id, "event_type": event_type, "duplicate": duplicate, "queued": queued}
+
+
+def _apply(data: dict, request_id: Optional[str]) -> None:
+    event_type = data.get("type") or ""
+    if event_type.startswith("invoice."):
+        process_stripe_invoice_webhook({}, b"", request_id, event=data)
+    elif event_type.startswith("customer.subscription."):
+        process_stripe_subscription_webhook({}, b"", request_id, event=data)
+    else:
+        event = provider_registry.get("stripe").parse_event(data)
+        process_webhook(provider_name="stripe", headers={}, body=b"", request_id=request_id, event=event)
+
+
+def _claimable(now: dt.datetime, *, due_only: bool = True):
+    received = ProviderEvent.status == "received"
+    if due_only:
+        received = received & or_(ProviderEvent.next_attempt_at == None, ProviderEvent.next_attempt_at <= now)  # noqa: E711
+    stale = (ProviderEvent.status == "processing") & (ProviderEvent.locked_until < now)
+    return or_(received, stale)
+
+
+def process_event(row_id: int, *, raise_errors: bool = False, due_only: bool = True) -> bool:
+    """Claim and apply one stored event. Returns False if it is not claimable (done, held or backing off)."""
+    now = dt.datetime.utcnow()
+    with SessionLocal() as s:
+        claimed = s.execute(
+            update(ProviderEvent)
+            .where(ProviderEvent.id == row_id, _claimable(now, due_only=due_only))
+            .values(status="processing", locked_until=now + dt.timedelta(seconds=_LEASE_SEC))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        s.commit()
+        if not claimed:
+            return False
+        pe = s.get(ProviderEvent, row_id)
+        data, request_id, attempts = dict(pe.raw or {}), pe.request_id, int(pe.attempts or 0)
+    try:
+        _apply(data, request_id)
+    except Exception as e:
+        attempts += 1
+        dead = attempts >= int(rc_get("WEBHOOK_MAX_ATTEMPTS", int, settings.WEBHOOK_MAX_ATTEMPTS))
+        backoff = min(3600, 2 ** min(10, attempts))
+        with SessionLocal() as s:
+            s.execute(
+                update(ProviderEvent)
+                .where(ProviderEvent.id == row_id)
+                .values(
+                    status="failed" if dead else "received",
+                    attempts=attempts,
+                    next_attempt_at=None if dead else dt.datetime.utcnow() + dt.timedelta(seconds=backoff),
+                    locked_until=None,
+                    last_error=str(e)[:500],
+                )
+            )
+            s.commit()
+        logger.warning("webhook.process_failed id=%s event_type=%s attempts=%s dead=%s err=%s", row_id, data.get("type"), attempts, dead, e)
+        if raise_errors:
+            raise
+        return True
+    with SessionLocal() as s:
+        s.execute(
+            update(ProviderEvent)
+            .where(ProviderEvent.id == row_id)
+            .values(status="processed", processed_at=dt.datetime.utcnow(), locked_until=None, last_error=None)
+        )
+        s.commit()
+    logger.info("webhook.processed id=%s provider=stripe event_type=%s request_id=%s", row_id, data.get("type"), request_id)
+    return True
+
+
+def process_pending(max_events: int = _BATCH) -> int:
+    """Apply due events in arrival order. Returns events handled (processed or retried)."""
+    with SessionLocal() as s:
+        ids = [
+            i for (i,) in s.execute(
+                select(ProviderEvent.id).where(_claimable(dt.datetime.utcnow())).order_by(ProviderEvent.id).limit(max_events)
+            )
+        ]
+    return sum(1 for i in ids if process_event(i))
+
+
+def _run() -> None:
+    backoff = 0.0
+    while not _stopping:
+        _wake.wait(timeout=max(1.0, backoff))
+        _wake.clear()
+        try:
+            while not _stopping and process_pending() >= _BATCH:
+                pass
+            backoff = 0.0
+        except Exception as e:
+            backoff = min(30.0, (backoff or 0.5) * 2)
+            logger.error("webhook.worker_failed err=%s retry_in=%.1fs", e, backoff)
+
+
+def start() -> None:
+    global _thread, _stopping
+    if not rc_get("WEBHOOK_ASYNC_ENABLED", bool, settings.WEBHOOK_ASYNC_ENABLED) or _thread is not None:
+        return
+    _stopping = False
+    _thread = threading.Thread(target=_run, name="webhook-worker", daemon=True)
+    _thread.start()
+
+
+def stop(timeout: float = 10.0) -> None:
+    """Stop the worker; events still queued stay in provider_events for the next start."""
+    global _thread, _stopping
+    t = _thread
+    if t is None:
+        return
+    _stopping = True
+    _wake.set()
+    t.join(timeout)
+    _thread = None
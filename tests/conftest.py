@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+import uuid
+
+# The app reads its settings at import time: point it at a throwaway database first.
+_tmp = tempfile.mkdtemp(prefix="rabbit-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp}/test.db"
+os.environ["DEV_API_KEY"] = "dev"
+os.environ["RATE_LIMIT_ENABLED"] = "0"
+os.environ["LITELLM_BASE_URL"] = "http://litellm.test"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+
+import api.server  # noqa: E402,F401 imports every model module
+from middleware.db import SessionLocal, init_db  # noqa: E402
+from middleware.db_migrate import run_migrations  # noqa: E402
+
+init_db()
+run_migrations()
+
+
+@pytest.fixture
+def make_user():
+    """Create an organization/team/user; returns the user id."""
+    from middleware.models import Organization, Team, User
+
+    def _make(**kw) -> int:
+        with SessionLocal() as s:
+            o = Organization(name=f"o-{uuid.uuid4().hex[:8]}")
+            s.add(o)
+            s.flush()
+            t = Team(organization_id=o.id, name="t")
+            s.add(t)
+            s.flush()
+            u = User(team_id=t.id, email=f"{uuid.uuid4().hex[:12]}@example.test", **kw)
+            s.add(u)
+            s.commit()
+            return u.id
+
+    return _make
+
+
+@pytest.fixture
+def priced_plan():
+    """Assign a daily-limit plan with a gpt-4* token price to a user; returns plan id."""
+    from middleware.plans import service as ps
+
+    def _assign(user_id: int, *, limit_cents: int = 100_000, policy: str = "block", meta: dict | None = None) -> int:
+        p = ps.create_plan(name=f"p-{uuid.uuid4().hex[:6]}", type="daily_limit")
+        ps.upsert_daily_limit(p.id, daily_limit_cents=limit_cents, overflow_policy=policy)
+        ps.add_price_rule(p.id, model_pattern="gpt-4*", unit="token", unit_base_price_cents=10)
+        if meta is not None:
+            ps.update_plan_meta(p.id, meta)
+        ps.assign_plan("user", user_id, p.id)
+        return p.id
+
+    return _assign
+
+
+@pytest.fixture
+def upstream():
+    """Route the proxy's LiteLLM client to a handler: upstream(lambda request: httpx.Response(...))."""
+    from middleware.integrations import litellm_proxy
+
+    old = litellm_proxy._client
+
+    def _set(handler) -> None:
+        litellm_proxy._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    yield _set
+    litellm_proxy._client = old
+
+
+@pytest.fixture
+def client():
+    from fastapi.testclient import TestClient
+
+    from api.server import app
+
+    return TestClient(app)
+
+
+@pytest.fixture
+def statements():
+    """SQL statements executed while the test runs; clear() it to start counting."""
+    from sqlalchemy import event
+
+    from middleware.db import engine
+
+    seen: list[str] = []
+
+    def _on_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        seen.append(statement)
+
+    event.listen(engine, "before_cursor_execute", _on_execute)
+    yield seen
+    event.remove(engine, "before_cursor_execute", _on_execute)
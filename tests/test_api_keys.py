@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import dataclasses
+import datetime as dt
+
+import httpx
+import pytest
+
+from middleware import api_keys, usage_recorder
+from middleware.db import SessionLocal
+from middleware.models import ApiKey, Usage
+from middleware.plans import service as plans
+from middleware.quotas import Limits
+
+_CHAT = {"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}
+
+
+@pytest.fixture
+def seen_auth(upstream):
+    seen: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request.headers.get("authorization"))
+        return httpx.Response(200, json={"choices": [], "usage": {"prompt_tokens": 3, "completion_tokens": 7, "total_tokens": 10}})
+
+    upstream(handler)
+    return seen
+
+
+def test_api_key_forwards_its_linked_litellm_key(make_user, priced_plan, client, seen_auth):
+    uid = make_user()
+    priced_plan(uid)
+    raw, _k = api_keys.create_key(uid, litellm_api_key="sk-linked")
+
+    # the client holds only the platform key; the upstream key is resolved server-side
+    r = client.post("/v1/proxy/chat/completions", json=_CHAT, headers={"authorization": f"Bearer {raw}"})
+    assert r.status_code == 200, r.text
+    # a LiteLLM key sent along is not forwarded in place of the linked one
+    r = client.post("/v1/proxy/chat/completions", json=_CHAT, headers={"authorization": f"Bearer {raw}", "x-litellm-api-key": "sk-someone-else"})
+    assert r.status_code == 200, r.text
+    assert seen_auth == ["Bearer sk-linked", "Bearer sk-linked"]
+
+
+def test_dev_auth_still_requires_a_litellm_key(make_user, client, seen_auth):
+    r = client.post("/v1/proxy/chat/completions", json=_CHAT, headers={"x-api-key": "dev", "x-dev-user-id": str(make_user())})
+    assert r.status_code == 400
+    assert seen_auth == []
+
+
+def test_key_budget_rejects_once_spend_reaches_it(make_user, priced_plan, client, upstream):
+    uid = make_user()
+    priced_plan(uid)
+    raw, k = api_keys.create_key(uid, litellm_api_key="sk-budget", max_budget_cents=2, budget_duration="30d")
+    auth = {"authorization": f"Bearer {raw}"}
+    calls: list[int] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(1)
+        # 100 tokens at 10 cents per 1k: 1 cent per call
+        return httpx.Response(200, json={"choices": [], "usage": {"prompt_tokens": 60, "completion_tokens": 40, "total_tokens": 100}})
+
+    upstream(handler)
+    assert client.post("/v1/proxy/chat/completions", json=_CHAT, headers=auth).status_code == 200
+    assert client.post("/v1/proxy/chat/completions", json=_CHAT, headers=auth).status_code == 200
+    r = client.post("/v1/proxy/chat/completions", json=_CHAT, headers=auth)
+    assert r.status_code == 402, r.text
+    assert len(calls) == 2
+
+    # the usage rows carry the key, so a cold counter reads the same spend
+    usage_recorder.flush()
+    api_keys.clear_cache()
+    assert api_keys.spent_cents(api_keys.authenticate(raw)) == 2
+    with SessionLocal() as s:
+        assert s.query(Usage).filter_by(api_key_id=k.id).count() == 2
+
+
+def test_budget_window_restarts_every_duration():
+    created = dt.datetime(2026, 1, 1)
+    kctx = api_keys.KeyContext(key_id=1, user_id=1, team_id=None, model_allowlist=frozenset(), max_budget_cents=1, budget_duration="24h", limits=Limits(), created_at=created)
+    assert kctx.budget_window_start(dt.datetime(2026, 1, 3, 5)) == dt.datetime(2026, 1, 3)
+    lifetime = dataclasses.replace(kctx, budget_duration=None)
+    assert lifetime.budget_window_start(dt.datetime(2026, 5, 1)) == created
+    assert api_keys.parse_duration("1mo") == 30 * 86400
+    assert api_keys.parse_duration("soon") is None
+
+
+def test_unlinked_api_key_is_rejected(make_user, client, seen_auth):
+    uid = make_user()
+    raw = "sk-rb-unlinked-test-key"
+    with SessionLocal() as s:
+        s.add(ApiKey(user_id=uid, key_hash=api_keys.hash_key(raw), key_last4=raw[-4:], active=True))
+        s.commit()
+    api_keys.clear_cache()
+
+    r = client.post("/v1/proxy/chat/completions", json=_CHAT, headers={"authorization": f"Bearer {raw}"})
+    assert r.status_code == 403
+    assert seen_auth == []
+
+
+def test_create_key_requires_a_litellm_key(make_user):
+    with pytest.raises(ValueError):
+        api_keys.create_key(make_user(), litellm_api_key=" ")
+
+
+def test_plan_limits_apply_to_a_cached_key(make_user, priced_plan, client, seen_auth):
+    uid = make_user()
+    plan_id = priced_plan(uid)
+    raw, _k = api_keys.create_key(uid, litellm_api_key="sk-plan")
+    headers = {"authorization": f"Bearer {raw}"}
+    assert client.post("/v1/proxy/chat/completions", json=_CHAT, headers=headers).status_code == 200
+
+    # the key context is cached now; a plan edit must still take effect
+    plans.update_plan_meta(plan_id, {"rpm_limit": 1})
+    assert client.post("/v1/proxy/chat/completions", json=_CHAT, headers=headers).status_code == 200
+    assert client.post("/v1/proxy/chat/completions", json=_CHAT, headers=headers).status_code == 429
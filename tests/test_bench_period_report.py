@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import datetime as dt
+import random
+
+from sqlalchemy import insert
+
+from middleware.db import SessionLocal
+from middleware.models import Usage
+
+_DAYS = 90
+_MODELS = 30
+_ROWS = 30_000
+
+
+def test_model_day_report_is_one_grouped_query(make_user, client, statements):
+    """90 days x 30 models was 2,700 SUM round trips; the grouped report is a constant few."""
+    uid = make_user()
+    rng = random.Random(8)
+    end = dt.datetime(2026, 10, 18, 4)  # 12:00 UTC+8
+    rows = [
+        dict(user_id=uid, team_id=None, model=f"m{rng.randrange(_MODELS)}", unit="token", total_tokens=100, computed_amount_cents=rng.randint(0, 9), currency="USD", success=True, created_at=end - dt.timedelta(minutes=rng.randrange(60 * 24 * _DAYS)))
+        for _ in range(_ROWS)
+    ]
+    with SessionLocal() as s:
+        s.execute(insert(Usage), rows)
+        s.commit()
+    expected: dict[tuple[str, str], list[int]] = {}
+    for r in rows:
+        key = ((r["created_at"] + dt.timedelta(hours=8)).strftime("%Y-%m-%d"), r["model"])
+        acc = expected.setdefault(key, [0, 0])
+        acc[0] += r["computed_amount_cents"]
+        acc[1] += r["total_tokens"]
+
+    statements.clear()
+    r = client.get(f"/v1/reports/period?user_id={uid}&date_from=2026-07-19&date_to=2026-10-18&group_by=model_day", headers={"x-api-key": "dev"})
+    assert r.status_code == 200, r.text
+    usage_statements = [st for st in statements if " usage" in st]
+    assert len(usage_statements) == 1
+    assert len(statements) <= 5
+
+    got = {(g["date"], g["model"]): [g["usage_amount_cents"], g["usage_tokens"]] for g in r.json()["groups"]}
+    assert got == {k: v for k, v in expected.items() if v[0] or v[1]}
@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+from middleware.ratelimit import SlidingWindowLimiter
+
+_IDENTITIES = 10_000
+_LIMIT = 120
+_WINDOW = 60
+
+
+def _run(limiter: SlidingWindowLimiter, limit: int, hits_per_ident: int, now: float) -> int:
+    allowed = 0
+    for n in range(hits_per_ident):
+        for i in range(_IDENTITIES):
+            allowed += limiter.hit(f"ip:{i}", limit, _WINDOW, now + n * 0.001).allowed
+    return allowed
+
+
+def test_10k_identities_at_120_per_window():
+    limiter = SlidingWindowLimiter(max_identities=_IDENTITIES)
+    now = 1_000_000 * _WINDOW + 1.0  # just after a window boundary: no carry-over
+    hits = _LIMIT + 10
+    allowed = _run(limiter, _LIMIT, hits, now)
+    assert allowed == _LIMIT * _IDENTITIES
+    assert len(limiter) == _IDENTITIES
+
+
+def test_state_per_identity_does_not_grow_with_the_limit():
+    """A hit touches three integers per identity whatever the limit (no per-request timestamps)."""
+    now = 1_000_000 * _WINDOW + 1.0
+    small = SlidingWindowLimiter(max_identities=_IDENTITIES)
+    large = SlidingWindowLimiter(max_identities=_IDENTITIES)
+    _run(small, _LIMIT, 20, now)
+    _run(large, _LIMIT * 100, 20, now)
+    idx = int(now // _WINDOW)
+    for limiter in (small, large):
+        assert len(limiter) == _IDENTITIES
+        assert all(entry == [idx, 20, 0] for entry in limiter._entries.values())
+
+
+def test_memory_is_bounded_by_max_identities():
+    limiter = SlidingWindowLimiter(max_identities=1_000)
+    now = 1_000_000 * _WINDOW + 1.0
+    for i in range(_IDENTITIES):
+        limiter.hit(f"ip:{i}", _LIMIT, _WINDOW, now)
+    assert len(limiter) == 1_000
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+from middleware import wallets
+from middleware.db import SessionLocal
+from middleware.models import LedgerEntry, Wallet
+
+_THREADS = 16
+_OPS = 50
+
+
+def _balance_and_ledger(uid: int) -> tuple[int, int, int]:
+    with SessionLocal() as s:
+        w = s.query(Wallet).filter_by(user_id=uid, currency="USD").one()
+        total, n = s.query(func.coalesce(func.sum(LedgerEntry.amount_cents), 0), func.count(LedgerEntry.id)).filter(LedgerEntry.wallet_id == w.id).one()
+        return int(w.balance_cents), int(total), int(n)
+
+
+def test_concurrent_credits_and_debits_on_one_wallet_lose_nothing(make_user):
+    uid = make_user()
+
+    def work() -> None:
+        for i in range(_OPS):
+            while True:
+                try:
+                    if i % 4 == 3:
+                        wallets.debit_wallet(uid, "usd", 1, "refund")
+                    else:
+                        wallets.credit_wallet(uid, "usd", 2, "recharge")
+                    break
+                except OperationalError:  # sqlite: database is locked
+                    time.sleep(0.001)
+
+    threads = [threading.Thread(target=work) for _ in range(_THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    ops = _THREADS * _OPS
+
+    expected = _THREADS * sum(-1 if i % 4 == 3 else 2 for i in range(_OPS))
+    balance, ledger_total, entries = _balance_and_ledger(uid)
+    assert balance == expected
+    assert ledger_total == expected
+    assert entries == ops
+
+
+def test_batch_of_movements_is_two_statements(make_user, statements):
+    uid = make_user()
+    wallets.credit_wallet(uid, "USD", 1, "open")
+    movements = [wallets.WalletMovement(uid, "USD", 1, "recharge") for _ in range(5000)]
+
+    statements.clear()
+    balances = wallets.apply_wallet_movements(movements)
+
+    assert balances[-1] == 5001
+    # one UPDATE .. RETURNING for the wallet and one executemany for the ledger rows
+    assert len(statements) == 2, statements
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+
+from middleware import db, db_migrate
+
+
+@pytest.fixture
+def fresh_engine(monkeypatch, tmp_path):
+    """Point init_db/run_migrations at an empty SQLite database of their own."""
+    engine = create_engine(f"sqlite:///{tmp_path}/fresh.db", future=True)
+    monkeypatch.setattr(db, "engine", engine)
+    monkeypatch.setattr(db_migrate, "engine", engine)
+    monkeypatch.setattr(db_migrate, "SessionLocal", sessionmaker(bind=engine, autoflush=False, future=True, expire_on_commit=False))
+    yield engine
+    engine.dispose()
+
+
+def _missing_indexes(engine) -> list[str]:
+    insp = inspect(engine)
+    return [name for table, names in db_migrate.HOT_INDEXES.items() for name in names if name not in {ix["name"] for ix in insp.get_indexes(table)}]
+
+
+def test_init_and_migrate_twice_on_a_fresh_database(fresh_engine):
+    for _ in range(2):
+        db.init_db()
+        assert db_migrate.run_migrations() == db_migrate.TARGET_DB_LAYER
+    assert _missing_indexes(fresh_engine) == []
+    assert [q["name"] for q in db_migrate.explain_hot_queries() if not q["uses_index"]] == []
+
+
+def test_migration_adds_indexes_to_an_existing_database(fresh_engine):
+    db.init_db()
+    with fresh_engine.begin() as conn:
+        for names in db_migrate.HOT_INDEXES.values():
+            for name in names:
+                conn.execute(text(f"DROP INDEX {name}"))
+    with db_migrate.SessionLocal() as s:
+        db_migrate._get_current_layer(s)
+        db_migrate._set_layer(s, 3)
+        s.commit()
+    assert len(_missing_indexes(fresh_engine)) == sum(map(len, db_migrate.HOT_INDEXES.values()))
+
+    assert db_migrate.run_migrations() == db_migrate.TARGET_DB_LAYER
+    assert _missing_indexes(fresh_engine) == []
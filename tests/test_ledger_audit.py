@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+from sqlalchemy import event, text
+
+from middleware import ledger_audit
+from middleware.config import settings
+from middleware.db import SessionLocal, engine
+from middleware.models import LedgerCheckpoint, Wallet
+from middleware.wallets import credit_wallet
+
+
+def test_concurrent_run_creating_the_same_checkpoint(monkeypatch, make_user):
+    monkeypatch.setattr(settings, "LEDGER_CHECKPOINT_SETTLE_SEC", 0)
+    uid = make_user()
+    credit_wallet(uid, "USD", 70, "topup")
+    credit_wallet(uid, "USD", 30, "topup")
+    with SessionLocal() as s:
+        wallet_id = s.query(Wallet.id).filter_by(user_id=uid).scalar()
+        # another run's checkpoint, created just before ours is inserted, covering only the first entry
+        first_entry = s.execute(text("SELECT MIN(id) FROM ledger_entries WHERE wallet_id = :w"), {"w": wallet_id}).scalar()
+
+    raced = []
+
+    def _race(conn, cursor, statement, parameters, context, executemany):
+        if not raced and statement.startswith("INSERT INTO ledger_checkpoints"):
+            raced.append(True)
+            with engine.connect() as other:
+                other.execute(
+                    text("INSERT INTO ledger_checkpoints (wallet_id, last_entry_id, balance_cents, updated_at) VALUES (:w, :e, 70, CURRENT_TIMESTAMP)"),
+                    {"w": wallet_id, "e": first_entry},
+                )
+                other.commit()
+
+    event.listen(engine, "before_cursor_execute", _race)
+    try:
+        res = ledger_audit.reconcile()
+    finally:
+        event.remove(engine, "before_cursor_execute", _race)
+
+    assert raced
+    assert wallet_id not in {d["wallet_id"] for d in res["discrepancies"]}
+    with SessionLocal() as s:
+        cp = s.get(LedgerCheckpoint, wallet_id)
+        assert cp.balance_cents == 100 and cp.last_entry_id > first_entry
+    # the next run replays nothing for this wallet and still agrees
+    res = ledger_audit.reconcile()
+    assert wallet_id not in {d["wallet_id"] for d in res["discrepancies"]}
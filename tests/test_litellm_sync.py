@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import uuid
+
+import httpx
+import pytest
+
+from middleware.config import settings
+from middleware.db import SessionLocal
+from middleware.integrations import litellm_sync
+from middleware.wallets import WalletMovement, apply_wallet_movements
+
+
+@pytest.fixture
+def litellm(monkeypatch, upstream):
+    """Budget upserts seen by a fake LiteLLM; luids listed in fail get a 500."""
+    monkeypatch.setattr(settings, "LITELLM_MASTER_KEY", "mk")
+    monkeypatch.setattr(litellm_sync, "_last_entry_id", None)
+    monkeypatch.setattr(litellm_sync, "_pending", set())
+    seen: dict[str, float] = {}
+    fail: set[str] = set()
+    active = [0, 0]  # in flight, max in flight
+
+    async def _handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        active[0] += 1
+        active[1] = max(active[1], active[0])
+        await asyncio.sleep(0.01)
+        active[0] -= 1
+        if body["user_id"] in fail:
+            return httpx.Response(500)
+        seen[body["user_id"]] = body["max_budget"]
+        return httpx.Response(200, json={})
+
+    upstream(_handler)
+    asyncio.run(litellm_sync.sync_wallets_to_litellm())  # push whatever earlier tests left behind
+    seen.clear()
+    active[1] = 0
+    return seen, fail, active
+
+
+def _user(make_user, cents: int) -> tuple[int, str]:
+    luid = f"ll-{uuid.uuid4().hex[:8]}"
+    uid = make_user(litellm_user_id=luid)
+    apply_wallet_movements([WalletMovement(uid, "USD", cents, "recharge", {})])
+    return uid, luid
+
+
+def test_sync_pushes_only_changed_wallets(litellm, make_user, monkeypatch):
+    seen, _fail, active = litellm
+    monkeypatch.setattr(settings, "LITELLM_SYNC_CONCURRENCY", 2)
+    users = [_user(make_user, 100 * (i + 1)) for i in range(5)]
+
+    summary = asyncio.run(litellm_sync.sync_wallets_to_litellm())
+    assert summary["pushed"] == 5 and summary["failed"] == 0
+    assert seen == {luid: i + 1.0 for i, (_uid, luid) in enumerate(users)}
+    assert active[1] == 2
+
+    seen.clear()
+    summary = asyncio.run(litellm_sync.sync_wallets_to_litellm())
+    assert summary["pushed"] == 0 and seen == {}
+
+    uid, luid = users[0]
+    apply_wallet_movements([WalletMovement(uid, "USD", -30, "usage", {})])
+    summary = asyncio.run(litellm_sync.sync_wallets_to_litellm())
+    assert summary["pushed"] == 1 and seen == {luid: 0.7}
+
+
+def test_failed_push_is_retried_next_run(litellm, make_user):
+    seen, fail, _active = litellm
+    (_a, ok), (_b, bad) = _user(make_user, 100), _user(make_user, 200)
+    fail.add(bad)
+    mark = litellm_sync._last_entry_id
+
+    summary = asyncio.run(litellm_sync.sync_wallets_to_litellm())
+    assert summary["pushed"] == 1 and summary["failed"] == 1
+    assert seen == {ok: 1.0}
+    assert litellm_sync._last_entry_id == mark  # mark held back until every push succeeds
+
+    seen.clear()
+    fail.clear()
+    summary = asyncio.run(litellm_sync.sync_wallets_to_litellm())
+    assert summary["pushed"] == 1 and summary["failed"] == 0
+    assert seen == {bad: 2.0}
+
+
+def test_sync_is_skipped_without_a_master_key(litellm, make_user, monkeypatch):
+    seen, _fail, _active = litellm
+    monkeypatch.setattr(settings, "LITELLM_MASTER_KEY", None)
+    _user(make_user, 100)
+    assert asyncio.run(litellm_sync.sync_wallets_to_litellm())["pushed"] == 0
+    assert seen == {}
+
+
+def test_wallet_movements_are_pushed_without_waiting_for_a_sync_run(litellm, make_user, monkeypatch):
+    seen, _fail, _active = litellm
+    uid, luid = _user(make_user, 100)
+    assert litellm_sync._pending == set()  # not noted while nobody drains them
+
+    monkeypatch.setattr(litellm_sync, "_listening", True)
+    apply_wallet_movements([WalletMovement(uid, "USD", 400, "recharge", {})])
+    apply_wallet_movements([WalletMovement(uid, "USD", -50, "usage", {})])
+    assert litellm_sync._pending == {uid}
+
+    assert asyncio.run(litellm_sync.flush_budget_events()) == 1
+    assert seen == {luid: 4.5}
+    assert litellm_sync._pending == set()
+
+
+def test_movements_in_a_caller_session_are_noted_on_commit(litellm, make_user, monkeypatch):
+    monkeypatch.setattr(litellm_sync, "_listening", True)
+    uid, _luid = _user(make_user, 100)
+    litellm_sync._pending.clear()
+
+    with SessionLocal() as s:
+        apply_wallet_movements([WalletMovement(uid, "USD", 5, "recharge", {})], session=s)
+        s.rollback()
+    assert litellm_sync._pending == set()
+
+    with SessionLocal() as s:
+        apply_wallet_movements([WalletMovement(uid, "USD", 5, "recharge", {})], session=s)
+        assert litellm_sync._pending == set()
+        s.commit()
+    assert litellm_sync._pending == {uid}
+
+
+def test_run_budget_events_drains_until_cancelled(litellm, make_user, monkeypatch):
+    seen, _fail, _active = litellm
+    monkeypatch.setattr(settings, "LITELLM_BUDGET_PUSH_DELAY_MS", 100)
+    uid, luid = _user(make_user, 100)
+
+    async def _scenario() -> None:
+        task = asyncio.create_task(litellm_sync.run_budget_events())
+        await asyncio.sleep(0)
+        assert litellm_sync._listening
+        await asyncio.to_thread(apply_wallet_movements, [WalletMovement(uid, "USD", 900, "recharge", {})])
+        for _ in range(50):
+            if luid in seen:
+                break
+            await asyncio.sleep(0.02)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(_scenario())
+    assert seen == {luid: 10.0}
+    assert not litellm_sync._listening
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import datetime as dt
+import json
+import uuid
+
+import httpx
+import pytest
+from sqlalchemy import update
+
+from middleware import outbox
+from middleware.billing.service import enqueue_http_post
+from middleware.config import settings
+from middleware.db import SessionLocal
+from middleware.models import EventOutbox
+
+
+@pytest.fixture
+def hooks(monkeypatch):
+    """Send the outbox to a fake HTTP client; returns (posts, failing endpoints)."""
+    with SessionLocal() as s:  # start from an empty queue
+        s.execute(update(EventOutbox).where(EventOutbox.status == "pending").values(status="sent"))
+        s.commit()
+    posts: list[tuple[str, object]] = []
+    fail: set[str] = set()
+
+    def _handler(request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        posts.append((url, json.loads(request.content)))
+        return httpx.Response(503 if url in fail else 200)
+
+    monkeypatch.setattr(outbox, "_client", httpx.Client(transport=httpx.MockTransport(_handler)))
+    yield posts, fail
+    outbox.close()
+
+
+def _endpoint(suffix: str = "/events") -> str:
+    return f"http://hook-{uuid.uuid4().hex[:8]}.test{suffix}"
+
+
+def _rows(ids: list[int]) -> list[EventOutbox]:
+    with SessionLocal() as s:
+        return s.query(EventOutbox).filter(EventOutbox.id.in_(ids)).order_by(EventOutbox.id).all()
+
+
+def _drain() -> int:
+    total = 0
+    while n := outbox.dispatch_once():
+        total += n
+    return total
+
+
+def test_rows_go_out_in_order_per_endpoint(hooks):
+    posts, _fail = hooks
+    a, b = _endpoint(), _endpoint()
+    ids = [enqueue_http_post(endpoint=ep, payload={"n": i}).id for i in range(3) for ep in (a, b)]
+
+    assert outbox.dispatch_once() == 6
+    assert [body["n"] for url, body in posts if url == a] == [0, 1, 2]
+    assert [body["n"] for url, body in posts if url == b] == [0, 1, 2]
+    rows = _rows(ids)
+    assert {r.status for r in rows} == {"sent"}
+    assert {r.locked_by for r in rows} == {None}
+
+
+def test_batch_endpoints_get_coalesced_posts(hooks, monkeypatch):
+    posts, _fail = hooks
+    monkeypatch.setattr(settings, "OUTBOX_BATCH_ENDPOINTS", "/api/v1/events")
+    monkeypatch.setattr(settings, "OUTBOX_BATCH_SIZE", 2)
+    ep = _endpoint("/api/v1/events")
+    ids = [enqueue_http_post(endpoint=ep, payload={"n": i}).id for i in range(5)]
+
+    assert _drain() == 5
+    assert [url for url, _ in posts] == [ep + "/batch"] * 3
+    assert [[e["n"] for e in body["events"]] for _, body in posts] == [[0, 1], [2, 3], [4]]
+    assert {r.status for r in _rows(ids)} == {"sent"}
+
+
+def test_failure_holds_back_the_rows_behind_it(hooks):
+    posts, fail = hooks
+    bad, good = _endpoint(), _endpoint()
+    fail.add(bad)
+    bad_ids = [enqueue_http_post(endpoint=bad, payload={"n": i}).id for i in range(3)]
+    good_id = enqueue_http_post(endpoint=good, payload={"n": 0}).id
+
+    assert outbox.dispatch_once() == 1
+    assert [url for url, _ in posts].count(bad) == 1  # stopped at the first failure
+    head, *behind = _rows(bad_ids)
+    assert head.status == "pending" and head.attempts == 1 and head.next_attempt_at > dt.datetime.utcnow()
+    assert "503" in head.last_error
+    assert [(r.status, r.attempts, r.locked_by) for r in behind] == [("pending", 0, None)] * 2
+    assert _rows([good_id])[0].status == "sent"
+
+    # the head is backing off, so nothing of that endpoint is due
+    posts.clear()
+    assert outbox.dispatch_once() == 0 and posts == []
+
+
+def _due(ids: list[int]) -> None:
+    with SessionLocal() as s:
+        s.execute(update(EventOutbox).where(EventOutbox.id.in_(ids)).values(next_attempt_at=dt.datetime.utcnow()))
+        s.commit()
+
+
+def test_claim_leases_an_endpoint_to_one_dispatcher(hooks):
+    ep = _endpoint()
+    ids = [enqueue_http_post(endpoint=ep, payload={"n": i}).id for i in range(4)]
+
+    first, rows = outbox.claim(10, 3)
+    assert [r.id for r in rows] == ids[:3]
+    assert outbox.claim(10, 3)[1] == []  # head leased; the rest are not heads
+
+    # the first dispatcher dies; its lease runs out
+    with SessionLocal() as s:
+        s.execute(update(EventOutbox).where(EventOutbox.locked_by == first).values(locked_until=dt.datetime.utcnow() - dt.timedelta(seconds=1)))
+        s.commit()
+    second, rows = outbox.claim(10, 3)
+    assert [r.id for r in rows] == ids[:3]
+
+    # a late settle under the expired lease changes nothing
+    outbox._finish(first, rows, [r.id for r in rows], [], [])
+    assert {(r.status, r.locked_by) for r in _rows(ids[:3])} == {("pending", second)}
+    outbox._finish(second, rows, [r.id for r in rows], [], [])
+    assert [r.status for r in _rows(ids)] == ["sent", "sent", "sent", "pending"]
+
+
+def test_failures_back_off_then_go_dead(hooks, monkeypatch):
+    posts, fail = hooks
+    monkeypatch.setattr(settings, "OUTBOX_MAX_ATTEMPTS", 3)
+    ep = _endpoint()
+    fail.add(ep)
+    rid = enqueue_http_post(endpoint=ep, payload={"n": 0}).id
+
+    waits = []
+    for attempt in (1, 2):
+        before = dt.datetime.utcnow()
+        outbox.dispatch_once()
+        (row,) = _rows([rid])
+        assert (row.status, row.attempts) == ("pending", attempt)
+        waits.append(round((row.next_attempt_at - before).total_seconds()))
+        _due([rid])
+    assert waits == [2, 4]
+
+    outbox.dispatch_once()
+    (row,) = _rows([rid])
+    assert (row.status, row.attempts, row.next_attempt_at) == ("dead", 3, None)
+    assert row.last_error.startswith("dead after 3 attempts")
+    assert len(posts) == 3
+
+
+def test_unsendable_rows_go_dead_without_a_request(hooks):
+    posts, _fail = hooks
+    with SessionLocal() as s:
+        row = EventOutbox(event_type="smtp", endpoint=_endpoint(), payload={"n": 0}, status="pending", attempts=0)
+        s.add(row)
+        s.commit()
+    outbox.dispatch_once()
+    (row,) = _rows([row.id])
+    assert (row.status, row.last_error) == ("dead", "unsupported event_type/payload")
+    assert posts == []
+
+
+def test_dead_rows_are_listed_and_replayed(hooks, client, monkeypatch):
+    posts, fail = hooks
+    monkeypatch.setattr(settings, "OUTBOX_MAX_ATTEMPTS", 1)
+    ep, other = _endpoint(), _endpoint()
+    fail.update({ep, other})
+    ids = [enqueue_http_post(endpoint=ep, payload={"n": i}).id for i in range(2)]
+    other_id = enqueue_http_post(endpoint=other, payload={"n": 0}).id
+    for _ in ids:
+        outbox.dispatch_once()
+    assert {r.status for r in _rows(ids + [other_id])} == {"dead"}
+
+    admin = {"x-api-key": "dev"}
+    dead = client.get(f"/v1/admin/outbox/dead?endpoint={ep}", headers=admin).json()["rows"]
+    assert [r["id"] for r in dead] == ids[::-1]
+    assert client.post("/v1/admin/outbox/replay", json={}, headers=admin).status_code == 400
+
+    r = client.post("/v1/admin/outbox/replay", json={"endpoint": ep}, headers=admin)
+    assert r.json()["replayed"] == 2
+    assert [(x.status, x.attempts, x.last_error) for x in _rows(ids)] == [("pending", 0, None)] * 2
+    assert _rows([other_id])[0].status == "dead"
+
+    fail.clear()
+    posts.clear()
+    assert _drain() == 2
+    assert [body["n"] for _, body in posts] == [0, 1]
+    assert outbox.replay_dead(ids=ids) == 0  # only dead rows are requeued
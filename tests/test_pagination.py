@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import datetime as dt
+import uuid
+
+import pytest
+
+from middleware import pagination
+from middleware.db import SessionLocal
+from middleware.models import LedgerEntry, Wallet
+from middleware.plans import service as plans
+from middleware.wallets import WalletMovement, apply_wallet_movements
+
+DEV = {"x-api-key": "dev"}
+
+
+def _ledger(user_id: int, n: int) -> None:
+    """n ledger entries that all share one created_at (ties on the displayed order)."""
+    apply_wallet_movements([WalletMovement(user_id, "USD", 1, "recharge", {"i": i}) for i in range(n)])
+    with SessionLocal() as s:
+        wallet_ids = s.query(Wallet.id).filter(Wallet.user_id == user_id)
+        s.query(LedgerEntry).filter(LedgerEntry.wallet_id.in_(wallet_ids)).update({LedgerEntry.created_at: dt.datetime(2026, 10, 18, 12)}, synchronize_session=False)
+        s.commit()
+
+
+def _walk(client, url: str, key: str) -> tuple[list, list]:
+    items, cursors, cursor = [], [], None
+    while True:
+        r = client.get(url + (f"&cursor={cursor}" if cursor else ""), headers=DEV)
+        assert r.status_code == 200
+        body = r.json()
+        items.extend(body[key])
+        cursors.append(body["next_cursor"])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return items, cursors
+
+
+def test_cursor_round_trip():
+    for last_id in (1, 99, 2**40):
+        assert pagination.decode_cursor(pagination.encode_cursor(last_id)) == last_id
+    for bad in ("", "!!", "b2Zmc2V0OjU"):  # last: "offset:5"
+        with pytest.raises(ValueError):
+            pagination.decode_cursor(bad)
+
+
+@pytest.mark.parametrize("n,limit", [(7, 3), (6, 3), (3, 3), (2, 3)])
+def test_ledger_pages_cover_every_entry_once(client, make_user, n, limit):
+    uid = make_user()
+    _ledger(uid, n)
+
+    entries, cursors = _walk(client, f"/v1/wallets/{uid}/ledger?limit={limit}", "entries")
+    assert [e["meta"]["i"] for e in entries] == list(reversed(range(n)))
+    assert len({e["created_at"] for e in entries}) == 1
+    assert len(cursors) == max(1, -(-n // limit))  # a full last page still ends the walk
+    assert cursors[-1] is None and None not in cursors[:-1]
+
+
+def test_invalid_cursor_is_rejected(client, make_user):
+    uid = make_user()
+    assert client.get(f"/v1/wallets/{uid}/ledger?cursor=nope", headers=DEV).status_code == 400
+    assert client.get("/v1/plans?cursor=nope", headers=DEV).status_code == 400
+
+
+def test_plan_list_cursor_matches_offset_paging(client):
+    tag = uuid.uuid4().hex[:8]
+    ids = [plans.create_plan(name=f"kp-{tag}-{i}", type="usage").id for i in range(5)]
+
+    rows, cursors = _walk(client, f"/v1/plans?q=kp-{tag}&limit=2&include_total=false", "plans")
+    assert [p["id"] for p in rows] == ids[::-1]
+    assert len(cursors) == 3
+
+    by_offset = [p["id"] for off in (0, 2, 4) for p in client.get(f"/v1/plans?q=kp-{tag}&limit=2&offset={off}", headers=DEV).json()["plans"]]
+    assert by_offset == ids[::-1]
+    assert client.get(f"/v1/plans?q=kp-{tag}&limit=2", headers=DEV).json()["total"] == 5
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import json
+import uuid
+
+from middleware.db import SessionLocal
+from middleware.models import Order, Wallet
+from middleware.payments import service
+
+
+def _event(event_id: str, event_type: str, order_id: str, amount: int = 500) -> bytes:
+    return json.dumps({"id": event_id, "type": event_type, "data": {"object": {"id": f"pi_{order_id}", "amount": amount, "currency": "usd", "metadata": {"order_id": order_id}}}}).encode()
+
+
+def _state(uid: int, order_id: str) -> tuple[str, int]:
+    with SessionLocal() as s:
+        status = s.query(Order.status).filter_by(order_id=order_id).scalar()
+        balance = s.query(Wallet.balance_cents).filter_by(user_id=uid, currency="USD").scalar()
+        return status, int(balance or 0)
+
+
+def _order(uid: int) -> str:
+    order_id = f"ord-{uuid.uuid4().hex[:8]}"
+    with SessionLocal() as s:
+        s.add(Order(order_id=order_id, user_id=uid, provider="stripe", amount_cents=500, currency="USD", status="created"))
+        s.commit()
+    return order_id
+
+
+def test_success_after_a_failed_attempt_credits_once(make_user):
+    uid = make_user()
+    order_id = _order(uid)
+
+    service.process_webhook(provider_name="stripe", headers={}, body=_event(f"evt-{order_id}-1", "payment_intent.payment_failed", order_id))
+    assert _state(uid, order_id) == ("failed", 0)
+
+    # the customer retries the payment intent and it goes through
+    service.process_webhook(provider_name="stripe", headers={}, body=_event(f"evt-{order_id}-2", "payment_intent.succeeded", order_id))
+    assert _state(uid, order_id) == ("succeeded", 500)
+
+    # a late failure of the first attempt, then the success redelivered under a new id
+    service.process_webhook(provider_name="stripe", headers={}, body=_event(f"evt-{order_id}-3", "payment_intent.payment_failed", order_id))
+    service.process_webhook(provider_name="stripe", headers={}, body=_event(f"evt-{order_id}-4", "payment_intent.succeeded", order_id))
+    assert _state(uid, order_id) == ("succeeded", 500)
+
+
+def test_success_replayed_after_refund_does_not_credit_again(make_user):
+    uid = make_user()
+    order_id = _order(uid)
+
+    service.process_webhook(provider_name="stripe", headers={}, body=_event(f"evt-{order_id}-1", "payment_intent.succeeded", order_id))
+    assert _state(uid, order_id) == ("succeeded", 500)
+
+    service.process_webhook(provider_name="stripe", headers={}, body=_event(f"evt-{order_id}-2", "charge.refunded", order_id))
+    assert _state(uid, order_id)[0] == "refunded"
+    balance_after_refund = _state(uid, order_id)[1]
+
+    # the success event redelivered under a new id
+    service.process_webhook(provider_name="stripe", headers={}, body=_event(f"evt-{order_id}-3", "payment_intent.succeeded", order_id))
+    assert _state(uid, order_id) == ("refunded", balance_after_refund)
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import uuid
+
+import pytest
+from sqlalchemy import update
+
+from middleware import cache_versions
+from middleware.db import SessionLocal
+from middleware.models import CacheVersion, PlanAssignment
+from middleware.plans import service as plans
+
+
+@pytest.fixture(autouse=True)
+def no_poll(monkeypatch):
+    """Only this worker's own bumps move the stamps unless a test polls explicitly."""
+    monkeypatch.setattr(cache_versions, "_POLL_SEC", 3600.0)
+
+
+def _plan(limit_cents: int = 1000) -> int:
+    p = plans.create_plan(name=f"p-{uuid.uuid4().hex[:6]}", type="daily_limit")
+    plans.upsert_daily_limit(p.id, daily_limit_cents=limit_cents)
+    return p.id
+
+
+def test_warm_reads_do_not_query(make_user, statements):
+    uid = make_user()
+    pid = _plan()
+    plans.assign_plan("user", uid, pid)
+
+    assert plans.get_assignment("user", uid).plan_id == pid
+    assert plans.get_daily_limit_plan(pid).daily_limit_cents == 1000
+    statements.clear()
+    assert plans.get_assignment("user", uid).plan_id == pid
+    assert plans.get_daily_limit_plan(pid).daily_limit_cents == 1000
+    assert statements == []
+
+
+def test_missing_assignment_is_cached_too(make_user, statements):
+    uid = make_user()
+    assert plans.get_assignment("user", uid) is None
+    statements.clear()
+    assert plans.get_assignment("user", uid) is None
+    assert statements == []
+
+
+def test_writes_invalidate_the_cache(make_user):
+    uid = make_user()
+    assert plans.get_assignment("user", uid) is None
+
+    first = _plan()
+    pa = plans.assign_plan("user", uid, first)
+    assert plans.get_assignment("user", uid).plan_id == first
+
+    second = _plan()
+    newer = plans.assign_plan("user", uid, second)
+    assert plans.get_assignment("user", uid).plan_id == second
+
+    plans.upsert_daily_limit(second, daily_limit_cents=2500)
+    assert plans.get_daily_limit_plan(second).daily_limit_cents == 2500
+
+    plans.set_assignment_status(newer.id, status="paused")
+    assert plans.get_assignment("user", uid).plan_id == first
+    plans.set_assignment_status(pa.id, status="canceled")
+    assert plans.get_assignment("user", uid) is None
+
+
+def test_another_workers_bump_is_seen_after_the_poll(make_user):
+    uid = make_user()
+    pid = _plan()
+    plans.get_assignment("user", uid)  # caches "no assignment"
+
+    # another worker assigns the plan: the row and its stamp bump, but no local bump here
+    with SessionLocal() as s:
+        s.add(PlanAssignment(entity_type="user", entity_id=uid, plan_id=pid, status="active", timezone="UTC+8"))
+        s.execute(update(CacheVersion).where(CacheVersion.name == plans.PLANS_CACHE).values(version=CacheVersion.version + 1))
+        s.commit()
+    assert plans.get_assignment("user", uid) is None  # not polled yet
+
+    cache_versions._polled_at = 0.0
+    assert plans.get_assignment("user", uid).plan_id == pid
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import logging
+
+import pytest
+from fastapi import HTTPException
+
+from api.proxy import ChatBody, _gate_request
+from middleware import prepaid
+from middleware.config import settings
+from middleware.db import SessionLocal
+from middleware.models import Wallet
+from middleware.wallets import credit_wallet
+
+
+@pytest.fixture(autouse=True)
+def _prepaid_on(monkeypatch):
+    monkeypatch.setattr(settings, "PREPAID_METERING_ENABLED", True)
+    prepaid.reset()
+    yield
+    prepaid.reset()
+
+
+def _balance(uid: int) -> int:
+    with SessionLocal() as s:
+        return int(s.query(Wallet.balance_cents).filter_by(user_id=uid, currency="USD").scalar() or 0)
+
+
+def test_hold_without_hints_uses_the_token_estimate(make_user, priced_plan):
+    uid = make_user()
+    priced_plan(uid)
+    credit_wallet(uid, "USD", 5, "topup")
+    # ~260 tokens estimated at 10 cents per 1k: a 3 cent hold
+    body = ChatBody(model="gpt-4o", messages=[{"role": "user", "content": "hello"}])
+
+    _model, _bctx, hold, _charge = _gate_request(uid, body, "sk-unlinked")
+    assert hold is not None and hold.cents == 3
+    with pytest.raises(HTTPException) as e:
+        _gate_request(uid, body, "sk-unlinked")
+    assert e.value.status_code == 402
+
+    prepaid.release(hold)
+    _gate_request(uid, body, "sk-unlinked")
+
+
+def test_settle_leaves_the_wallet_write_to_the_flusher(make_user, statements):
+    uid = make_user()
+    credit_wallet(uid, "USD", 100, "topup")
+    hold = prepaid.reserve(uid, 10)
+
+    statements.clear()
+    prepaid.settle(hold, 7)
+    assert statements == []
+    assert _balance(uid) == 100
+
+    assert prepaid.flush() == 1
+    assert _balance(uid) == 93
+
+
+def test_flush_isolates_a_user_without_wallet_row(make_user, caplog):
+    good = make_user()
+    credit_wallet(good, "USD", 100, "topup")
+    missing = 10**9  # no User row: the wallet cannot be created
+    for uid in (good, missing):
+        prepaid.settle(prepaid.Hold(user_id=uid, cents=0), 4)
+
+    with caplog.at_level(logging.ERROR, logger="middleware.prepaid"):
+        assert prepaid.flush() == 1
+    assert _balance(good) == 96
+    assert any("prepaid.movement_dropped" in r.getMessage() and f"user_id={missing}" in r.getMessage() for r in caplog.records)
+    # nothing is left to retry
+    assert prepaid.flush() == 0
+
+
+def test_usd_cost_is_not_debited_from_a_wallet_in_another_currency(monkeypatch, make_user, priced_plan):
+    monkeypatch.setattr(settings, "PREPAID_METERING_CURRENCY", "CNY")
+    uid = make_user()
+    priced_plan(uid, meta={"rpm_limit": 1})
+    credit_wallet(uid, "CNY", 10_000, "topup")
+    body = ChatBody(model="gpt-4o", messages=[{"role": "user", "content": "hello"}])
+
+    with pytest.raises(prepaid.CurrencyMismatch):
+        prepaid.reserve(uid, 3)
+    for _ in range(2):
+        # refused as a misconfiguration, and the request is not left on the RPM quota
+        with pytest.raises(HTTPException) as e:
+            _gate_request(uid, body, "sk-unlinked")
+        assert e.value.status_code == 503
+
+    monkeypatch.setattr(settings, "PREPAID_METERING_CURRENCY", "cny")
+    assert prepaid.reserve(uid, 3, currency="CNY").cents == 3
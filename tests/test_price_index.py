@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import datetime as dt
+import random
+
+from middleware.db import SessionLocal
+from middleware.models import PriceRule
+from middleware.plans import service as plans
+from middleware.plans.price_index import PriceIndex
+
+
+def _scan(rules: list[PriceRule], model: str, now: dt.datetime) -> PriceRule | None:
+    """The linear scan the index replaced: an exact pattern, else the first matching wildcard by id."""
+    live = [r for r in sorted(rules, key=lambda r: r.id) if (r.effective_from is None or now >= r.effective_from) and (r.effective_to is None or now < r.effective_to)]
+    for r in live:
+        if r.model_pattern == model:
+            return r
+    for r in live:
+        p = r.model_pattern
+        if p == "*" or (p.endswith("*") and model.startswith(p[:-1])) or (p.startswith("*") and model.endswith(p[1:])):
+            return r
+    return None
+
+
+def test_index_matches_the_linear_scan():
+    rng = random.Random(5)
+    now = dt.datetime(2026, 10, 18)
+    parts = ["gpt", "-4", "o", "-mini", "claude", "-3", "x"]
+    names = ["".join(rng.choice(parts) for _ in range(rng.randint(1, 4))) for _ in range(60)]
+    for trial in range(50):
+        rules = []
+        for i in range(rng.randint(1, 40)):
+            base = rng.choice(names)
+            pattern = rng.choice([base, base[: rng.randint(0, len(base))] + "*", "*" + base[rng.randint(0, len(base)):], "*"])
+            window = rng.random()
+            rules.append(PriceRule(
+                id=rng.randint(1, 10_000) * 100 + i,
+                model_pattern=pattern,
+                effective_from=now + dt.timedelta(days=1) if window < 0.1 else None,
+                effective_to=now - dt.timedelta(days=1) if 0.1 <= window < 0.2 else None,
+            ))
+        idx = PriceIndex(rules)
+        for model in names:
+            assert idx.match(model, now=now) is _scan(rules, model, now), (trial, model)
+
+
+def test_exact_beats_an_older_wildcard_and_expired_rules_are_skipped():
+    now = dt.datetime(2026, 10, 18)
+    wildcard = PriceRule(id=1, model_pattern="gpt-*")
+    exact = PriceRule(id=2, model_pattern="gpt-4o")
+    expired = PriceRule(id=0, model_pattern="gpt-4o", effective_to=now)
+    idx = PriceIndex([exact, wildcard, expired])
+    assert idx.match("gpt-4o", now=now) is exact
+    assert idx.match("gpt-4o-mini", now=now) is wildcard
+    assert idx.match("claude", now=now) is None
+
+
+def test_new_rule_is_visible_to_the_cached_index():
+    p = plans.create_plan(name="price-index", type="daily_limit")
+    plans.add_price_rule(p.id, model_pattern="gpt-*", unit="token", unit_base_price_cents=10)
+    with SessionLocal() as s:
+        assert plans.find_price_rule(s, p.id, "gpt-4o").unit_base_price_cents == 10
+    plans.add_price_rule(p.id, model_pattern="gpt-4o", unit="token", unit_base_price_cents=30)
+    with SessionLocal() as s:
+        assert plans.find_price_rule(s, p.id, "gpt-4o").unit_base_price_cents == 30
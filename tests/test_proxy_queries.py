@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import pytest
+from fastapi import HTTPException
+
+from api.proxy import ChatBody, _gate_request, _settle_usage
+from middleware.config import settings
+
+_BODY = ChatBody(model="gpt-4o", messages=[{"role": "user", "content": "hi"}])
+_USAGE = {"prompt_tokens": 1000, "completion_tokens": 1000}
+
+
+def _call(uid: int, request_id: str) -> bool:
+    model, bctx, hold, charge = _gate_request(uid, _BODY, "sk-unlinked")
+    return _settle_usage(bctx, model=model, usage=_USAGE, request_id=request_id, hold=hold, charge=charge)
+
+
+def test_warm_gate_and_settle_stay_within_statement_budget(monkeypatch, make_user, priced_plan, statements):
+    monkeypatch.setattr(settings, "OVERDRAFT_GATING_ENABLED", True)
+    uid = make_user()
+    priced_plan(uid)
+    _call(uid, "q-warm")  # fills the plan, price, spend and key caches
+
+    statements.clear()
+    _call(uid, "q-1")
+    # with the recorder thread off, the Usage row is inserted inline; that is the only write
+    assert len(statements) <= 2, statements
+    assert not [st for st in statements if "overdraft_alerts" in st], statements
+
+
+def test_overdraft_gates_next_request_without_requery(monkeypatch, make_user, priced_plan, statements):
+    monkeypatch.setattr(settings, "OVERDRAFT_GATING_ENABLED", True)
+    monkeypatch.setattr(settings, "OVERDRAFT_GATING_MODE", "block")
+    uid = make_user()
+    priced_plan(uid, limit_cents=15, policy="block")
+    assert _call(uid, "q-over") is True  # 20 cents against a 15 cent limit
+
+    statements.clear()
+    with pytest.raises(HTTPException) as e:
+        _gate_request(uid, _BODY, "sk-unlinked")
+    assert e.value.status_code == 403
+    assert not [st for st in statements if "overdraft_alerts" in st], statements
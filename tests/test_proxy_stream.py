@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+
+import httpx
+
+from middleware import prepaid, quotas, usage_recorder
+from middleware.config import settings
+from middleware.db import SessionLocal
+from middleware.models import Usage
+from middleware.ratelimit import get_limiter
+from middleware.wallets import credit_wallet
+
+_USAGE = {"prompt_tokens": 1000, "completion_tokens": 500, "total_tokens": 1500}
+
+
+class _StalledStream(httpx.AsyncByteStream):
+    """Sends a content delta and the usage chunk, then hangs until closed."""
+
+    def __init__(self) -> None:
+        self.closed = asyncio.Event()
+
+    async def __aiter__(self):
+        yield b'data: {"choices":[{"delta":{"content":"he"}}]}\n\n'
+        yield b'data: {"choices":[],"usage":' + json.dumps(_USAGE).encode() + b"}\n\n"
+        await self.closed.wait()
+
+    async def aclose(self) -> None:
+        self.closed.set()
+
+
+async def _disconnect_after_first_chunk(app, uid: int, request_id: str) -> None:
+    body = json.dumps({"model": "gpt-4o", "messages": [{"role": "user", "content": "x"}], "stream": True}).encode()
+    headers = {"x-api-key": "dev", "x-dev-user-id": str(uid), "x-litellm-api-key": "sk", "x-request-id": request_id, "content-type": "application/json"}
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/v1/proxy/chat/completions",
+        "raw_path": b"/v1/proxy/chat/completions",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(k.encode(), v.encode()) for k, v in headers.items()],
+        "client": ("127.0.0.1", 1234),
+        "server": ("testserver", 80),
+    }
+    got_chunk = asyncio.Event()
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await got_chunk.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            got_chunk.set()
+
+    await asyncio.wait_for(app(scope, receive, send), timeout=5)
+    # the detached settlement task runs on this loop; let it finish
+    from api import proxy
+
+    for _ in range(100):
+        if not proxy._settle_tasks:
+            break
+        await asyncio.sleep(0.02)
+
+
+def test_disconnect_mid_stream_settles_usage_and_releases_hold(monkeypatch, make_user, priced_plan, upstream):
+    from api.server import app
+
+    monkeypatch.setattr(settings, "PREPAID_METERING_ENABLED", True)
+    uid = make_user()
+    priced_plan(uid)
+    credit_wallet(uid, "USD", 100_000, "topup")
+    prepaid.reset()
+    upstream(lambda request: httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=_StalledStream()))
+
+    asyncio.run(_disconnect_after_first_chunk(app, uid, "disc-1"))
+
+    usage_recorder.flush()
+    with SessionLocal() as s:
+        row = s.query(Usage).filter_by(request_id="disc-1").one()
+    assert row.total_tokens == 1500
+    assert row.computed_amount_cents == 15
+    acc = prepaid._account(uid)
+    assert acc.held == 0
+    assert acc.available() == 100_000 - 15
+
+
+async def _two_streams_without_usage(app, uid: int) -> list[int]:
+    from api import proxy
+
+    body = {"model": "gpt-4o", "messages": [{"role": "user", "content": "x"}], "stream": True}
+    headers = {"x-api-key": "dev", "x-dev-user-id": str(uid), "x-litellm-api-key": "sk"}
+    codes = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver") as c:
+        for _ in range(2):
+            r = await c.post("/v1/proxy/chat/completions", json=body, headers=headers)
+            codes.append(r.status_code)
+            for _ in range(100):
+                if not proxy._settle_tasks:
+                    break
+                await asyncio.sleep(0.02)
+    return codes
+
+
+def test_stream_without_usage_still_counts_the_request(make_user, priced_plan, upstream):
+    from api.server import app
+
+    uid = make_user()
+    priced_plan(uid, meta={"rpm_limit": 1, "tpm_limit": 100_000})
+    upstream(lambda request: httpx.Response(200, headers={"content-type": "text/event-stream"}, content=b'data: {"choices":[{"delta":{"content":"hi"}}]}\n\ndata: [DONE]\n\n'))
+
+    assert asyncio.run(_two_streams_without_usage(app, uid)) == [200, 429]
+    # the token estimate was given back: only the request stays charged
+    d = get_limiter().hit(f"tokens:user:{uid}", 100_000, quotas.WINDOW_SEC, time.time(), 0)
+    assert d.remaining == 100_000
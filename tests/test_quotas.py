@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import time
+import uuid
+
+import pytest
+
+from middleware import quotas
+from middleware.ratelimit import get_limiter
+
+
+def _remaining(ident: str, limit: int) -> int:
+    return get_limiter().hit(ident, limit, quotas.WINDOW_SEC, time.time(), 0).remaining
+
+
+def _scope() -> str:
+    return f"key:{uuid.uuid4().hex[:8]}"
+
+
+def test_settle_without_usage_keeps_the_request_counted():
+    scope = _scope()
+    charge = quotas.precharge([(scope, quotas.Limits(rpm=1, tpm=1000))], tokens=300, cents=0)
+    assert _remaining(f"tokens:{scope}", 1000) == 700
+
+    quotas.settle(charge, tokens=0, cents=0)
+    assert _remaining(f"tokens:{scope}", 1000) == 1000
+    with pytest.raises(quotas.QuotaExceeded) as e:
+        quotas.precharge([(scope, quotas.Limits(rpm=1, tpm=1000))], tokens=1, cents=0)
+    assert e.value.dimension == "requests"
+
+
+def test_release_after_an_upstream_failure_gives_everything_back():
+    scope = _scope()
+    limits = quotas.Limits(rpm=1, tpm=1000)
+    quotas.release(quotas.precharge([(scope, limits)], tokens=300, cents=0))
+    assert quotas.precharge([(scope, limits)], tokens=300, cents=0) is not None
+
+
+def test_estimate_above_the_limit_is_charged_as_the_whole_limit():
+    scope = _scope()
+    charge = quotas.precharge([(scope, quotas.Limits(tpm=1000))], tokens=5000, cents=0)
+    assert charge.entries == [(f"tokens:{scope}", "tokens", 1000)]
+    with pytest.raises(quotas.QuotaExceeded):
+        quotas.precharge([(scope, quotas.Limits(tpm=1000))], tokens=1, cents=0)
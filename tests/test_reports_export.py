@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import csv
+import datetime as dt
+import io
+import json
+
+from api import reports
+from middleware.db import SessionLocal
+from middleware.models import Usage
+from middleware.wallets import WalletMovement, apply_wallet_movements
+
+ADMIN = {"x-api-key": "dev"}
+MODEL = 'acme/"big", v2'  # needs quoting in CSV
+
+
+def _today() -> str:
+    return (dt.datetime.utcnow() + dt.timedelta(hours=8)).strftime("%Y-%m-%d")
+
+
+def _usage(user_id: int, n: int) -> list[int]:
+    with SessionLocal() as s:
+        rows = [Usage(user_id=user_id, model=MODEL, unit="token", total_tokens=10 + i, computed_amount_cents=i, currency="USD", success=bool(i % 2), request_id=None if i else "r\n0") for i in range(n)]
+        s.add_all(rows)
+        s.commit()
+        return [r.id for r in rows]
+
+
+def test_exports_require_admin(client):
+    day = _today()
+    for kind in ("usage", "ledger", "lago_payments"):
+        assert client.get(f"/v1/reports/export/{kind}?date_from={day}&date_to={day}").status_code == 401
+    assert client.get(f"/v1/reports/export/usage?date_from={day}&date_to={day}&format=xml", headers=ADMIN).status_code == 422
+
+
+def test_usage_csv_streams_every_row_in_chunks(client, make_user, monkeypatch):
+    monkeypatch.setattr(reports, "_EXPORT_CHUNK", 2)
+    uid = make_user()
+    ids = _usage(uid, 5)
+    day = _today()
+
+    r = client.get(f"/v1/reports/export/usage?date_from={day}&date_to={day}&user_id={uid}", headers=ADMIN)
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/csv")
+    assert r.headers["content-disposition"] == f'attachment; filename="usage_{day}_{day}.csv"'
+    header, *rows = list(csv.reader(io.StringIO(r.text)))
+    assert header[:5] == ["id", "created_at", "user_id", "team_id", "model"]
+    assert [int(row[0]) for row in rows] == ids
+    first = dict(zip(header, rows[0]))
+    assert first["model"] == MODEL
+    assert first["request_id"] == "r\n0"
+    assert first["team_id"] == ""
+    assert [dict(zip(header, row))["success"] for row in rows] == ["0", "1", "0", "1", "0"]
+
+
+def test_usage_ndjson_keeps_types(client, make_user):
+    uid = make_user()
+    ids = _usage(uid, 2)
+    day = _today()
+
+    r = client.get(f"/v1/reports/export/usage?date_from={day}&date_to={day}&user_id={uid}&success=true&format=ndjson", headers=ADMIN)
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in r.text.splitlines()]
+    assert [x["id"] for x in lines] == ids[1:]
+    assert lines[0]["success"] is True and lines[0]["team_id"] is None and lines[0]["model"] == MODEL
+
+
+def test_ledger_export_serializes_meta(client, make_user):
+    uid = make_user()
+    apply_wallet_movements([WalletMovement(uid, "USD", 500, "recharge", {"note": "a, \"b\""})])
+    day = _today()
+
+    r = client.get(f"/v1/reports/export/ledger?date_from={day}&date_to={day}&user_id={uid}", headers=ADMIN)
+    header, row = list(csv.reader(io.StringIO(r.text)))
+    rec = dict(zip(header, row))
+    assert rec["user_id"] == str(uid) and rec["amount_cents"] == "500" and rec["reason"] == "recharge"
+    assert json.loads(rec["meta"]) == {"note": "a, \"b\""}
+
+    r = client.get(f"/v1/reports/export/ledger?date_from={day}&date_to={day}&user_id={uid}&format=ndjson", headers=ADMIN)
+    (rec,) = [json.loads(line) for line in r.text.splitlines()]
+    assert rec["meta"] == {"note": "a, \"b\""}
+
+
+def test_period_csv_quotes_model_names(client, make_user):
+    uid = make_user()
+    _usage(uid, 3)
+    day = _today()
+
+    r = client.get(f"/v1/reports/period?user_id={uid}&date_from={day}&date_to={day}&group_by=model&format=csv")
+    header, row = list(csv.reader(io.StringIO(r.text)))
+    rec = dict(zip(header, row))
+    assert rec["model"] == MODEL
+    assert rec["usage_amount_cents"] == "3" and rec["usage_tokens"] == "33"
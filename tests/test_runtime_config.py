@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import uuid
+
+import pytest
+from sqlalchemy import text
+
+from middleware import cache_versions, runtime_config
+from middleware.db import SessionLocal
+
+ADMIN = {"x-api-key": "dev"}
+
+
+@pytest.fixture
+def slow_poll(monkeypatch):
+    """Stamps and snapshots that would not refresh on their own during the test."""
+    monkeypatch.setattr(cache_versions, "_POLL_SEC", 3600.0)
+    monkeypatch.setattr(runtime_config, "_cache_ttl_sec", 3600)
+    runtime_config.reload()
+
+
+def _key() -> str:
+    return f"TEST_RC_{uuid.uuid4().hex[:8].upper()}"
+
+
+def _store(key: str, value: str) -> None:
+    """A settings write by another worker (or by hand)."""
+    with SessionLocal() as s:
+        s.execute(text("INSERT OR REPLACE INTO settings(key, value) VALUES(:k, :v)"), {"k": key, "v": value})
+        s.commit()
+
+
+def test_patch_is_visible_on_the_next_get(client, slow_poll, monkeypatch):
+    # even with the reload thread running and the poll interval far away
+    monkeypatch.setattr(runtime_config, "_thread", object())
+    key = _key()
+    assert runtime_config.get(key, int, 7) == 7
+
+    r = client.patch("/v1/settings", json={"values": {key: "42"}}, headers=ADMIN)
+    assert r.status_code == 200 and r.json()["updated"] == [key]
+    assert runtime_config.get(key, int, 7) == 42
+
+    client.patch("/v1/settings", json={"values": {key: "43"}}, headers=ADMIN)
+    assert runtime_config.get(key, int, 7) == 43
+    assert runtime_config.get(key, str) == "43"
+
+
+def test_warm_get_does_not_query(slow_poll, statements):
+    key = _key()
+    _store(key, "on")
+    runtime_config.reload()
+    assert runtime_config.get(key, bool, False) is True
+    statements.clear()
+    assert runtime_config.get(key, bool, False) is True
+    assert runtime_config.get(key + "_UNSET", int, 3) == 3
+    assert statements == []
+
+
+def test_another_workers_patch_is_seen_after_the_poll(slow_poll):
+    key = _key()
+    assert runtime_config.get(key) is None
+
+    _store(key, "x")
+    cache_versions.bump(runtime_config.SETTINGS_CACHE)  # a local bump too: this process wrote it
+    assert runtime_config.get(key) == "x"
+
+    # another worker: the row and the DB stamp move, nothing local does
+    with SessionLocal() as s:
+        s.execute(text("INSERT OR REPLACE INTO settings(key, value) VALUES(:k, :v)"), {"k": key, "v": "y"})
+        cache_versions._bump(s, runtime_config.SETTINGS_CACHE)
+        s.commit()
+    assert runtime_config.get(key) == "x"
+    cache_versions._polled_at = 0.0
+    assert runtime_config.get(key) == "y"
+
+
+def test_direct_db_edits_are_seen_after_the_ttl(slow_poll, monkeypatch):
+    key = _key()
+    assert runtime_config.get(key) is None
+    _store(key, "z")  # no stamp bump at all
+    assert runtime_config.get(key) is None
+
+    monkeypatch.setattr(runtime_config, "_cache_ttl_sec", 0)
+    assert runtime_config.get(key) == "z"
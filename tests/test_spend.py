@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import datetime as dt
+
+from middleware import usage_recorder
+from middleware.db import SessionLocal
+from middleware.models import Usage
+from middleware.plans import service as plans
+from middleware.plans import spend
+
+
+def _store(user_id: int, cents: int, created_at: dt.datetime) -> None:
+    """A usage row written behind this process's back (another worker)."""
+    with SessionLocal() as s:
+        s.add(Usage(user_id=user_id, model="gpt-4o", unit="token", total_tokens=10, computed_amount_cents=cents, currency="USD", success=True, created_at=created_at))
+        s.commit()
+
+
+def test_counter_is_seeded_once_and_bumped_by_recorded_usage(make_user, statements):
+    uid = make_user()
+    start = dt.datetime.utcnow() - dt.timedelta(hours=1)
+    _store(uid, 7, start + dt.timedelta(minutes=5))
+    _store(uid, 100, start - dt.timedelta(minutes=5))  # before the window
+
+    with SessionLocal() as s:
+        assert spend.spent_since(s, uid, reset_time="00:00", start=start) == 7
+        statements.clear()
+        assert spend.spent_since(s, uid, reset_time="00:00", start=start) == 7
+    assert statements == []
+
+    usage_recorder.record(user_id=uid, model="gpt-4o", total_tokens=10, computed_amount_cents=5, request_id=None)
+    usage_recorder.record(user_id=uid, model="gpt-4o", total_tokens=10, computed_amount_cents=9, currency="EUR", request_id=None)
+    with SessionLocal() as s:
+        statements.clear()
+        assert spend.spent_since(s, uid, reset_time="00:00", start=start) == 12
+    assert statements == []
+
+
+def test_window_rollover_reseeds_from_the_table(make_user):
+    uid = make_user()
+    now = dt.datetime.utcnow()
+    _store(uid, 4, now - dt.timedelta(hours=30))
+    _store(uid, 6, now - dt.timedelta(hours=2))
+    with SessionLocal() as s:
+        assert spend.spent_since(s, uid, reset_time="00:00", start=now - dt.timedelta(days=2)) == 10
+        assert spend.spent_since(s, uid, reset_time="00:00", start=now - dt.timedelta(days=1)) == 6
+
+
+def test_reconcile_folds_in_usage_from_other_workers(make_user):
+    uid = make_user()
+    start = dt.datetime.utcnow() - dt.timedelta(hours=1)
+    with SessionLocal() as s:
+        assert spend.spent_since(s, uid, reset_time="00:00", start=start) == 0
+    _store(uid, 11, start + dt.timedelta(minutes=1))
+    with SessionLocal() as s:
+        assert spend.spent_since(s, uid, reset_time="00:00", start=start) == 0  # not seen yet
+
+    assert spend.reconcile() >= 1
+    with SessionLocal() as s:
+        assert spend.spent_since(s, uid, reset_time="00:00", start=start) == 11
+
+
+def test_daily_limit_check_reads_the_running_counter(make_user, priced_plan):
+    uid = make_user()
+    priced_plan(uid, limit_cents=10, policy="block")
+    assert plans.check_daily_limit(uid, add_amount_cents=10)[0] is True
+    usage_recorder.record(user_id=uid, model="gpt-4o", total_tokens=10, computed_amount_cents=8, request_id=None)
+    allowed, policy, _reason, remaining = plans.check_daily_limit(uid, add_amount_cents=3)
+    assert (allowed, policy, remaining) == (False, "block", 2)
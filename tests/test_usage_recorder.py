@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import datetime as dt
+import logging
+import threading
+
+import pytest
+
+from middleware import usage_recorder
+from middleware.db import SessionLocal
+from middleware.models import Usage
+from middleware.plans import spend
+
+
+def _row(user_id: int, request_id: str, **kw) -> dict:
+    return usage_recorder._row(user_id=user_id, model="gpt-4o", total_tokens=10, computed_amount_cents=2, request_id=request_id, **kw)
+
+
+def test_poison_row_is_dead_lettered_after_retries(make_user, caplog):
+    uid = make_user()
+    good = [(_row(uid, f"ok-{i}"), False) for i in range(5)]
+    poison = (_row(uid, "poison", created_at="not a timestamp"), False)
+    with usage_recorder.buffer_lock():
+        usage_recorder._buf[:0] = good[:2] + [poison] + good[2:]
+
+    for _ in range(usage_recorder._ISOLATE_AFTER):
+        with pytest.raises(Exception):
+            usage_recorder._flush_batch()
+    assert usage_recorder.queue_depth() == 6
+
+    with caplog.at_level(logging.ERROR, logger="middleware.usage_recorder"):
+        assert usage_recorder._flush_batch() == 5
+    assert usage_recorder.queue_depth() == 0
+    assert any("usage_recorder.dead_letter" in r.getMessage() and "poison" in r.getMessage() for r in caplog.records)
+    with SessionLocal() as s:
+        assert s.query(Usage).filter(Usage.request_id.like("ok-%"), Usage.user_id == uid).count() == 5
+    assert usage_recorder._flush_batch() == -1
+
+
+def test_spend_seed_does_not_block_batch_writes(make_user):
+    uid = make_user()
+    start = dt.datetime.utcnow() - dt.timedelta(hours=1)
+    with SessionLocal() as s:
+        s.add(Usage(**_row(uid, "stored")))
+        s.commit()
+    with usage_recorder.buffer_lock():
+        usage_recorder._buf.append((_row(uid, "buffered"), False))
+
+    result: list[int] = []
+    # a batch writer holds the flush lock for the whole seed
+    with usage_recorder._flush_lock:
+        t = threading.Thread(target=lambda: result.append(spend._load(SessionLocal(), start, [(uid, "00:00")]).get(uid, 0)))
+        t.start()
+        t.join(5)
+        assert not t.is_alive()
+    # the stored row and the buffered one, each counted once
+    assert result == [4]
+    with spend._lock:
+        spend._pending.pop((uid, "00:00"), None)
+    usage_recorder.flush()
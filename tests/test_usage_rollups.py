@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import datetime as dt
+
+from sqlalchemy import func, insert
+
+from middleware import usage_rollups
+from middleware.config import settings
+from middleware.db import SessionLocal
+from middleware.models import Usage, UsageRollupState
+from middleware.plans.service import utc8_day_start
+
+
+def _mark() -> int:
+    with SessionLocal() as s:
+        return int(s.query(UsageRollupState.last_usage_id).filter_by(name="usage").scalar() or 0)
+
+
+def _insert(ids: list[int], user_id: int, created_at: dt.datetime) -> None:
+    rows = [dict(id=i, user_id=user_id, model="gpt-4o", unit="token", total_tokens=10, computed_amount_cents=3, currency="USD", success=True, created_at=created_at) for i in ids]
+    with SessionLocal() as s:
+        s.execute(insert(Usage), rows)
+        s.commit()
+
+
+def _report_cents(user_id: int, day: dt.datetime) -> int:
+    with SessionLocal() as s:
+        return sum(b[2] for b in usage_rollups.usage_buckets(s, start=day, end=day + dt.timedelta(days=1), user_id=user_id))
+
+
+def test_late_commit_below_a_gap_is_not_skipped(monkeypatch, make_user):
+    monkeypatch.setattr(settings, "USAGE_ROLLUPS_ENABLED", True)
+    monkeypatch.setattr(settings, "USAGE_ROLLUP_SETTLE_SEC", 0)
+    usage_rollups.catch_up()  # fold whatever earlier tests wrote
+    monkeypatch.setattr(settings, "USAGE_ROLLUP_SETTLE_SEC", 120)
+
+    uid = make_user()
+    queued_at = dt.datetime.utcnow() - dt.timedelta(minutes=10)
+    day = utc8_day_start(queued_at)
+    with SessionLocal() as s:
+        base = int(s.query(func.max(Usage.id)).scalar() or 0)
+    # base+3 is allocated but not committed yet; rows after it already are
+    _insert([base + 1, base + 2, base + 4, base + 5], uid, queued_at)
+    assert usage_rollups.catch_up() == 2
+    assert _mark() == base + 2
+
+    _insert([base + 3], uid, queued_at)  # commits late, with its old queue time
+    assert usage_rollups.catch_up() == 3
+    assert _mark() == base + 5
+    assert _report_cents(uid, day) == 5 * 3
+
+
+def test_rolled_back_id_is_passed_after_settle(monkeypatch, make_user):
+    monkeypatch.setattr(settings, "USAGE_ROLLUPS_ENABLED", True)
+    monkeypatch.setattr(settings, "USAGE_ROLLUP_SETTLE_SEC", 0)
+    usage_rollups.catch_up()
+
+    uid = make_user()
+    now = dt.datetime.utcnow()
+    with SessionLocal() as s:
+        base = int(s.query(func.max(Usage.id)).scalar() or 0)
+    _insert([base + 1, base + 3], uid, now)  # base+2 never commits
+    assert usage_rollups.catch_up() == 2
+    assert _mark() == base + 3
+    assert _report_cents(uid, utc8_day_start(now)) == 2 * 3
+
+
+def test_hourly_groups_read_the_hourly_rollup(monkeypatch, make_user, client, statements):
+    monkeypatch.setattr(settings, "USAGE_ROLLUPS_ENABLED", True)
+    monkeypatch.setattr(settings, "USAGE_ROLLUP_SETTLE_SEC", 0)
+    uid = make_user()
+    with SessionLocal() as s:
+        base = int(s.query(func.max(Usage.id)).scalar() or 0)
+    # 2026-10-18 01:xx and 02:xx UTC are 09:00 and 10:00 in UTC+8
+    _insert([base + 1, base + 2], uid, dt.datetime(2026, 10, 18, 1, 5))
+    _insert([base + 3], uid, dt.datetime(2026, 10, 18, 2, 59))
+    usage_rollups.catch_up()
+    _insert([base + 4], uid, dt.datetime(2026, 10, 18, 2, 30))  # above the mark: read raw
+
+    statements.clear()
+    r = client.get(f"/v1/reports/period?user_id={uid}&date_from=2026-10-18&date_to=2026-10-18&group_by=model_hour")
+    assert r.status_code == 200, r.text
+    assert r.json()["groups"] == [
+        {"hour": "2026-10-18 09:00", "model": "gpt-4o", "usage_amount_cents": 6, "usage_tokens": 20},
+        {"hour": "2026-10-18 10:00", "model": "gpt-4o", "usage_amount_cents": 6, "usage_tokens": 20},
+    ]
+    assert any("usage_rollup_hourly" in st for st in statements)
+
+    csv = client.get(f"/v1/reports/period?user_id={uid}&date_from=2026-10-18&date_to=2026-10-18&group_by=hour&format=csv").text
+    assert csv.splitlines()[0].endswith("from,to,hour,usage_amount_cents,usage_tokens")
+    assert len(csv.splitlines()) == 3
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import datetime as dt
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+import pytest
+from sqlalchemy import update
+
+from middleware import webhooks
+from middleware.config import settings
+from middleware.db import SessionLocal
+from middleware.models import Order, ProviderEvent, Wallet
+
+URL = "/v1/webhooks/stripe"
+
+
+def _order(uid: int) -> str:
+    order_id = f"ord-{uuid.uuid4().hex[:8]}"
+    with SessionLocal() as s:
+        s.add(Order(order_id=order_id, user_id=uid, provider="stripe", amount_cents=500, currency="USD", status="created"))
+        s.commit()
+    return order_id
+
+
+def _event(order_id: str, event_type: str = "payment_intent.succeeded") -> tuple[str, bytes]:
+    event_id = f"evt_{uuid.uuid4().hex[:12]}"
+    body = {"id": event_id, "type": event_type, "data": {"object": {"id": f"pi_{order_id}", "amount": 500, "currency": "usd", "metadata": {"order_id": order_id}}}}
+    return event_id, json.dumps(body).encode()
+
+
+def _sign(body: bytes, secret: str, at: int | None = None) -> str:
+    at = int(time.time()) if at is None else at
+    mac = hmac.new(secret.encode(), f"{at}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"t={at},v1={mac}"
+
+
+def _balance(uid: int) -> int:
+    with SessionLocal() as s:
+        return int(s.query(Wallet.balance_cents).filter_by(user_id=uid, currency="USD").scalar() or 0)
+
+
+def _stored(event_id: str) -> ProviderEvent:
+    with SessionLocal() as s:
+        return s.query(ProviderEvent).filter_by(provider="stripe", event_id=event_id).one()
+
+
+def _set(event_id: str, **values) -> None:
+    with SessionLocal() as s:
+        s.execute(update(ProviderEvent).where(ProviderEvent.event_id == event_id).values(**values))
+        s.commit()
+
+
+def _pending_ids() -> list[int]:
+    with SessionLocal() as s:
+        return [i for (i,) in s.query(ProviderEvent.id).filter(webhooks._claimable(dt.datetime.utcnow()))]
+
+
+@pytest.fixture
+def queued(monkeypatch):
+    """Pretend the webhook worker runs: events are stored and acknowledged, not applied."""
+    monkeypatch.setattr(webhooks, "_thread", object())
+    monkeypatch.setattr(webhooks, "_stopping", False)
+
+
+@pytest.fixture
+def failing(monkeypatch):
+    """Make applying events fail until the returned switch is turned off."""
+    broken = [True]
+    apply = webhooks._apply
+
+    def _apply(data, request_id):
+        if broken[0]:
+            raise RuntimeError("billing unavailable")
+        apply(data, request_id)
+
+    monkeypatch.setattr(webhooks, "_apply", _apply)
+    return broken
+
+
+def test_signature_is_checked_when_a_secret_is_set(client, make_user, monkeypatch):
+    monkeypatch.setattr(settings, "STRIPE_WEBHOOK_SECRET", "whsec_test")
+    uid = make_user()
+    event_id, body = _event(_order(uid))
+
+    assert client.post(URL, content=body).status_code == 400
+    assert client.post(URL, content=body, headers={"stripe-signature": _sign(body, "whsec_other")}).status_code == 400
+    assert client.post(URL, content=body, headers={"stripe-signature": _sign(body, "whsec_test", at=int(time.time()) - 3600)}).status_code == 400
+    with SessionLocal() as s:
+        assert s.query(ProviderEvent).filter_by(event_id=event_id).count() == 0
+    assert _balance(uid) == 0
+
+    r = client.post(URL, content=body, headers={"stripe-signature": _sign(body, "whsec_test")})
+    assert r.status_code == 200 and r.json()["event_id"] == event_id
+    assert _balance(uid) == 500
+
+
+def test_malformed_events_are_rejected(client):
+    assert client.post(URL, content=b"{not json").status_code == 400
+    assert client.post(URL, content=json.dumps({"type": "payment_intent.succeeded"}).encode()).status_code == 400
+
+
+def test_duplicate_delivery_is_applied_once(client, make_user):
+    uid = make_user()
+    event_id, body = _event(_order(uid))
+
+    first = client.post(URL, content=body).json()
+    second = client.post(URL, content=body).json()
+    assert (first["duplicate"], second["duplicate"]) == (False, True)
+    assert _stored(event_id).status == "processed"
+    assert _balance(uid) == 500
+
+
+def test_retry_of_an_event_that_failed_inline_is_applied(client, make_user, failing):
+    uid = make_user()
+    event_id, body = _event(_order(uid))
+
+    assert client.post(URL, content=body).status_code == 400  # Stripe will retry
+    pe = _stored(event_id)
+    assert (pe.status, pe.attempts, pe.last_error) == ("received", 1, "billing unavailable")
+
+    failing[0] = False
+    r = client.post(URL, content=body)
+    assert r.status_code == 200 and r.json()["duplicate"] is True
+    assert _stored(event_id).status == "processed"
+    assert _balance(uid) == 500
+
+
+def test_queued_events_back_off_and_end_failed(client, make_user, queued, failing, monkeypatch):
+    monkeypatch.setattr(settings, "WEBHOOK_MAX_ATTEMPTS", 3)
+    uid = make_user()
+    event_id, body = _event(_order(uid))
+    assert client.post(URL, content=body).json()["queued"] is True
+    assert _stored(event_id).status == "received"
+    row_id = _stored(event_id).id
+
+    waits = []
+    for attempt in (1, 2):
+        before = dt.datetime.utcnow()
+        assert webhooks.process_event(row_id)
+        pe = _stored(event_id)
+        assert (pe.status, pe.attempts) == ("received", attempt)
+        waits.append(round((pe.next_attempt_at - before).total_seconds()))
+        assert not webhooks.process_event(row_id)  # backing off
+        _set(event_id, next_attempt_at=dt.datetime.utcnow())
+    assert waits == [2, 4]
+
+    assert webhooks.process_event(row_id)
+    pe = _stored(event_id)
+    assert (pe.status, pe.attempts, pe.next_attempt_at) == ("failed", 3, None)
+    assert not webhooks.process_event(row_id)
+    assert _balance(uid) == 0
+
+
+def test_processing_lease_expires(client, make_user, queued):
+    uid = make_user()
+    event_id, body = _event(_order(uid))
+    client.post(URL, content=body)
+    row_id = _stored(event_id).id
+
+    # a worker claimed the event and died
+    _set(event_id, status="processing", locked_until=dt.datetime.utcnow() + dt.timedelta(seconds=60))
+    assert not webhooks.process_event(row_id)
+    assert row_id not in _pending_ids()
+
+    _set(event_id, locked_until=dt.datetime.utcnow() - dt.timedelta(seconds=1))
+    assert webhooks.process_pending() >= 1
+    assert _stored(event_id).status == "processed"
+    assert _balance(uid) == 500